@@ -0,0 +1,46 @@
+"""
+Session analytics: summarizes recorded telemetry sessions (range of motion, repetitions per minute, time to pop,
+left/right symmetry) and writes a CSV and plot report with the trends over the weeks.
+Each root directory is the session archive of one patient. Summaries are cached next to the sessions,
+so running it again only processes the new ones.
+
+Examples:
+    python analyze.py sessions --output reports
+    python analyze.py archive/patient-01 archive/patient-02 --output reports --since 2024-09-01
+"""
+import argparse
+import os
+import sys
+import time
+
+from coach.Analytics import summarize_sessions, write_report
+
+
+def parse_date(text):
+    return time.mktime(time.strptime(text, '%Y-%m-%d'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('roots', nargs='+', help='Session directories, one per patient')
+    parser.add_argument('--output', '-o', default='reports', help='Directory the reports are written to')
+    parser.add_argument('--workers', type=int, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--since', type=parse_date, help='Only sessions from this date on (YYYY-MM-DD)')
+    parser.add_argument('--until', type=parse_date, help='Only sessions before this date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    for root in args.roots:
+        start = time.perf_counter()
+        summaries = summarize_sessions(root, workers=args.workers, since=args.since, until=args.until)
+        if not summaries:
+            print(f"{root}: no sessions", file=sys.stderr)
+            continue
+        name = os.path.basename(os.path.normpath(root))
+        output = os.path.join(args.output, name) if len(args.roots) > 1 else args.output
+        paths = write_report(summaries, output, title=name)
+        print(f"{root}: {len(summaries)} sessions in {time.perf_counter() - start:.1f}s -> {', '.join(paths)}",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
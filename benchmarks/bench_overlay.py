@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of the sprite compositing: the old float blend from Act.overlay_png against Compositor.
+
+Run from the repository root:
+    python -m benchmarks.bench_overlay
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from coach.Compositor import Compositor
+from coach.Sprites import SpriteAtlas
+
+
+def legacy_overlay_png(background, overlay, pos=(0, 0)):
+    # The float blend Act.overlay_png used before the Compositor, kept here as the reference
+    b, g, r, a = cv2.split(overlay)
+    overlay_rgb = cv2.merge((b, g, r))
+
+    bg_height, bg_width = background.shape[:2]
+    ov_height, ov_width = overlay_rgb.shape[:2]
+
+    x, y = pos
+
+    if x + ov_width > bg_width or y + ov_height > bg_height:
+        ov_width = min(ov_width, bg_width - x)
+        ov_height = min(ov_height, bg_height - y)
+        overlay_rgb = cv2.resize(overlay_rgb, (ov_width, ov_height))
+        a = cv2.resize(a, (ov_width, ov_height))
+
+    overlay_area = background[y:y + ov_height, x:x + ov_width]
+    mask = a / 255.0
+    background[y:y + ov_height, x:x + ov_width] = (1.0 - mask[:, :, None]) * overlay_area + mask[:, :,
+                                                                                            None] * overlay_rgb
+    return background
+
+
+def time_per_call(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--sprites", type=int, default=1, help="Number of balloons drawn per frame")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    args = parser.parse_args()
+
+    atlas = SpriteAtlas()
+    overlay = atlas.balloon(0, 0)
+    sprite = atlas.premultiplied(0, 0)
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    positions = [(int(x), int(y)) for x, y in zip(rng.integers(0, args.width - 100, args.sprites),
+                                                  rng.integers(0, args.height - 100, args.sprites))]
+
+    # Both implementations have to agree up to rounding
+    expected = legacy_overlay_png(frame.copy(), overlay, positions[0])
+    actual = frame.copy()
+    Compositor().blend(actual, sprite, positions[0])
+    max_error = int(np.abs(expected.astype(np.int16) - actual.astype(np.int16)).max())
+
+    compositor = Compositor()
+    placements = [(sprite, pos) for pos in positions]
+    legacy = time_per_call(lambda: [legacy_overlay_png(frame, overlay, pos) for pos in positions], args.iterations)
+    fast = time_per_call(lambda: compositor.blend_many(frame, placements), args.iterations)
+
+    print(f"{args.sprites} sprite(s) of {overlay.shape[1]}x{overlay.shape[0]} on {args.width}x{args.height}, "
+          f"max difference {max_error}")
+    print(f"legacy float blend: {legacy * 1e6:8.1f} us/frame")
+    print(f"compositor:         {fast * 1e6:8.1f} us/frame ({legacy / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Benchmark suite of the coaching hot paths on synthetic pose streams and frames (see benchmarks.synthetic).
+Every hot path is timed on its own, plus the whole game loop without MediaPipe. The results are written to a JSON
+file and compared with a stored baseline; a benchmark that got slower than the tolerance fails the run.
+
+Run from the repository root:
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --output results.json --filter act.
+    python -m benchmarks.bench_suite --update-baseline
+
+The baseline only means something on the machine it was recorded on, record a new one with --update-baseline
+on the reference machine after an intended change.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from coach import Act
+from coach import Sense
+from coach import Think
+from coach.Sense import JOINT_INDEX, PoseResults
+from benchmarks.synthetic import pose_stream, synthetic_frame
+from main import play_frame
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+RESOLUTIONS = ((640, 480), (1280, 720), (1920, 1080))
+
+# name -> (function(stream, resolution) returning the callable to time, uses the resolution)
+BENCHMARKS = {}
+
+
+def benchmark(name, frames=False):
+    """
+    Registers a benchmark. The decorated function sets everything up and returns a callable that processes the
+    next frame of the stream on every call.
+
+    :param name: Name of the benchmark, the resolution is appended for frame benchmarks
+    :param frames: True if it draws on frames and runs once per resolution
+    """
+    def register(function):
+        BENCHMARKS[name] = (function, frames)
+        return function
+    return register
+
+
+class Cycle:
+
+    def __init__(self, stream):
+        # Hands out the frames of a stream round and round
+        self.stream = stream
+        self.index = -1
+
+    def next(self):
+        self.index = (self.index + 1) % len(self.stream.timestamps)
+        return self.index
+
+
+def make_act():
+    random.seed(0)
+    return Act.Act(speech=False)
+
+
+@benchmark('sense.calculate_angle')
+def bench_calculate_angle(stream, resolution):
+    sense = Sense.Sense()
+    cycle = Cycle(stream)
+    joints = [JOINT_INDEX['right_shoulder'], JOINT_INDEX['right_elbow'], JOINT_INDEX['right_wrist']]
+    points = [tuple(map(tuple, frame[joints, :2].tolist())) for frame in stream.landmarks]
+
+    def run():
+        shoulder, elbow, wrist = points[cycle.next()]
+        sense.calculate_angle(shoulder, elbow, wrist, 'right_elbow')
+    return run
+
+
+@benchmark('sense.extract_angles')
+def bench_extract_angles(stream, resolution):
+    sense = Sense.Sense()
+    cycle = Cycle(stream)
+    return lambda: sense.extract_angles(stream.landmarks[cycle.next()])
+
+
+@benchmark('sense.extract_joint_coordinates')
+def bench_extract_joint_coordinates(stream, resolution):
+    sense = Sense.Sense()
+    cycle = Cycle(stream)
+    return lambda: sense.extract_joint_coordinates(stream.landmarks[cycle.next()], 'right_wrist')
+
+
+@benchmark('sense.calculate_distance')
+def bench_calculate_distance(stream, resolution):
+    sense = Sense.Sense()
+    cycle = Cycle(stream)
+    return lambda: sense.calculate_distance(stream.landmarks[cycle.next()])
+
+
+@benchmark('think.update_state')
+def bench_update_state(stream, resolution):
+    think = Think.Think(make_act())
+    cycle = Cycle(stream)
+    sense = Sense.Sense()
+    angles = [sense.extract_angles(frame)[sense.angle_engine.index['right_elbow']] for frame in stream.landmarks]
+
+    def run():
+        index = cycle.next()
+        think.update_state(angles[index], angles[index - 1], stream.timestamps[index])
+    return run
+
+
+@benchmark('think.update_angles')
+def bench_update_angles(stream, resolution):
+    think = Think.Think(make_act())
+    cycle = Cycle(stream)
+    sense = Sense.Sense()
+    angles = np.array([sense.extract_angles(frame) for frame in stream.landmarks])
+    index_of = sense.angle_engine.index
+
+    def run():
+        index = cycle.next()
+        think.update_angles(angles[index], index_of, stream.timestamps[index])
+    return run
+
+
+@benchmark('stats.push')
+def bench_stats_push(stream, resolution):
+    # One sample per tracked joint, the repetition statistics of every frame
+    think = Think.Think(make_act())
+    cycle = Cycle(stream)
+    sense = Sense.Sense()
+    angles = np.array([sense.extract_angles(frame) for frame in stream.landmarks])
+    columns = [sense.angle_engine.index[joint] for joint in think.fsm.joints]
+    samples = angles[:, columns]
+
+    def run():
+        index = cycle.next()
+        think.stats.push(samples[index], stream.timestamps[index])
+    return run
+
+
+@benchmark('think.is_landmark_over_image')
+def bench_is_landmark_over_image(stream, resolution):
+    think = Think.Think(make_act())
+    cycle = Cycle(stream)
+    wrist = JOINT_INDEX['left_wrist']
+    return lambda: think.is_landmark_over_image(stream.landmarks[cycle.next(), wrist], (500, 100, 600, 200),
+                                                1280, 720)
+
+
+@benchmark('think.game.update')
+def bench_game_update(stream, resolution):
+    act = make_act()
+    think = Think.Think(act, max_targets=4)
+    cycle = Cycle(stream)
+    return lambda: think.game.update(stream.landmarks[cycle.next()], 1280, 720)
+
+
+@benchmark('act.show_balloons', frames=True)
+def bench_show_balloons(stream, resolution):
+    # Queues the balloons and composes them, like they are drawn at the start of every game frame
+    act = make_act()
+    think = Think.Think(act, max_targets=4)
+    think.game.update(stream.landmarks[0], *resolution)
+    frame = synthetic_frame(*resolution)
+
+    def run():
+        act.show_balloons(think.game, frame)
+        act.renderer.flush(frame)
+    return run
+
+
+@benchmark('act.overlay_png', frames=True)
+def bench_overlay_png(stream, resolution):
+    act = make_act()
+    overlay = act.sprites.balloon(0, 0)
+    frame = synthetic_frame(*resolution)
+    return lambda: act.overlay_png(frame, overlay, (resolution[0] // 2, resolution[1] // 2))
+
+
+@benchmark('act.provide_feedback', frames=True)
+def bench_provide_feedback(stream, resolution):
+    act = make_act()
+    cycle = Cycle(stream)
+    frame = synthetic_frame(*resolution)
+
+    def run():
+        index = cycle.next()
+        joints = PoseResults(None, stream.landmarks[index], False)
+        act.provide_feedback('flexion', frame, joints, 0.15, stream.timestamps[index])
+    return run
+
+
+@benchmark('end_to_end', frames=True)
+def bench_end_to_end(stream, resolution):
+    # The whole game frame as in main.py, with the landmarks of the stream instead of MediaPipe
+    sense = Sense.Sense()
+    act = make_act()
+    think = Think.Think(act, max_targets=2)
+    cycle = Cycle(stream)
+    camera = synthetic_frame(*resolution)
+    frame = camera.copy()
+    nobody = PoseResults(None, None, False)
+
+    def run():
+        index = cycle.next()
+        np.copyto(frame, camera)
+        joints = PoseResults(None, stream.landmarks[index], False) if stream.detected[index] else nobody
+        play_frame(sense, think, act, frame, joints, stream.timestamps[index], *resolution)
+        if think.game.popped_count >= 10:
+            think.reset()
+    return run
+
+
+def measure(function, number, repeat, warmup=20):
+    """
+    :return: Median and minimum of the time per call in microseconds over repeat rounds of number calls
+    """
+    for _ in range(warmup):
+        function()
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - start) / number)
+    return {'median_us': 1e6 * float(np.median(rounds)), 'min_us': 1e6 * min(rounds), 'number': number,
+            'repeat': repeat}
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'system': platform.system(),
+            'cpus': os.cpu_count(), 'recorded_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def run_suite(names=None, number=200, repeat=7, frames=900, resolutions=RESOLUTIONS, seed=0):
+    """
+    Runs the benchmarks.
+
+    :param names: Only benchmarks whose name contains one of these strings, all if None
+    :param number: Calls per round
+    :param repeat: Rounds per benchmark
+    :param frames: Length of the synthetic pose stream
+    :param resolutions: (width, height) the frame benchmarks run at
+    :param seed: Seed of the synthetic data
+    :return: Dictionary of benchmark name to its timing
+    """
+    stream = pose_stream(frames, seed=seed)
+    results = {}
+    for name, (setup, uses_frames) in BENCHMARKS.items():
+        if names and not any(part in name for part in names):
+            continue
+        for resolution in (resolutions if uses_frames else (None,)):
+            key = f'{name}@{resolution[0]}x{resolution[1]}' if resolution else name
+            results[key] = measure(setup(stream, resolution), number, repeat)
+            print(f"{key:45s} {results[key]['median_us']:10.1f} us", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the results next to the baseline.
+
+    :param tolerance: Allowed slowdown as a fraction, 0.25 fails a benchmark that got more than 25% slower
+    :return: Names of the benchmarks that regressed
+    """
+    regressions = []
+    print(f"{'benchmark':45s} {'baseline':>10s} {'current':>10s} {'change':>8s}")
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name:45s} {'-':>10s} {result['median_us']:10.1f} {'new':>8s}")
+            continue
+        change = result['median_us'] / reference['median_us'] - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:45s} {reference['median_us']:10.1f} {result['median_us']:10.1f} {100 * change:+7.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', '-o', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file to compare with')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before a run fails')
+    parser.add_argument('--filter', nargs='*', help='Only benchmarks whose name contains one of these')
+    parser.add_argument('--number', type=int, default=200, help='Calls per round')
+    parser.add_argument('--repeat', type=int, default=7, help='Rounds per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run_suite(args.filter, args.number, args.repeat, seed=args.seed)
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=1)
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, record one with --update-baseline", file=sys.stderr)
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline['environment'].get('processor') != report['environment']['processor'] or \
+            baseline['environment'].get('cpus') != report['environment']['cpus']:
+        print("The baseline was recorded on a different machine, the comparison is only a rough guide",
+              file=sys.stderr)
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {100 * args.tolerance:.0f}%: "
+              f"{', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Synthetic input for the benchmarks: scripted pose streams in the layout of Sense's landmark array and camera-like
+frames, all generated from a seed so every run sees the same data.
+"""
+import collections
+
+import numpy as np
+
+from coach.Sense import JOINT_INDEX, NUM_LANDMARKS
+from coach.Think import LIMB_LANDMARKS
+
+
+# A generated recording. landmarks has shape (frames, 33, 4), detected is False for frames without a pose.
+PoseStream = collections.namedtuple('PoseStream', ['timestamps', 'landmarks', 'detected'])
+
+# A person standing in the middle of the frame, normalized (x, y, z) of every MediaPipe landmark
+TEMPLATE = np.zeros((NUM_LANDMARKS, 3))
+TEMPLATE[0:11, :2] = [(0.50, 0.20), (0.49, 0.18), (0.48, 0.18), (0.47, 0.18), (0.51, 0.18), (0.52, 0.18),
+                      (0.53, 0.18), (0.46, 0.19), (0.54, 0.19), (0.49, 0.23), (0.51, 0.23)]
+TEMPLATE[11:17, :2] = [(0.42, 0.35), (0.58, 0.35), (0.38, 0.48), (0.62, 0.48), (0.36, 0.60), (0.64, 0.60)]
+TEMPLATE[17:23, :2] = [(0.35, 0.63), (0.65, 0.63), (0.36, 0.64), (0.64, 0.64), (0.37, 0.62), (0.63, 0.62)]
+TEMPLATE[23:29, :2] = [(0.45, 0.62), (0.55, 0.62), (0.45, 0.78), (0.55, 0.78), (0.45, 0.93), (0.55, 0.93)]
+TEMPLATE[29:33, :2] = [(0.44, 0.95), (0.56, 0.95), (0.47, 0.96), (0.53, 0.96)]
+
+# (shoulder, elbow, wrist, hand landmarks, rotation direction) of both arms
+ARMS = ((JOINT_INDEX['right_shoulder'], JOINT_INDEX['right_elbow'], JOINT_INDEX['right_wrist'], (17, 19, 21), 1),
+        (JOINT_INDEX['left_shoulder'], JOINT_INDEX['left_elbow'], JOINT_INDEX['left_wrist'], (18, 20, 22), -1))
+FOREARM = 0.13
+
+
+def pose_stream(frames=900, fps=30.0, seed=0, rep_period=2.0, jitter=0.003, dropout=0.02, reach_every=3.0,
+                reach_duration=0.6):
+    """
+    Generates a recording of elbow flexion/extension with reaches for balloons in between.
+
+    :param frames: Number of frames
+    :param fps: Frame rate the timestamps are spaced at
+    :param seed: Seed of the random reaches, jitter and dropouts
+    :param rep_period: Seconds of one flexion/extension cycle, the elbows move between 40 and 170 degrees
+    :param jitter: Standard deviation of the noise added to every coordinate
+    :param dropout: Fraction of frames in which nobody is detected, in bursts of up to 5 frames
+    :param reach_every: Seconds between two reaches of a wrist or knee towards a random location
+    :param reach_duration: Seconds of a reach, out and back
+    :return: PoseStream
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(frames) / fps
+    landmarks = np.zeros((frames, NUM_LANDMARKS, 4))
+    landmarks[:, :, :3] = TEMPLATE
+
+    # Rotating the upper arm direction by the elbow angle gives the forearm direction
+    theta = np.radians(105 - 65 * np.cos(2 * np.pi * timestamps / rep_period))
+    for shoulder, elbow, wrist, hands, sign in ARMS:
+        upper = TEMPLATE[shoulder, :2] - TEMPLATE[elbow, :2]
+        upper /= np.linalg.norm(upper)
+        cos, sin = np.cos(sign * theta), np.sin(sign * theta)
+        direction = np.stack([cos * upper[0] - sin * upper[1], sin * upper[0] + cos * upper[1]], axis=-1)
+        landmarks[:, wrist, :2] = TEMPLATE[elbow, :2] + FOREARM * direction
+        for hand in hands:
+            landmarks[:, hand, :2] = TEMPLATE[elbow, :2] + (FOREARM + 0.03) * direction
+
+    # Reaches: a balloon landmark moves out to a random location and back
+    for start in np.arange(reach_every, timestamps[-1] if frames else 0, reach_every):
+        landmark = LIMB_LANDMARKS[rng.integers(len(LIMB_LANDMARKS))]
+        target = rng.uniform(0.1, 0.9, 2)
+        phase = (timestamps - start) / reach_duration
+        reaching = (phase >= 0) & (phase <= 1)
+        weight = np.sin(np.pi * phase[reaching])[:, None]
+        landmarks[reaching, landmark, :2] += weight * (target - landmarks[reaching, landmark, :2])
+
+    landmarks[:, :, :3] += rng.normal(0, jitter, (frames, NUM_LANDMARKS, 3))
+    landmarks[:, :, 3] = rng.uniform(0.85, 1.0, (frames, NUM_LANDMARKS))
+
+    # Dropouts come in bursts, like a patient walking out of the picture for a moment
+    starts = rng.random(frames) < dropout / 3
+    lengths = rng.integers(1, 6, frames)
+    lost = np.zeros(frames + 6, dtype=int)
+    np.add.at(lost, np.flatnonzero(starts), 1)
+    np.add.at(lost, np.flatnonzero(starts) + lengths[starts], -1)
+    detected = np.cumsum(lost)[:frames] == 0
+    return PoseStream(timestamps, landmarks.astype(np.float32), detected)
+
+
+def synthetic_frame(width, height, seed=0):
+    """
+    A camera-like BGR frame: a smooth gradient with sensor noise, so nothing compresses or caches unrealistically.
+    """
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(40, 200, width)[None, :, None] + np.linspace(0, 40, height)[:, None, None]
+    noise = rng.normal(0, 8, (height, width, 3))
+    return np.clip(gradient + noise, 0, 255).astype(np.uint8)
@@ -1,70 +1,126 @@
 # Act Component: Provide feedback to the user
 import math
-import threading
-import time
 
-import mediapipe as mp
 import cv2
 import numpy as np
 import random
-import pyttsx3
-import queue
-import random
+
+from coach.Compositor import Compositor, PremultipliedSprite
+from coach.Events import DROP_OLDEST, HIT, REP, STATE, STATS
+from coach.Renderer import Renderer
+from coach.Speech import Speech
+from coach.Sprites import SpriteAtlas
+from coach.Think import LIMB_JOINTS
 
 
 # Act Component: Visualization to motivate user, visualization such as the skeleton and debugging information.
 # Things to add: Other graphical visualization, a proper GUI, more verbal feedback
 class Act:
 
-    def __init__(self):
-        self.popped_count = 0
+    def __init__(self, speech=True, sprites=None, bus=None):
+        """
+        :param speech: Start the text-to-speech engine, switched off for headless runs
+        :param sprites: SpriteAtlas to use, e.g. one that already showed the tutorial. A new one if None.
+        :param bus: EventBus of Think to subscribe to, see subscribe()
+        """
         self.finish_time = None
-        self.engine = pyttsx3.init()
-        self.speech_queue = queue.Queue()
         self.motivating_utterances = ['keep on going', 'you are doing great. I see it', 'only a few left',
                                       'that is awesome', 'you have almost finished the exercise']
+        # Speech runs on its own thread, the motivating utterances are pre-rendered there
+        self.speech = Speech(self.motivating_utterances) if speech else None
 
-        self.stage = 0
-        self.location = (500, 100)
-        self.current_balloon = 0
         self.limb_list = [0, 1, 2, 3]
-        # Handles balloon inflation and reset after explosion
 
-        t = threading.Thread(target=self._speech_thread, args=())
-        t.start()
+        # Repetitions reported by Think's state machines, every few of them get a motivating utterance
+        self.rep_count = 0
+        self.reps_per_utterance = 5
+
+        # Latest state change and pop seen on the bus, shown by provide_feedback
+        self.decision = None
+        self.pop_message_time = 1.0
+        self._popped_at = None
+        self.subscriptions = []
+        self._render_events = None
+
+        # Adaptive difficulty: the balloons of a limb are placed within the reach its range of motion allows,
+        # a fraction of the limb's quarter of the frame measured from the frame center
+        self.last_rep = None
+        self.reach = [1.0] * len(self.limb_list)
+        self.target_rom = 120.0
+        self.min_reach = 0.4
+        self.challenge = 0.1
+        self.min_reps_for_reach = 3
+
+        # All balloon stages and screen images are decoded once, show_balloon only looks them up
+        self.sprites = sprites or SpriteAtlas()
+        self.sprites.preload()
+        self.compositor = Compositor()
+        # Balloons, skeleton and text of a game frame are queued and drawn together by provide_feedback
+        self.renderer = Renderer(self.compositor)
+
+        if bus is not None:
+            self.subscribe(bus)
+
+    def subscribe(self, bus):
+        """
+        Subscribes to Think's events. Repetitions are handled on a thread of their own, so a slow voice only
+        ever drops old repetitions. State changes and hits wait for provide_feedback on the frame loop.
+        """
+        self.subscriptions.append(bus.subscribe(REP, lambda event: self.on_rep(event.data), policy=DROP_OLDEST,
+                                                max_pending=4, name='act.speech'))
+        self._render_events = bus.subscribe((STATE, HIT, STATS), policy=DROP_OLDEST, max_pending=32,
+                                            name='act.render')
+        self.subscriptions.append(self._render_events)
 
     def speak_text(self, text):
         """
-        Speaks the given text using pyttsx3 text-to-speech engine.
+        Speaks the given text using pyttsx3 text-to-speech engine. Returns immediately.
         :param text: The text to be spoken
         """
-        self.speech_queue.put(text)
+        if self.speech is not None:
+            self.speech.say(text)
 
-    def _speech_thread(self):
-        while True:
-            try:
-                # Try to get an item with a small timeout to avoid blocking indefinitely
-                item = self.speech_queue.get(timeout=1)
-                self.engine.say(item)
-                self.engine.runAndWait()
-                self.speech_queue.task_done()
-            except queue.Empty:
-                time.sleep(1)
-    def provide_feedback(self, decision, frame, joints, distance, elapsed_time):
+    def on_rep(self, event):
+        """
+        Called for every repetition (a coach.Fsm.RepEvent) Think publishes, motivates the user now and then.
+        :param event: The repetition with the joint, its kind and the angle it was completed at
+        """
+        self.rep_count += 1
+        if self.rep_count % self.reps_per_utterance == 0:
+            self.speak_text(random.choice(self.motivating_utterances))
+
+    def close(self):
+        """
+        Unsubscribes from the bus and stops the speech thread.
         """
-        Displays the skeleton and some text using open cve.
+        for subscription in self.subscriptions:
+            subscription.close(drain=False)
+        if self.speech is not None:
+            self.speech.stop()
 
-        :param decision: The decision in which state the user is from the think component.
+    def provide_feedback(self, decision=None, frame=None, joints=None, distance=0.0, elapsed_time=0.0):
+        """
+        Displays the skeleton and some text using open cve. Everything queued for this frame (the balloons from
+        show_balloons, the skeleton and the text) is drawn in one pass at the end.
+
+        :param decision: The state the user is in, the latest state change from the bus if None.
         :param frame: The currently processed frame form the webcam.
-        :param joints: The joints extracted from mediapipe from the current frame.
-        :param elbow_angle_mvg: The moving average from the left elbow angle.
+        :param joints: The PoseResults of the current frame from Sense.
+        :param distance: The distance estimate from Sense.calculate_distance.
+        :param elapsed_time: Seconds since the game started.
 
         """
 
-        mp.solutions.drawing_utils.draw_landmarks(frame, joints.pose_landmarks, mp.solutions.pose.POSE_CONNECTIONS)
+        self.take_events(elapsed_time)
+        if decision is None:
+            decision = self.decision
+
+        self.renderer.skeleton(joints.landmarks)
 
         # Define the number and text to display
         text = ""
+        if self._popped_at is not None and elapsed_time - self._popped_at < self.pop_message_time:
+            text = "Pop!"
         distance_text = ""
 
         near = 0.2
@@ -78,114 +134,129 @@ class Act:
         elif near < distance:
             distance_text = f"You are out of range! Move away from the camera."
 
-        # Draw the text on the image
-        cv2.putText(frame, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255),
-                    2)  # White color for contrast
-        cv2.putText(frame, distance_text, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255),
-                    2)  # Adjusted y-coordinate
-        # Format the elapsed time to display
+        # Draw the text on the image, white color for contrast. Unchanged strings are not rasterized again.
+        self.renderer.text('text', text, (50, 50))
+        self.renderer.text('distance', distance_text, (50, 100))
+        if self.last_rep is not None:
+            rep = self.last_rep
+            self.renderer.text('stats', f"{rep.joint}: ROM {rep.rom:.0f} deg (median {rep.summary.rom_p50:.0f}), "
+                                        f"{rep.duration:.1f} s, peak {rep.peak_velocity:.0f} deg/s", (50, 150),
+                               scale=0.6)
+        # Format the elapsed time to display. It changes on every frame, so it is not worth caching.
         elapsed_time_text = f"Duration: {elapsed_time:.2f} seconds"
-        cv2.putText(frame, elapsed_time_text, (50, 400), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255), 2)
+        self.renderer.text('elapsed_time', elapsed_time_text, (50, 400), cached=False)
+
+        self.renderer.flush(frame)
         # Display the frame
         # cv2.imshow('Sport Coaching Program', frame)
 
-    def overlay_png(self, background, overlay, pos=(0, 0), overlay_size=None):
-        # Resize the overlay if a size is specified
-        if overlay_size is not None:
-            overlay = cv2.resize(overlay, overlay_size)
-
-        # Split the channels (B, G, R, A)
-        b, g, r, a = cv2.split(overlay)
-        overlay_rgb = cv2.merge((b, g, r))
-
-        # Get dimensions of background and overlay
-        bg_height, bg_width = background.shape[:2]
-        ov_height, ov_width = overlay_rgb.shape[:2]
-
-        x, y = pos
-
-        # Ensure the overlay doesn't exceed the background dimensions
-        if x + ov_width > bg_width or y + ov_height > bg_height:
-            ov_width = min(ov_width, bg_width - x)
-            ov_height = min(ov_height, bg_height - y)
-            overlay_rgb = cv2.resize(overlay_rgb, (ov_width, ov_height))
-            a = cv2.resize(a, (ov_width, ov_height))
+    def take_events(self, elapsed_time):
+        """
+        Takes the state changes, hits and repetition statistics that were published since the last frame.
+        """
+        if self._render_events is None:
+            return
+        for event in self._render_events.poll():
+            if event.topic == STATE:
+                self.decision = event.data.dest
+            elif event.topic == HIT and event.data.popped:
+                self._popped_at = elapsed_time
+            elif event.topic == STATS:
+                self.last_rep = event.data
+                self.update_reach(event.data.summary)
+
+    def update_reach(self, summary):
+        """
+        Adapts how far the balloons of the limbs moved by a joint are placed to the joint's range of motion:
+        a bit beyond the 90th percentile of its repetitions so far, relative to target_rom.
 
-        # Prepare the region for overlay
-        overlay_area = background[y:y + ov_height, x:x + ov_width]
+        :param summary: coach.Stats.StatsSummary of the joint
+        """
+        if summary.reps < self.min_reps_for_reach:
+            return
+        reach = min(1.0, max(self.min_reach, summary.rom_p90 / self.target_rom + self.challenge))
+        for limb, joint in enumerate(LIMB_JOINTS):
+            if joint == summary.joint:
+                self.reach[limb] = reach
 
-        # Create a mask using the alpha channel
-        mask = a / 255.0
+    def overlay_png(self, background, overlay, pos=(0, 0), overlay_size=None):
+        """
+        Blends a BGRA image into the background in place. Parts outside the background are clipped.
 
-        # Blend the overlay with the background
-        background[y:y + ov_height, x:x + ov_width] = (1.0 - mask[:, :, None]) * overlay_area + mask[:, :,
-                                                                                                None] * overlay_rgb
+        :param background: The BGR frame to draw on
+        :param overlay: BGRA image, or an already premultiplied sprite from the sprite atlas
+        :param pos: (x, y) of the top left corner of the overlay, may be negative
+        :param overlay_size: Optional (width, height) to resize a BGRA overlay to first
+        :return: The background
+        """
+        if not isinstance(overlay, PremultipliedSprite):
+            # Resize the overlay if a size is specified
+            if overlay_size is not None:
+                overlay = cv2.resize(overlay, overlay_size)
+            overlay = Compositor.premultiply(overlay)
 
+        self.compositor.blend(background, overlay, pos)
         return background
-    def show_balloon(self, type, frame):
-        # Choose image
-        balloon_paths = {
-            0: "Left_hand",
-            1: "Left_knee",
-            2: "Right_hand",
-            3: "Right_knee"
-        }
-        balloon_colors = {
-            0: "green",
-            1: "yellow",
-            2: "blue",
-            3: "red"
-        }
-        if 0 <= self.stage <= 5:
-            base_path = f"images/{balloon_paths[type]}/{balloon_colors[type]}_balloon"
-            if self.stage == 0:
-                path = f"{base_path}.png"
-            else:
-                path = f"{base_path}_popping{self.stage}.png"
-        overlay_img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-        overlay_img = cv2.resize(overlay_img, (100, 100))
 
-        overlay_height, overlay_width, _ = overlay_img.shape
-        overlay_pos = self.location
+    def show_balloons(self, game, frame):
+        """
+        Queues every active balloon of the game, they are drawn by the next provide_feedback.
 
-        # frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        # mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=frame_rgb)
-        # frame = self.overlay_png(frame, overlay_img, overlay_pos)
-        self.overlay_png(frame, overlay_img, overlay_pos)
+        :param game: The BalloonGame from the think component
+        :param frame: The frame the balloons are shown on
+        """
+        # Smaller sprites (see set_sprite_size) are centered on the balloon, its hit area stays the same
+        offset_x = (game.balloon_size - self.sprites.size[0]) // 2
+        offset_y = (game.balloon_size - self.sprites.size[1]) // 2
+        for slot in game.slots:
+            # Choose image
+            overlay_img = self.sprites.premultiplied(int(game.limb[slot]), int(game.stage[slot]))
+            self.renderer.sprite(overlay_img, (int(game.x[slot]) + offset_x, int(game.y[slot]) + offset_y))
+
+    def set_sprite_size(self, size):
+        """
+        Changes the size the balloons are drawn at, e.g. to save blending time on a slow machine.
 
-        overlay_rect = (
-            overlay_pos[0], overlay_pos[1], overlay_pos[0] + overlay_width, overlay_pos[1] + overlay_height)  # hit box
+        :param size: Width and height of the balloon sprites in pixels
+        """
+        self.sprites.set_size((size, size))
 
-        # frame[overlay_pos[1]:overlay_pos[1] + overlay_height,
-        # overlay_pos[0]:overlay_pos[0] + overlay_width] = overlay_img  # put in frame
+    def random_location(self, limb, frame_width, frame_height):
+        """
+        Picks a random location for a new balloon in the quarter of the frame belonging to its limb.
 
-        return overlay_rect
+        The balloons of a limb whose reach is limited (see update_reach) stay in the part of the quarter that is
+        closest to the frame center.
 
-    def random_location(self, frame_width, frame_height):
-        x, y = 0, 0
-        if self.current_balloon == 0:
+        :param limb: The limb of the balloon (0-3)
+        :return: (x, y) of the top left corner of the balloon
+        """
+        if limb == 0:
             x1lim, x2lim = 0, int(frame_width / 2) - 100
             y1lim, y2lim = 0, int(frame_height / 2) - 100
-        elif self.current_balloon == 1:
+        elif limb == 1:
             x1lim, x2lim = 0, int(frame_width / 2) - 100
             y1lim, y2lim = int(frame_height / 2), frame_height - 100
-        elif self.current_balloon == 2:
+        elif limb == 2:
             x1lim, x2lim = int(frame_width / 2), frame_width - 100
             y1lim, y2lim = 0, int(frame_height / 2) - 100
-        elif self.current_balloon == 3:
+        elif limb == 3:
             x1lim, x2lim = int(frame_width / 2), frame_width - 100
             y1lim, y2lim = int(frame_height / 2), frame_height - 100
         # return (0, frame_height-100)
-        return random.randrange(x1lim, x2lim, 1), random.randrange(y1lim, y2lim, 1)
 
-    def enlarge(self, frame_width, frame_height):
-        if self.stage == 5:
-            self.stage = 0
-            self.current_balloon = random.choice([x for x in self.limb_list if x != self.current_balloon])
-            self.location = self.random_location(frame_width, frame_height)
-            self.popped_count += 1
-        else:
-            self.stage += 1
+        reach = self.reach[limb]
+        if reach < 1.0:
+            # Shrink the quarter towards the frame center
+            if x2lim <= frame_width / 2:
+                x1lim = x2lim - max(1, int((x2lim - x1lim) * reach))
+            else:
+                x2lim = x1lim + max(1, int((x2lim - x1lim) * reach))
+            if y2lim <= frame_height / 2:
+                y1lim = y2lim - max(1, int((y2lim - y1lim) * reach))
+            else:
+                y2lim = y1lim + max(1, int((y2lim - y1lim) * reach))
+        return random.randrange(x1lim, x2lim, 1), random.randrange(y1lim, y2lim, 1)
 
 # class Bubble:
 #     def __init__(self, overlay_pos, overlay_rect, overlay_image):
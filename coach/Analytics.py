@@ -0,0 +1,279 @@
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from coach.Sense import ANGLE_TRIPLES, AngleEngine
+from coach.Telemetry import META_FILE, Session, open_sessions
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever summarize_session changes, so cached summaries of older versions are recomputed
+ANALYTICS_VERSION = 1
+SUMMARY_FILE = 'summary.json'
+
+# Landmarks below this visibility make an angle unknown for that frame
+MIN_VISIBILITY = 0.5
+
+# Range of motion is taken between these percentiles, so single glitched frames do not count
+ROM_PERCENTILES = (5, 95)
+
+
+def _cache_key(path):
+    stat = os.stat(os.path.join(path, META_FILE))
+    return [ANALYTICS_VERSION, stat.st_mtime_ns, stat.st_size]
+
+
+def _count_reps(state, states, reps):
+    # Repetitions per joint: state changes (previous, current) that are a rep transition of the exercise
+    if len(state) < 2 or not reps:
+        return np.zeros(state.shape[1], dtype=np.int64)
+    codes = np.array([states.index(source) * len(states) + states.index(dest) for source, dest, _ in reps])
+    previous, current = state[:-1].astype(np.int64), state[1:].astype(np.int64)
+    changes = (previous != current) & (previous >= 0) & (current >= 0)
+    return (np.isin(previous * len(states) + current, codes) & changes).sum(axis=0)
+
+
+def summarize_session(path):
+    """
+    Computes the metrics of one recorded session. Every metric is a NumPy reduction over the whole session.
+
+    :param path: Directory of the session
+    :return: Dictionary with the session metrics: duration, reps, reps per minute, time to pop, range of motion
+             per angle (rom_<angle>, in degrees) and left/right symmetry (symmetry_<joint>, 1 is symmetric).
+             A session without frames has no reps and None for the metrics it cannot measure.
+    """
+    session = Session(path)
+    frames = session.frames
+    names = [name for name in session.angle_names if name in ANGLE_TRIPLES]
+    summary = {
+        'session_id': session.session_id,
+        'started_at': session.started_at,
+        'date': time.strftime('%Y-%m-%d', time.localtime(session.started_at)),
+        'week': time.strftime('%G-W%V', time.localtime(session.started_at)),
+        'complete': session.complete,
+        'frames': len(frames),
+    }
+    if not len(frames):
+        # Stopped before the first frame was recorded
+        return _empty_summary(session, names, summary)
+
+    timestamp = frames.column('timestamp')
+    duration = float(timestamp[-1] - timestamp[0]) if len(timestamp) > 1 else 0.0
+
+    # Angles again from the landmarks: unsmoothed, and only on frames MediaPipe actually detected
+    engine = AngleEngine({name: ANGLE_TRIPLES[name] for name in names})
+    landmarks = frames.column('landmarks')
+    detected = ~frames.column('predicted') & ~np.isnan(landmarks[:, 0, 0])
+    landmarks = landmarks[detected]
+    angles = np.degrees(engine.compute(landmarks))
+    visible = landmarks[:, engine.triples, 3].min(axis=2) >= MIN_VISIBILITY
+    angles[~visible] = np.nan
+
+    summary.update({
+        'detected_frames': int(detected.sum()),
+        'duration_s': duration,
+        'finish_time_s': session.finish_time,
+        'popped': int(frames.column('popped')[-1]),
+    })
+
+    reps = _count_reps(frames.column('state'), session.states, session.reps)
+    summary['reps'] = int(reps.sum())
+    summary['reps_per_minute'] = 60 * summary['reps'] / duration if duration > 0 else None
+    for joint, count in zip(session.joints, reps):
+        summary[f'reps_{joint}'] = int(count)
+
+    # Time between two pops, the first one counted from the start of the game
+    balloons = session.balloons
+    pops = balloons.column('timestamp')[balloons.column('popped')] if len(balloons) else np.zeros(0)
+    if len(pops):
+        time_to_pop = np.diff(pops, prepend=timestamp[0])
+        summary['time_to_pop_mean_s'] = float(time_to_pop.mean())
+        summary['time_to_pop_median_s'] = float(np.median(time_to_pop))
+    else:
+        summary['time_to_pop_mean_s'] = summary['time_to_pop_median_s'] = None
+
+    rom = {}
+    for name, column in zip(engine.names, angles.T):
+        column = column[~np.isnan(column)]
+        low, high = np.percentile(column, ROM_PERCENTILES) if len(column) else (np.nan, np.nan)
+        rom[name] = float(high - low)
+        summary[f'rom_{name}'] = rom[name] if len(column) else None
+
+    # Symmetry: smaller over larger range of motion of the left and right side
+    for name in engine.names:
+        if not name.startswith('left_') or 'right_' + name[5:] not in rom:
+            continue
+        left, right = rom[name], rom['right_' + name[5:]]
+        larger = max(left, right)
+        summary[f'symmetry_{name[5:]}'] = min(left, right) / larger if larger > 0 else None
+    return summary
+
+
+def _empty_summary(session, names, summary):
+    # Same metrics as summarize_session, with nothing counted and nothing measured
+    summary.update({'detected_frames': 0, 'duration_s': 0.0, 'finish_time_s': session.finish_time, 'popped': 0,
+                    'reps': 0, 'reps_per_minute': None})
+    summary.update((f'reps_{joint}', 0) for joint in session.joints)
+    summary['time_to_pop_mean_s'] = summary['time_to_pop_median_s'] = None
+    summary.update((f'rom_{name}', None) for name in names)
+    summary.update((f'symmetry_{name[5:]}', None) for name in names
+                   if name.startswith('left_') and 'right_' + name[5:] in names)
+    return summary
+
+
+def _load_cached(path):
+    try:
+        with open(os.path.join(path, SUMMARY_FILE)) as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return cached['summary'] if cached.get('key') == _cache_key(path) else None
+
+
+def _store_cached(path, key, summary):
+    try:
+        with open(os.path.join(path, SUMMARY_FILE), 'w') as file:
+            json.dump({'key': key, 'summary': summary}, file)
+    except OSError:
+        # Read-only archives are summarized again next time
+        pass
+
+
+def _summarize(path):
+    # Runs in the worker processes. The key is taken first, so a session that grows meanwhile is seen as stale.
+    # A session that cannot be read is returned with its error instead of failing the whole pool.
+    try:
+        key = _cache_key(path)
+        summary = summarize_session(path)
+    except Exception as error:
+        return None, f"{type(error).__name__}: {error}"
+    if summary['complete']:
+        _store_cached(path, key, summary)
+    return summary, None
+
+
+def summarize_sessions(root='sessions', workers=None, since=None, until=None):
+    """
+    Summarizes every session under root. Sessions with an up to date summary.json are not read again,
+    the others are summarized in parallel by a process pool. Sessions that cannot be summarized (e.g. damaged
+    chunk files) are logged and skipped.
+
+    :param root: Directory the sessions were recorded to
+    :param workers: Number of worker processes, the CPU count if None
+    :param since: Only sessions started at or after this time.time() value
+    :param until: Only sessions started before this time.time() value
+    :return: List of session summaries, oldest first
+    """
+    paths = [session.path for session in open_sessions(root, since, until)]
+    summaries = {path: _load_cached(path) for path in paths}
+    stale = [path for path, summary in summaries.items() if summary is None]
+    if len(stale) == 1 or workers == 1:
+        results = [_summarize(path) for path in stale]
+    elif stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_summarize, stale, chunksize=max(len(stale) // 64, 1)))
+    else:
+        results = []
+    for path, (summary, error) in zip(stale, results):
+        if error is not None:
+            logger.warning("Skipped session %s: %s", path, error)
+        summaries[path] = summary
+    return [summaries[path] for path in paths if summaries[path] is not None]
+
+
+def weekly_trends(summaries):
+    """
+    Averages the metrics of the sessions per ISO week.
+
+    :param summaries: Session summaries from summarize_sessions
+    :return: List of dictionaries, one per week with the number of sessions and the mean of every metric
+    """
+    metrics = [key for key in _fields(summaries) if key.startswith(('rom_', 'symmetry_', 'reps', 'time_to_pop_'))
+               or key in ('duration_s', 'finish_time_s', 'popped')]
+    weeks = sorted({summary['week'] for summary in summaries})
+    rows = []
+    for week in weeks:
+        sessions = [summary for summary in summaries if summary['week'] == week]
+        row = {'week': week, 'sessions': len(sessions)}
+        for metric in metrics:
+            values = np.array([summary.get(metric) for summary in sessions], dtype=float)
+            row[metric] = float(np.nanmean(values)) if not np.isnan(values).all() else None
+        rows.append(row)
+    return rows
+
+
+def _fields(rows):
+    # Union of the keys of all rows in order, sessions of different exercises can have different metrics
+    fields = []
+    for row in rows:
+        fields += [field for field in row if field not in fields]
+    return fields
+
+
+def _write_csv(path, rows):
+    fields = _fields(rows)
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_report(summaries, output, title='Sessions'):
+    """
+    Writes sessions.csv, weekly.csv and report.png with the trends over the weeks to the output directory.
+
+    :param summaries: Session summaries from summarize_sessions
+    :param output: Directory the report is written to
+    :param title: Title of the plots, e.g. the patient
+    :return: Paths of the written files
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(output, exist_ok=True)
+    weekly = weekly_trends(summaries)
+    paths = [os.path.join(output, 'sessions.csv'), os.path.join(output, 'weekly.csv'),
+             os.path.join(output, 'report.png')]
+    _write_csv(paths[0], summaries)
+    _write_csv(paths[1], weekly)
+
+    days = np.array([summary['started_at'] for summary in summaries], dtype=float) / 86400
+    days -= days[0] if len(days) else 0
+
+    def series(metric):
+        return np.array([np.nan if summary.get(metric) is None else summary[metric] for summary in summaries])
+
+    fields = _fields(summaries)
+    rom_metrics = [key for key in fields if key.startswith('rom_')]
+    symmetry_metrics = [key for key in fields if key.startswith('symmetry_')]
+
+    figure, axes = plt.subplots(2, 2, figsize=(12, 8))
+    figure.suptitle(title)
+    for metric in rom_metrics:
+        axes[0, 0].plot(days, series(metric), marker='.', label=metric[4:])
+    axes[0, 0].set_title('Range of motion (degrees)')
+    if rom_metrics:
+        axes[0, 0].legend(fontsize='small', ncol=2)
+    axes[0, 1].plot(days, series('reps_per_minute'), marker='.')
+    axes[0, 1].set_title('Repetitions per minute')
+    axes[1, 0].plot(days, series('time_to_pop_mean_s'), marker='.')
+    axes[1, 0].set_title('Mean time to pop (s)')
+    for metric in symmetry_metrics:
+        axes[1, 1].plot(days, series(metric), marker='.', label=metric[9:])
+    axes[1, 1].set_title('Left/right symmetry')
+    axes[1, 1].set_ylim(0, 1.05)
+    if symmetry_metrics:
+        axes[1, 1].legend(fontsize='small')
+    for axis in axes.flat:
+        axis.set_xlabel('Days since first session')
+        axis.grid(True, alpha=0.3)
+    figure.tight_layout()
+    figure.savefig(paths[2], dpi=100)
+    plt.close(figure)
+    return paths
@@ -0,0 +1,87 @@
+import collections
+
+import numpy as np
+
+
+# A sprite prepared for blending: colour already multiplied by alpha and the inverted alpha as uint16,
+# so blending is one multiply-add per channel in integer math.
+PremultipliedSprite = collections.namedtuple('PremultipliedSprite', ['color', 'inv_alpha'])
+
+
+# Compositor: blends premultiplied sprites into a frame in place using fixed-point integer math.
+class Compositor:
+
+    def __init__(self):
+        # Scratch buffers reused by every blend, they only grow when a bigger sprite comes along
+        self._scratch = np.empty((0, 0, 3), dtype=np.uint16)
+        self._shifted = np.empty((0, 0, 3), dtype=np.uint16)
+
+    @staticmethod
+    def premultiply(overlay):
+        """
+        Converts a BGRA image into premultiplied form. Done once per sprite, not per frame.
+
+        :param overlay: uint8 array of shape (height, width, 4)
+        :return: PremultipliedSprite with uint16 colour and inverted alpha
+        """
+        color = overlay[:, :, :3].astype(np.uint16)
+        alpha = overlay[:, :, 3:4].astype(np.uint16)
+        # round(color * alpha / 255)
+        color *= alpha
+        color += 127
+        color //= 255
+        return PremultipliedSprite(color, 255 - alpha)
+
+    def blend(self, frame, sprite, pos):
+        """
+        Blends a premultiplied sprite into the frame in place. Parts outside the frame are clipped by slicing,
+        so negative positions and sprites crossing the border are allowed.
+
+        :param frame: uint8 BGR frame that is drawn on
+        :param sprite: PremultipliedSprite to draw
+        :param pos: (x, y) of the top left corner of the sprite in the frame
+        :return: The drawn rectangle (x1, y1, x2, y2) in frame coordinates, None if nothing was visible
+        """
+        frame_height, frame_width = frame.shape[:2]
+        sprite_height, sprite_width = sprite.color.shape[:2]
+        x, y = int(pos[0]), int(pos[1])
+
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + sprite_width, frame_width), min(y + sprite_height, frame_height)
+        if x1 >= x2 or y1 >= y2:
+            return None
+
+        sx1, sy1 = x1 - x, y1 - y
+        sx2, sy2 = sx1 + (x2 - x1), sy1 + (y2 - y1)
+        color = sprite.color[sy1:sy2, sx1:sx2]
+        inv_alpha = sprite.inv_alpha[sy1:sy2, sx1:sx2]
+        roi = frame[y1:y2, x1:x2]
+
+        scratch, shifted = self._buffers(y2 - y1, x2 - x1)
+        # out = color + round(roi * (255 - alpha) / 255), with the division done as (t + (t >> 8)) >> 8
+        np.multiply(roi, inv_alpha, out=scratch, dtype=np.uint16)
+        scratch += 128
+        np.right_shift(scratch, 8, out=shifted)
+        scratch += shifted
+        scratch >>= 8
+        scratch += color
+        np.copyto(roi, scratch, casting='unsafe')
+
+        return x1, y1, x2, y2
+
+    def blend_many(self, frame, placements):
+        """
+        Blends several sprites into the frame in one call, in the given order.
+
+        :param frame: uint8 BGR frame that is drawn on
+        :param placements: Iterable of (PremultipliedSprite, (x, y)) pairs
+        :return: List with the drawn rectangle of every placement (None for invisible ones)
+        """
+        return [self.blend(frame, sprite, pos) for sprite, pos in placements]
+
+    def _buffers(self, height, width):
+        if self._scratch.shape[0] < height or self._scratch.shape[1] < width:
+            shape = (max(height, self._scratch.shape[0]), max(width, self._scratch.shape[1]), 3)
+            self._scratch = np.empty(shape, dtype=np.uint16)
+            self._shifted = np.empty(shape, dtype=np.uint16)
+        return self._scratch[:height, :width], self._shifted[:height, :width]
@@ -0,0 +1,234 @@
+import collections
+import logging
+import threading
+import time
+
+from coach.Profiler import DISABLED
+
+logger = logging.getLogger(__name__)
+
+
+# An event on the bus. timestamp is when it was published, origin when the data it is about came into existence
+# (e.g. the capture time of the camera frame), both time.perf_counter() values. origin - delivery is the latency.
+Event = collections.namedtuple('Event', ['topic', 'data', 'timestamp', 'origin'])
+
+# Topics and their data:
+#   POSE   PoseFrame of every game frame, published after Think ran on it
+#   STATE  coach.Fsm.StateChange when a joint's state machine changes state
+#   REP    coach.Fsm.RepEvent for every repetition
+#   HIT    coach.Think.BalloonHit for every touched balloon (only confirmed hits)
+#   STATS  coach.Stats.RepStats for every completed repetition cycle
+POSE = 'pose'
+STATE = 'state'
+REP = 'rep'
+HIT = 'hit'
+STATS = 'stats'
+
+# A processed game frame. landmarks, angles and state are copies, subscribers may keep them.
+PoseFrame = collections.namedtuple('PoseFrame', ['elapsed_time', 'landmarks', 'angles', 'predicted', 'state',
+                                                 'popped', 'hits'])
+
+# Backpressure policies, what happens when a subscriber has max_pending events waiting:
+#   DROP_OLDEST  the oldest waiting event is dropped
+#   COALESCE     only the newest event per topic is kept (max_pending is ignored)
+#   BLOCK        the publisher waits until there is room, at most the publish timeout, then the new event is dropped
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+
+
+class Subscription:
+
+    def __init__(self, bus, name, topics, handler, policy, max_pending, threaded):
+        """
+        Events of some topics for one consumer, with their own queue. Created by EventBus.subscribe.
+        """
+        if policy not in (DROP_OLDEST, COALESCE, BLOCK):
+            raise ValueError(f"Unknown backpressure policy {policy!r}")
+        self.bus = bus
+        self.name = name
+        self.topics = tuple(topics)
+        self.handler = handler
+        self.policy = policy
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.delivered = 0
+
+        # Coalescing keeps one event per topic, the others a queue in publish order
+        self._pending = collections.OrderedDict() if policy == COALESCE else collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        if threaded:
+            self._thread = threading.Thread(target=self._run, name=f'events-{name}', daemon=True)
+            self._thread.start()
+
+    def offer(self, event, timeout=None):
+        """
+        Queues an event according to the policy. Called by EventBus.publish.
+
+        :param timeout: Seconds a BLOCK subscriber may hold up the publisher, None waits as long as needed
+        :return: False if the event was dropped
+        """
+        with self._condition:
+            if self._closed:
+                return False
+            if self.policy == COALESCE:
+                if self._pending.pop(event.topic, None) is not None:
+                    self.dropped += 1
+                self._pending[event.topic] = event
+            elif self.policy == DROP_OLDEST:
+                self._pending.append(event)
+                while len(self._pending) > self.max_pending:
+                    self._pending.popleft()
+                    self.dropped += 1
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while len(self._pending) >= self.max_pending and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.dropped += 1
+                        return False
+                    self._condition.wait(remaining)
+                self._pending.append(event)
+            self._condition.notify_all()
+        return True
+
+    def poll(self):
+        """
+        Takes all waiting events without calling the handler, for subscribers that are not threaded.
+
+        :return: List of events, oldest first
+        """
+        with self._condition:
+            events = list(self._pending.values()) if self.policy == COALESCE else list(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        now = time.perf_counter()
+        for event in events:
+            self._delivered(event, now)
+        return events
+
+    def drain(self):
+        """
+        Calls the handler for every waiting event on the calling thread.
+
+        :return: Number of events handled
+        """
+        events = self.poll()
+        for event in events:
+            self._handle(event)
+        return len(events)
+
+    def close(self, drain=True, timeout=5.0):
+        """
+        Unsubscribes. A threaded subscriber handles the events that are still waiting first, unless drain is False.
+        """
+        self.bus.unsubscribe(self)
+        with self._condition:
+            if not drain:
+                self._pending.clear()
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _next(self):
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return None
+            event = self._pending.popitem(last=False)[1] if self.policy == COALESCE else self._pending.popleft()
+            self._condition.notify_all()
+            return event
+
+    def _run(self):
+        while True:
+            event = self._next()
+            if event is None:
+                return
+            self._delivered(event, time.perf_counter())
+            self._handle(event)
+
+    def _delivered(self, event, now):
+        self.delivered += 1
+        self.bus.profiler.record(f'latency:{self.name}', now - event.origin)
+
+    def _handle(self, event):
+        try:
+            self.handler(event)
+        except Exception:
+            # A broken consumer must not take the others down
+            logger.exception("Subscriber %s failed on a %s event", self.name, event.topic)
+
+
+# Event bus: Sense and Think publish what happened, every consumer (render, speech, telemetry) subscribes with
+# its own queue and backpressure policy. Publishing never waits for a consumer unless it subscribed with BLOCK.
+class EventBus:
+
+    def __init__(self, profiler=DISABLED):
+        """
+        :param profiler: Profiler the delivery latency of every subscriber is recorded to, as 'latency:<name>'
+        """
+        self.profiler = profiler
+        # topic -> tuple of subscriptions, replaced as a whole so publish can read it without a lock
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics, handler=None, policy=DROP_OLDEST, max_pending=8, name=None, threaded=None):
+        """
+        :param topics: Topic or iterable of topics
+        :param handler: Function called with every Event
+        :param policy: DROP_OLDEST, COALESCE or BLOCK
+        :param max_pending: Events waiting at most before the policy applies
+        :param name: Name of the subscriber in the profiler and log
+        :param threaded: Call the handler on a thread of its own. When False the subscriber takes its events with
+                         poll() or drain(). By default threaded when there is a handler.
+        :return: Subscription
+        """
+        topics = (topics,) if isinstance(topics, str) else tuple(topics)
+        if threaded is None:
+            threaded = handler is not None
+        subscription = Subscription(self, name or getattr(handler, '__qualname__', 'subscriber'), topics, handler,
+                                    policy, max_pending, threaded)
+        with self._lock:
+            for topic in topics:
+                self._subscriptions[topic] = self._subscriptions.get(topic, ()) + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions[topic] = tuple(other for other in self._subscriptions.get(topic, ())
+                                                   if other is not subscription)
+
+    def has_subscribers(self, topic):
+        """
+        True if anyone listens to the topic, publishers can skip building the data otherwise.
+        """
+        return bool(self._subscriptions.get(topic))
+
+    def publish(self, topic, data=None, origin=None, timeout=None):
+        """
+        Hands an event to every subscriber of the topic.
+
+        :param data: The data of the event, it must not be changed afterwards
+        :param origin: time.perf_counter() of when the data came into existence, now if None
+        :param timeout: Seconds a BLOCK subscriber may hold up this call, None waits as long as needed
+        :return: The Event
+        """
+        now = time.perf_counter()
+        event = Event(topic, data, now, now if origin is None else origin)
+        for subscription in self._subscriptions.get(topic, ()):
+            subscription.offer(event, timeout)
+        return event
+
+    def close(self):
+        """
+        Closes every subscription, threaded ones handle their waiting events first.
+        """
+        with self._lock:
+            subscriptions = {subscription for group in self._subscriptions.values() for subscription in group}
+        for subscription in subscriptions:
+            subscription.close()
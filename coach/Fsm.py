@@ -0,0 +1,257 @@
+import collections
+from typing import Protocol
+
+import numpy as np
+
+
+# Events the FSM reacts to. The angle bands give flexed/extended/relaxed/out_of_range when a joint enters them,
+# held and timeout fire once after the joint stayed hold_time or timeout seconds in the same state.
+EVENTS = ('none', 'flexed', 'extended', 'relaxed', 'held', 'timeout', 'out_of_range')
+NONE, FLEXED, EXTENDED, RELAXED, HELD, TIMEOUT, OUT_OF_RANGE = range(len(EVENTS))
+
+# Angle bands, indexed like the events they emit when entered
+BAND_FLEXED, BAND_EXTENDED, BAND_RELAXED, BAND_INVALID = FLEXED, EXTENDED, RELAXED, OUT_OF_RANGE
+
+# An exercise as data. transitions are (source, event, dest, rep) tuples, source '*' matches every state and
+# rep names the repetition that is reported to the listeners when the transition is taken (or None).
+ExerciseSpec = collections.namedtuple('ExerciseSpec', ['states', 'initial', 'transitions', 'hold_time', 'timeout'])
+
+# A repetition of one joint, sent to every RepListener
+RepEvent = collections.namedtuple('RepEvent', ['joint', 'kind', 'source', 'dest', 'angle', 'timestamp'])
+
+# A joint's state machine changed state
+StateChange = collections.namedtuple('StateChange', ['joint', 'source', 'dest', 'timestamp'])
+
+
+class RepListener(Protocol):
+
+    def on_rep(self, event: RepEvent) -> None:
+        """
+        Called for every repetition an ExerciseFsm detects.
+        """
+
+
+# Flexion/extension as in the original state machine, plus an idle state after a timeout and an incorrect
+# state for angles outside of the valid range
+FLEXION_EXTENSION = ExerciseSpec(
+    states=('flexion', 'extension', 'idle', 'incorrect'),
+    initial='flexion',
+    transitions=(
+        ('flexion', 'extended', 'extension', 'flexion_to_extension'),
+        ('extension', 'flexed', 'flexion', 'extension_to_flexion'),
+        ('flexion', 'timeout', 'idle', None),
+        ('extension', 'timeout', 'idle', None),
+        ('idle', 'flexed', 'flexion', None),
+        ('idle', 'extended', 'extension', None),
+        ('*', 'out_of_range', 'incorrect', None),
+        ('incorrect', 'flexed', 'flexion', None),
+        ('incorrect', 'extended', 'extension', None),
+        ('incorrect', 'relaxed', 'idle', None),
+    ),
+    hold_time=None,
+    timeout=30.0
+)
+
+# Like FLEXION_EXTENSION, but the extension only counts after it was held for hold_time seconds
+HELD_EXTENSION = ExerciseSpec(
+    states=('flexion', 'extension', 'extension_held', 'idle', 'incorrect'),
+    initial='flexion',
+    transitions=(
+        ('flexion', 'extended', 'extension', None),
+        ('extension', 'held', 'extension_held', 'flexion_to_extension'),
+        ('extension', 'flexed', 'flexion', None),
+        ('extension_held', 'flexed', 'flexion', 'extension_to_flexion'),
+        ('flexion', 'timeout', 'idle', None),
+        ('extension_held', 'timeout', 'idle', None),
+        ('idle', 'flexed', 'flexion', None),
+        ('idle', 'extended', 'extension', None),
+        ('*', 'out_of_range', 'incorrect', None),
+        ('incorrect', 'flexed', 'flexion', None),
+        ('incorrect', 'extended', 'extension', None),
+        ('incorrect', 'relaxed', 'idle', None),
+    ),
+    hold_time=1.0,
+    timeout=30.0
+)
+
+
+def compile_spec(spec):
+    """
+    Compiles an ExerciseSpec into integer transition tables.
+
+    :return: (next_state, rep_kind, rep_names): next_state[state, event] is the state after the event,
+             rep_kind[state, event] the index into rep_names of the reported repetition or -1
+    """
+    states = {name: i for i, name in enumerate(spec.states)}
+    events = {name: i for i, name in enumerate(EVENTS)}
+    rep_names = []
+
+    next_state = np.tile(np.arange(len(states), dtype=np.intp)[:, None], (1, len(EVENTS)))
+    rep_kind = np.full((len(states), len(EVENTS)), -1, dtype=np.intp)
+    # Wildcards first, so transitions of a specific state override them
+    for source, event, dest, rep in sorted(spec.transitions, key=lambda transition: transition[0] != '*'):
+        sources = list(states.values()) if source == '*' else [states[source]]
+        if rep is not None and rep not in rep_names:
+            rep_names.append(rep)
+        for state in sources:
+            next_state[state, events[event]] = states[dest]
+            rep_kind[state, events[event]] = rep_names.index(rep) if rep is not None else -1
+    return next_state, rep_kind, tuple(rep_names)
+
+
+def rep_transitions(spec):
+    """
+    :return: List of (source, dest, rep) of every transition of the spec that completes a repetition,
+             with the '*' sources expanded to the states
+    """
+    return [(state, dest, rep) for source, event, dest, rep in spec.transitions if rep is not None
+            for state in (spec.states if source == '*' else (source,)) if state != dest]
+
+
+# Exercise FSM: one state machine per joint, all driven by the same compiled tables. A step evaluates every
+# joint at once, so several joints cost about as much as one.
+class ExerciseFsm:
+
+    def __init__(self, spec, joints, flexion_threshold=90, extension_threshold=120, hysteresis=5,
+                 valid_range=None):
+        """
+        :param spec: The ExerciseSpec
+        :param joints: Names of the joints, one state machine each
+        :param flexion_threshold: Angle below which a joint is flexed (scalar or one per joint)
+        :param extension_threshold: Angle above which a joint is extended (scalar or one per joint)
+        :param hysteresis: Degrees an angle has to move back over a threshold before the band is left
+        :param valid_range: Optional (min, max) angle, outside of it the movement is incorrect
+        """
+        self.spec = spec
+        self.joints = tuple(joints)
+        self.next_state, self.rep_kind, self.rep_names = compile_spec(spec)
+
+        count = len(self.joints)
+        self.flexion_threshold = np.broadcast_to(np.asarray(flexion_threshold, dtype=float), (count,))
+        self.extension_threshold = np.broadcast_to(np.asarray(extension_threshold, dtype=float), (count,))
+        self.hysteresis = hysteresis
+        self.valid_range = valid_range
+        self.hold_time = np.inf if spec.hold_time is None else spec.hold_time
+        self.timeout = np.inf if spec.timeout is None else spec.timeout
+
+        self.listeners = []
+        self.state_listeners = []
+        self.state = np.zeros(count, dtype=np.intp)
+        self.band = np.zeros(count, dtype=np.intp)
+        self.entered_at = np.zeros(count)
+        self.held_fired = np.zeros(count, dtype=bool)
+        self.timeout_fired = np.zeros(count, dtype=bool)
+        self.reset()
+
+    def reset(self, timestamp=None):
+        """
+        Puts every joint back into the initial state.
+
+        :param timestamp: Time the initial state is entered at, the first timestamp step() gets if None. The
+                          timestamps may be on any clock (e.g. time.monotonic()), only their differences count.
+        """
+        self.state[:] = self.spec.states.index(self.spec.initial)
+        self.band[:] = NONE
+        self.entered_at[:] = 0.0 if timestamp is None else timestamp
+        self._started = timestamp is not None
+        self.held_fired[:] = False
+        self.timeout_fired[:] = False
+
+    def add_listener(self, listener):
+        """
+        Registers a RepListener, its on_rep is called for every repetition.
+        """
+        self.listeners.append(listener)
+
+    def add_state_listener(self, listener):
+        """
+        Registers a function that is called with a StateChange whenever a joint changes state.
+        """
+        self.state_listeners.append(listener)
+
+    def state_name(self, joint=0):
+        """
+        :param joint: Index of the joint
+        :return: Name of the current state of the joint
+        """
+        return self.spec.states[self.state[joint]]
+
+    def step(self, angles, timestamps):
+        """
+        Feeds angle samples to the state machines.
+
+        :param angles: Array of shape (joints,) for one sample or (samples, joints) for a batch, in degrees.
+                       NaN means no measurement for that joint.
+        :param timestamps: Time in seconds of every sample (scalar or one per sample)
+        :return: List of RepEvent, in the order they happened
+        """
+        angles = np.asarray(angles, dtype=float).reshape(-1, len(self.joints))
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=float), (len(angles),))
+
+        reps = []
+        changes = []
+        for row, timestamp in zip(angles, timestamps):
+            if not self._started:
+                self.entered_at[:] = timestamp
+                self._started = True
+            band = self._bands(row)
+            event = np.where(band != self.band, band, NONE)
+            self.band = band
+
+            # Time based events fire once per visit of a state, and only when nothing else happened
+            age = timestamp - self.entered_at
+            held = (event == NONE) & ~self.held_fired & (age >= self.hold_time)
+            event[held] = HELD
+            self.held_fired |= held
+            timed_out = (event == NONE) & ~self.timeout_fired & (age >= self.timeout)
+            event[timed_out] = TIMEOUT
+            self.timeout_fired |= timed_out
+
+            next_state = self.next_state[self.state, event]
+            rep_kind = self.rep_kind[self.state, event]
+            for joint in np.flatnonzero(rep_kind >= 0):
+                reps.append(RepEvent(self.joints[joint], self.rep_names[rep_kind[joint]],
+                                     self.spec.states[self.state[joint]], self.spec.states[next_state[joint]],
+                                     float(row[joint]), float(timestamp)))
+
+            changed = next_state != self.state
+            if self.state_listeners:
+                changes += [StateChange(self.joints[joint], self.spec.states[self.state[joint]],
+                                        self.spec.states[next_state[joint]], float(timestamp))
+                            for joint in np.flatnonzero(changed)]
+            self.entered_at[changed] = timestamp
+            self.held_fired[changed] = False
+            self.timeout_fired[changed] = False
+            self.state = next_state
+
+        for change in changes:
+            for listener in self.state_listeners:
+                listener(change)
+        for rep in reps:
+            for listener in self.listeners:
+                listener.on_rep(rep)
+        return reps
+
+    def _bands(self, angles):
+        # Entering a band needs the threshold, leaving it needs the threshold plus the hysteresis
+        band = self.band.copy()
+        flexed = self.band == BAND_FLEXED
+        extended = self.band == BAND_EXTENDED
+        band[angles < np.where(flexed, self.flexion_threshold + self.hysteresis, self.flexion_threshold)] = FLEXED
+        band[angles > np.where(extended, self.extension_threshold - self.hysteresis,
+                               self.extension_threshold)] = EXTENDED
+        relaxed = ((angles >= np.where(flexed, self.flexion_threshold + self.hysteresis, self.flexion_threshold)) &
+                   (angles <= np.where(extended, self.extension_threshold - self.hysteresis,
+                                       self.extension_threshold)))
+        band[relaxed] = RELAXED
+
+        if self.valid_range is not None:
+            low, high = self.valid_range
+            invalid = self.band == BAND_INVALID
+            margin = np.where(invalid, self.hysteresis, 0)
+            band[(angles < low + margin) | (angles > high - margin)] = BAND_INVALID
+
+        # Joints without a measurement keep their band
+        missing = np.isnan(angles)
+        band[missing] = self.band[missing]
+        return band
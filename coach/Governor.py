@@ -0,0 +1,176 @@
+import collections
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# One rung of the quality ladder:
+#   model_complexity   MediaPipe pose model complexity
+#   inference_size     Longest side of the image MediaPipe sees, see Sense
+#   keyframe_interval  Frames per MediaPipe run, the others are predicted, see Sense
+#   skeleton           'full', 'bones' or 'off', see Renderer.skeleton_detail
+#   hud_stages         The profiling HUD lists every stage, otherwise only the FPS
+#   sprite_size        Size the balloons are drawn at, their hit area does not change
+QualityLevel = collections.namedtuple('QualityLevel', ['name', 'model_complexity', 'inference_size',
+                                                       'keyframe_interval', 'skeleton', 'hud_stages',
+                                                       'sprite_size'])
+
+# From the best quality to the cheapest. The first level are the defaults of main.py, every step saves work
+# where it is cheapest to lose it first.
+LEVELS = (
+    QualityLevel('high', 1, 640, 3, 'full', True, 100),
+    QualityLevel('medium', 1, 480, 4, 'full', True, 100),
+    QualityLevel('low', 0, 384, 4, 'bones', False, 80),
+    QualityLevel('minimal', 0, 256, 5, 'off', False, 64),
+)
+
+# A level change, kept in QualityGovernor.changes
+LevelChange = collections.namedtuple('LevelChange', ['timestamp', 'source', 'dest', 'fps'])
+
+
+def apply_level(level, sense=None, act=None, profiler=None):
+    """
+    Applies a quality level to the components. Safe while the pipeline runs: Sense reads its settings once per
+    frame, a new model complexity is built on a background thread before it replaces the old model.
+
+    :param level: QualityLevel
+    :param sense: Sense whose inference is adjusted, None if it runs elsewhere (e.g. a station worker)
+    :param act: Act whose skeleton and sprites are adjusted
+    :param profiler: Profiler whose HUD is adjusted
+    """
+    if sense is not None:
+        sense.inference_size = level.inference_size
+        sense.keyframe_interval = level.keyframe_interval
+        sense.set_model_complexity(level.model_complexity)
+    if act is not None:
+        act.renderer.show_skeleton = level.skeleton != 'off'
+        act.renderer.skeleton_detail = level.skeleton
+        act.set_sprite_size(level.sprite_size)
+    if profiler is not None:
+        profiler.hud_stages = level.hud_stages
+
+
+# Quality governor: watches the frame rate and steps through the quality levels to hold a target FPS.
+# A level is dropped after the frame rate stayed below the target for a while, and raised again only after it
+# held the target for much longer. An upgrade that does not last makes the next one wait twice as long, so the
+# governor does not flap between two levels on a machine that can only just run the better one.
+class QualityGovernor:
+
+    def __init__(self, target_fps=25.0, levels=LEVELS, level=0, apply=None, window=30, tolerance=0.1,
+                 downgrade_after=2.0, upgrade_after=8.0, max_upgrade_after=120.0):
+        """
+        :param target_fps: Frame rate to hold, below what the camera delivers
+        :param levels: QualityLevels from the best to the cheapest
+        :param level: Index of the level to start at
+        :param apply: Function called with the QualityLevel on every change (and once with the initial level),
+                      e.g. functools.partial(apply_level, sense=sense, act=act, profiler=profiler)
+        :param window: Number of frames the frame rate is measured over
+        :param tolerance: The frame rate may fall this fraction below the target before the level is dropped,
+                          an upgrade needs the target within half of it
+        :param downgrade_after: Seconds below the target before a level is dropped
+        :param upgrade_after: Seconds at the target before a level is raised
+        :param max_upgrade_after: Upper limit of the wait before an upgrade, which doubles after a failed one
+        """
+        self.target_fps = target_fps
+        self.levels = tuple(levels)
+        self.level = level
+        self.apply = apply
+        self.tolerance = tolerance
+        self.downgrade_after = downgrade_after
+        self.upgrade_after = upgrade_after
+        self.max_upgrade_after = max_upgrade_after
+        self.changes = []
+
+        # Times of the last frames, the frame rate is measured from the oldest to the newest
+        self._frame_times = np.zeros(window)
+        self._frames = 0
+        self._slow_since = None
+        self._fast_since = None
+        self._upgrade_wait = upgrade_after
+        self._upgraded_at = None
+
+        if self.apply is not None:
+            self.apply(self.current)
+
+    @property
+    def current(self):
+        """
+        The QualityLevel in use.
+        """
+        return self.levels[self.level]
+
+    @property
+    def fps(self):
+        """
+        Frame rate over the measurement window, 0 until the window is full.
+        """
+        window = len(self._frame_times)
+        if self._frames < window:
+            return 0.0
+        newest = self._frame_times[(self._frames - 1) % window]
+        oldest = self._frame_times[self._frames % window]
+        return (window - 1) / (newest - oldest) if newest > oldest else 0.0
+
+    def frame(self, now=None):
+        """
+        Called once per shown frame. Changes the level when the frame rate asks for it.
+
+        :param now: time.perf_counter() of the frame
+        :return: The new QualityLevel if the level changed, None otherwise
+        """
+        now = time.perf_counter() if now is None else now
+        self._frame_times[self._frames % len(self._frame_times)] = now
+        self._frames += 1
+        fps = self.fps
+        if fps == 0.0:
+            return None
+
+        slow = fps < self.target_fps * (1 - self.tolerance)
+        fast = fps >= self.target_fps * (1 - self.tolerance / 2)
+        if not slow:
+            self._slow_since = None
+        elif self._slow_since is None:
+            self._slow_since = now
+        if not fast:
+            self._fast_since = None
+        elif self._fast_since is None:
+            self._fast_since = now
+
+        if slow and now - self._slow_since >= self.downgrade_after and self.level < len(self.levels) - 1:
+            # An upgrade that could not hold its frame rate makes the next one wait longer
+            if self._upgraded_at is not None and now - self._upgraded_at < self._upgrade_wait:
+                self._upgrade_wait = min(2 * self._upgrade_wait, self.max_upgrade_after)
+            self._upgraded_at = None
+            return self._change(self.level + 1, now, fps)
+        if fast and now - self._fast_since >= self._upgrade_wait and self.level > 0:
+            self._upgraded_at = now
+            return self._change(self.level - 1, now, fps)
+        if self._upgraded_at is not None and now - self._upgraded_at >= self._upgrade_wait:
+            # The upgrade lasted, the next one may come sooner again
+            self._upgraded_at = None
+            self._upgrade_wait = self.upgrade_after
+        return None
+
+    def pause(self):
+        """
+        Called for frames that are not part of the game (nobody in view, the end screen). The frame rate is
+        measured anew from the next frame, the gap would look like a slow machine.
+        """
+        self._frames = 0
+        self._slow_since = None
+        self._fast_since = None
+
+    def _change(self, level, now, fps):
+        source = self.current
+        self.level = level
+        self.changes.append(LevelChange(now, source.name, self.current.name, fps))
+        logger.info("Quality %s -> %s at %.1f fps (target %.1f)", source.name, self.current.name, fps,
+                    self.target_fps)
+        # The frames of the old level do not tell anything about the new one
+        self.pause()
+        if self.apply is not None:
+            self.apply(self.current)
+        return self.current
@@ -0,0 +1,120 @@
+import collections
+import queue
+import threading
+import time
+
+import cv2
+
+from coach.Profiler import DISABLED
+
+
+# One captured frame on its way through the pipeline, with the timestamps of the stages it passed
+Packet = collections.namedtuple('Packet', ['frame', 'results', 'captured_at', 'inferred_at'])
+
+
+# Pipeline: runs capture and pose inference on their own threads so the render loop never waits for the
+# camera or for MediaPipe. Stages are connected by bounded queues that drop the oldest frame when full.
+class Pipeline:
+
+    def __init__(self, capture, infer, flip=True, queue_size=1, profiler=DISABLED):
+        """
+        Sets up the stages, nothing runs until start() is called.
+
+        :param capture: A cv2.VideoCapture (or anything with read()/isOpened()) frames are taken from
+        :param infer: Function that is called with a frame and returns the pose results
+        :param flip: Mirror the frames horizontally right after capture
+        :param queue_size: Number of frames each queue holds before the oldest one is dropped
+        :param profiler: Profiler the capture and inference latencies and dropped frames are reported to
+        """
+        self.capture = capture
+        self.infer = infer
+        self.flip = flip
+
+        self.captured = queue.Queue(maxsize=queue_size)
+        self.inferred = queue.Queue(maxsize=queue_size)
+
+        # Inference can be switched off while no landmarks are needed (tutorial and end screen)
+        self.inference_enabled = threading.Event()
+        self.inference_enabled.set()
+
+        self.profiler = profiler
+        self.dropped_frames = 0
+        self.failed = False
+
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._capture_loop, name='capture', daemon=True),
+                         threading.Thread(target=self._inference_loop, name='inference', daemon=True)]
+
+    @property
+    def running(self):
+        return not self._stop.is_set()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops both worker threads and waits for them to finish.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout=1)
+
+    def get(self, timeout=1.0):
+        """
+        Returns the next packet for the render stage.
+
+        :param timeout: Seconds to wait for a packet
+        :return: Packet, or None if the camera failed or the pipeline was stopped
+        """
+        while self.running or not self.inferred.empty():
+            try:
+                return self.inferred.get(timeout=timeout)
+            except queue.Empty:
+                if self.failed:
+                    return None
+        return None
+
+    def _put_latest(self, target, item):
+        # Replace the oldest entry instead of blocking, the render stage only cares about the newest frame
+        while True:
+            try:
+                target.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    target.get_nowait()
+                    self.dropped_frames += 1
+                    self.profiler.drop()
+                except queue.Empty:
+                    pass
+
+    def _capture_loop(self):
+        while self.running and self.capture.isOpened():
+            start = time.perf_counter()
+            ret, frame = self.capture.read()
+            if not ret:
+                self.failed = True
+                break
+            if self.flip:
+                frame = cv2.flip(frame, 1)
+            captured_at = time.perf_counter()
+            self.profiler.record('capture', captured_at - start)
+            self._put_latest(self.captured, (frame, captured_at))
+        self._stop.set()
+
+    def _inference_loop(self):
+        while self.running:
+            try:
+                frame, captured_at = self.captured.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            results = None
+            if self.inference_enabled.is_set():
+                start = time.perf_counter()
+                results = self.infer(frame)
+                self.profiler.record('detect_joints', time.perf_counter() - start)
+            self._put_latest(self.inferred, Packet(frame, results, captured_at, time.perf_counter()))
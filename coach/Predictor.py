@@ -0,0 +1,71 @@
+import numpy as np
+
+
+# Landmark predictor: a constant-velocity alpha-beta filter (a steady-state Kalman filter) over the whole
+# landmark array. Used to fill in the frames between two pose inferences.
+class LandmarkPredictor:
+
+    def __init__(self, num_landmarks=33, alpha=0.85, beta=0.3):
+        """
+        :param num_landmarks: Number of rows in the landmark array
+        :param alpha: How much of the measurement residual goes into the position (0-1)
+        :param beta: How much of the measurement residual goes into the velocity (0-1)
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.position = np.zeros((num_landmarks, 3))
+        self.velocity = np.zeros((num_landmarks, 3))
+        self.visibility = np.zeros(num_landmarks)
+        self.timestamp = None
+
+    @property
+    def ready(self):
+        return self.timestamp is not None
+
+    def reset(self):
+        """
+        Forgets the tracked pose, e.g. when the person left the frame.
+        """
+        self.velocity[:] = 0
+        self.timestamp = None
+
+    def correct(self, observed, timestamp):
+        """
+        Updates the filter with measured landmarks.
+
+        :param observed: Landmark array of shape (33, 4) with x, y, z and visibility
+        :param timestamp: Time of the measurement in seconds
+        """
+        if not self.ready:
+            self.position[:] = observed[:, :3]
+            self.velocity[:] = 0
+        else:
+            dt = max(timestamp - self.timestamp, 1e-3)
+            residual = observed[:, :3] - (self.position + self.velocity * dt)
+            self.position += self.velocity * dt + self.alpha * residual
+            self.velocity += (self.beta / dt) * residual
+        self.visibility[:] = observed[:, 3]
+        self.timestamp = timestamp
+
+    def predict(self, timestamp, out):
+        """
+        Extrapolates the landmarks to the given time. The filter state is not changed.
+
+        :param timestamp: Time in seconds to predict for
+        :param out: Landmark array of shape (33, 4) the prediction is written to
+        :return: out
+        """
+        np.multiply(self.velocity, timestamp - self.timestamp, out=out[:, :3])
+        out[:, :3] += self.position
+        out[:, 3] = self.visibility
+        return out
+
+    def speed(self, min_visibility=0.5):
+        """
+        :param min_visibility: Landmarks with a lower visibility are ignored
+        :return: Fastest image-plane speed of a visible landmark in normalized units per second
+        """
+        visible = self.visibility >= min_visibility
+        if not visible.any():
+            return 0.0
+        return float(np.sqrt((self.velocity[visible, :2] ** 2).sum(axis=1)).max())
@@ -0,0 +1,210 @@
+import csv
+import json
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class _StageTimer:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Samples:
+
+    def __init__(self, window):
+        # Rolling window for the percentiles plus running totals over the whole session
+        self.window = np.zeros(window)
+        self.position = 0
+        self.filled = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.window[self.position] = seconds
+        self.position = (self.position + 1) % len(self.window)
+        self.filled = min(self.filled + 1, len(self.window))
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+# Profiler: low-overhead timers around the stages of the coaching loop, with rolling p50/p95/p99 per stage,
+# FPS and dropped-frame counters, an optional on-screen HUD and an export at the end of a session.
+class Profiler:
+
+    def __init__(self, enabled=True, window=300):
+        """
+        :param enabled: When False every call returns immediately, so the timers can stay in the code
+        :param window: Number of samples per stage the percentiles are computed over
+        """
+        self.enabled = enabled
+        self.window = window
+        self.show_hud = False
+        # The HUD lists every stage, False shows only the FPS line
+        self.hud_stages = True
+        self.samples = {}
+        # record() and drop() are called from other threads (e.g. Sense's worker), the readers take copies
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.dropped_frames = 0
+        self._timers = {}
+        self._frame_times = np.zeros(window)
+        self._session_start = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Context manager that times a stage:
+
+            with profiler.stage('detect_joints'):
+                joints = sense.detect_joints(frame)
+
+        :param name: Name of the stage
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = _StageTimer(self, name)
+        return timer
+
+    def record(self, name, seconds):
+        """
+        Adds a duration measured elsewhere (e.g. on another thread) to a stage.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = _Samples(self.window)
+            samples.add(seconds)
+
+    def frame(self):
+        """
+        Marks that a frame was shown, used for the FPS.
+        """
+        if not self.enabled:
+            return
+        self._frame_times[self.frames % self.window] = time.perf_counter()
+        self.frames += 1
+
+    def drop(self, count=1):
+        """
+        Counts frames that were captured but never shown.
+        """
+        if self.enabled:
+            with self._lock:
+                self.dropped_frames += count
+
+    @property
+    def fps(self):
+        """
+        Frame rate over the rolling window.
+        """
+        filled = min(self.frames, self.window)
+        if filled < 2:
+            return 0.0
+        newest = self._frame_times[(self.frames - 1) % self.window]
+        oldest = self._frame_times[(self.frames - filled) % self.window]
+        return (filled - 1) / (newest - oldest) if newest > oldest else 0.0
+
+    def percentiles(self, name):
+        """
+        :param name: Name of the stage
+        :return: (p50, p95, p99) of the rolling window in milliseconds
+        """
+        with self._lock:
+            samples = self.samples.get(name)
+            window = samples.window[:samples.filled].copy() if samples is not None else None
+        return self._percentiles(window)
+
+    @staticmethod
+    def _percentiles(window):
+        if window is None or len(window) == 0:
+            return 0.0, 0.0, 0.0
+        p50, p95, p99 = np.percentile(window, (50, 95, 99))
+        return 1000 * p50, 1000 * p95, 1000 * p99
+
+    def _snapshot(self):
+        # (name, count, total, max, window) per stage, copied under the lock so record() can go on meanwhile
+        with self._lock:
+            return [(name, samples.count, samples.total, samples.max, samples.window[:samples.filled].copy())
+                    for name, samples in list(self.samples.items())]
+
+    def summary(self):
+        """
+        :return: List with one dictionary per stage (count, mean, percentiles and max in milliseconds)
+        """
+        rows = []
+        for name, count, total, maximum, window in self._snapshot():
+            p50, p95, p99 = self._percentiles(window)
+            rows.append({'stage': name, 'count': count, 'mean_ms': 1000 * total / count,
+                         'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': 1000 * maximum})
+        return rows
+
+    def draw_hud(self, frame, origin=(10, 20)):
+        """
+        Draws the FPS and the p50/p95 of every stage in the top left corner of the frame, if the HUD is on.
+        """
+        if not (self.enabled and self.show_hud):
+            return
+        x, y = origin
+        lines = [f"FPS {self.fps:.1f}  dropped {self.dropped_frames}"]
+        if self.hud_stages:
+            lines += [f"{name}: {p50:.1f} / {p95:.1f} ms" for name, p50, p95, _ in
+                      ((name, *self._percentiles(window)) for name, _, _, _, window in self._snapshot())]
+        for line in lines:
+            cv2.putText(frame, line, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 0), 1, cv2.LINE_AA)
+            y += 16
+
+    def export(self, path):
+        """
+        Writes the summary of the session to a .csv file, or to JSON lines for any other extension.
+        The last row/line holds the session totals (frames, dropped frames, duration, fps).
+        """
+        duration = time.perf_counter() - self._session_start
+        session = {'stage': 'session', 'count': self.frames, 'dropped_frames': self.dropped_frames,
+                   'duration_s': duration, 'fps': self.frames / duration if duration > 0 else 0.0}
+        rows = self.summary() + [session]
+        with open(path, 'w', newline='') as file:
+            if path.endswith('.csv'):
+                fields = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+                          'dropped_frames', 'duration_s', 'fps']
+                writer = csv.DictWriter(file, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    file.write(json.dumps(row) + '\n')
+
+
+# Shared profiler for code paths that are not given one
+DISABLED = Profiler(enabled=False, window=1)
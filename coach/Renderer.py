@@ -0,0 +1,156 @@
+import cv2
+import numpy as np
+
+from coach.Compositor import Compositor
+
+
+# mediapipe.solutions.pose.POSE_CONNECTIONS as an index array, so the skeleton can be drawn from the
+# landmark array without going through the protobuf
+POSE_CONNECTIONS = np.array([
+    (0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5), (5, 6), (6, 8), (9, 10),
+    (11, 12), (11, 13), (13, 15), (15, 17), (15, 19), (15, 21), (17, 19),
+    (12, 14), (14, 16), (16, 18), (16, 20), (16, 22), (18, 20),
+    (11, 23), (12, 24), (23, 24), (23, 25), (24, 26), (25, 27), (26, 28),
+    (27, 29), (28, 30), (29, 31), (30, 32), (27, 31), (28, 32)
+], dtype=np.intp)
+
+
+class TextLayer:
+
+    def __init__(self, text, font, scale, color, thickness):
+        """
+        A string rasterized once into a small patch and a mask, blitted into every frame it is shown on.
+        """
+        self.text = text
+        # Everything the patch depends on besides the font, see Renderer.text
+        self.params = (text, scale, tuple(color), thickness)
+        (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+        self.ascent = height + thickness
+        # The text starts this far into the patch, so the strokes are not cut off at the left
+        self.indent = thickness
+        self.patch = np.zeros((height + baseline + 2 * thickness, width + 2 * thickness, 3), dtype=np.uint8)
+        cv2.putText(self.patch, text, (thickness, self.ascent), font, scale, color, thickness)
+        # Pixels touched by the text, the patch itself has a black background
+        self.mask = cv2.putText(np.zeros(self.patch.shape[:2], dtype=np.uint8), text, (thickness, self.ascent),
+                                font, scale, 255, thickness).astype(bool)[:, :, None]
+
+    def blit(self, frame, org):
+        """
+        Copies the text into the frame, org is the bottom left corner of the text like in cv2.putText.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        x, y = org[0] - self.indent, org[1] - self.ascent
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + self.patch.shape[1], frame_width), min(y + self.patch.shape[0], frame_height)
+        if x1 >= x2 or y1 >= y2:
+            return
+        patch = (slice(y1 - y, y2 - y), slice(x1 - x, x2 - x))
+        np.copyto(frame[y1:y2, x1:x2], self.patch[patch], where=self.mask[patch])
+
+
+class PlainText:
+
+    def __init__(self, text, font, scale, color, thickness):
+        """
+        A string drawn with cv2.putText on every frame, for text that changes on (nearly) every frame and would
+        be rasterized into a new TextLayer each time.
+        """
+        self.text = text
+        self.font = font
+        self.scale = scale
+        self.color = color
+        self.thickness = thickness
+
+    def blit(self, frame, org):
+        cv2.putText(frame, self.text, org, self.font, self.scale, self.color, self.thickness)
+
+
+# Renderer: collects everything drawn on top of the camera frame (balloons, skeleton, text) and composes it
+# in one pass with flush(). Text is only rasterized again when its string or style changes.
+class Renderer:
+
+    def __init__(self, compositor=None, font=cv2.FONT_HERSHEY_SIMPLEX, min_visibility=0.5):
+        """
+        :param compositor: Compositor used for the sprites, a new one if None
+        :param font: Font of the text layers
+        :param min_visibility: Landmarks with a lower visibility are left out of the skeleton
+        """
+        self.compositor = compositor or Compositor()
+        self.font = font
+        self.min_visibility = min_visibility
+        self.show_skeleton = True
+        # 'full' draws bones and joints, 'bones' only the bones (one draw call less)
+        self.skeleton_detail = 'full'
+
+        self._text_layers = {}
+        self._sprites = []
+        self._texts = []
+        self._landmarks = None
+
+    def sprite(self, sprite, pos):
+        """
+        Queues a premultiplied sprite at (x, y).
+        """
+        self._sprites.append((sprite, pos))
+
+    def text(self, key, text, org, scale=0.9, color=(255, 255, 255), thickness=2, cached=True):
+        """
+        Queues a line of text. The rasterized text is kept per key and reused while the string and its style
+        stay the same.
+
+        :param key: Name of the text slot (e.g. 'distance')
+        :param text: The string to show, empty strings are skipped
+        :param org: Bottom left corner of the text like in cv2.putText
+        :param cached: False for strings that change on every frame (e.g. a clock), they are drawn directly
+        """
+        if not text:
+            return
+        if not cached:
+            self._text_layers.pop(key, None)
+            self._texts.append((PlainText(text, self.font, scale, color, thickness), org))
+            return
+        layer = self._text_layers.get(key)
+        if layer is None or layer.params != (text, scale, tuple(color), thickness):
+            layer = self._text_layers[key] = TextLayer(text, self.font, scale, color, thickness)
+        self._texts.append((layer, org))
+
+    def skeleton(self, landmarks):
+        """
+        Queues the skeleton of a landmark array of shape (33, 4).
+        """
+        self._landmarks = landmarks
+
+    def flush(self, frame):
+        """
+        Draws everything that was queued onto the frame (sprites, then skeleton, then text) and clears the queue.
+        """
+        self.compositor.blend_many(frame, self._sprites)
+        if self._landmarks is not None and self.show_skeleton:
+            self.draw_skeleton(frame, self._landmarks)
+        for layer, org in self._texts:
+            layer.blit(frame, org)
+
+        self._sprites.clear()
+        self._texts.clear()
+        self._landmarks = None
+
+    def draw_skeleton(self, frame, landmarks, joint_color=(0, 0, 255), bone_color=(255, 255, 255)):
+        """
+        Draws all bones with one cv2.polylines call and all joints with another.
+
+        :param frame: The frame to draw on
+        :param landmarks: Landmark array of shape (33, 4) with normalized x, y, z and visibility
+        """
+        frame_height, frame_width = frame.shape[:2]
+        points = np.rint(landmarks[:, :2] * (frame_width, frame_height)).astype(np.int32)
+        visible = landmarks[:, 3] >= self.min_visibility
+
+        bones = POSE_CONNECTIONS[visible[POSE_CONNECTIONS].all(axis=1)]
+        if len(bones):
+            cv2.polylines(frame, points[bones], False, bone_color, 2)
+        # A zero-length segment with a thick line is a filled dot
+        if self.skeleton_detail == 'bones':
+            return
+        joints = points[visible][:, None, :].repeat(2, axis=1)
+        if len(joints):
+            cv2.polylines(frame, joints, False, joint_color, 4)
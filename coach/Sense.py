@@ -1,28 +1,373 @@
+import collections
+import threading
+import time
+
 import cv2
-import mediapipe as mp
 import math
 import numpy as np
 
+from coach.Predictor import LandmarkPredictor
+
+
+# Number of landmarks in a MediaPipe pose and the columns stored per landmark in the landmark array
+NUM_LANDMARKS = 33
+LANDMARK_COLUMNS = ('x', 'y', 'z', 'visibility')
+
+# Result of detect_joints. landmarks is the pose as a (33, 4) array and predicted is True when it was
+# extrapolated instead of detected. pose_landmarks is the MediaPipe protobuf of the last detection, as MediaPipe
+# returned it: normalized to the region of interest the detection ran on, not to the frame like landmarks.
+PoseResults = collections.namedtuple('PoseResults', ['pose_landmarks', 'landmarks', 'predicted'])
+
+# Joint name to MediaPipe landmark index. The frame is mirrored, so MediaPipe's LEFT side is the user's right.
+JOINT_INDEX = {
+    'right_shoulder': 11,  # PoseLandmark.LEFT_SHOULDER
+    'left_shoulder': 12,  # PoseLandmark.RIGHT_SHOULDER
+    'right_elbow': 13,  # PoseLandmark.LEFT_ELBOW
+    'left_elbow': 14,  # PoseLandmark.RIGHT_ELBOW
+    'right_wrist': 15,  # PoseLandmark.LEFT_WRIST
+    'left_wrist': 16,  # PoseLandmark.RIGHT_WRIST
+    'right_hip': 23,  # PoseLandmark.LEFT_HIP
+    'left_hip': 24,  # PoseLandmark.RIGHT_HIP
+    'right_knee': 25,  # PoseLandmark.LEFT_KNEE
+    'left_knee': 26,  # PoseLandmark.RIGHT_KNEE
+    'right_ankle': 27,  # PoseLandmark.LEFT_ANKLE
+    'left_ankle': 28  # PoseLandmark.RIGHT_ANKLE
+}
+
+# Joint triples (first, middle, last) of every angle the AngleEngine tracks, as MediaPipe landmark indices.
+# Names follow JOINT_INDEX.
+ANGLE_TRIPLES = {
+    'right_elbow': (11, 13, 15),
+    'left_elbow': (12, 14, 16),
+    'right_shoulder': (23, 11, 13),
+    'left_shoulder': (24, 12, 14),
+    'right_hip': (11, 23, 25),
+    'left_hip': (12, 24, 26),
+    'right_knee': (23, 25, 27),
+    'left_knee': (24, 26, 28)
+}
+
+
+class RunningMean:
+
+    def __init__(self, size, width=1):
+        """
+        Fixed-size ring buffer with an O(1) running mean over each of its columns.
+
+        :param size: Number of samples the mean is taken over
+        :param width: Number of values pushed at once (one per tracked angle)
+        """
+        self.buffer = np.zeros((size, width))
+        self.total = np.zeros(width)
+        self.position = 0
+        self.count = 0
+
+    def push(self, values):
+        """
+        Adds one sample per column, replacing the oldest one.
+
+        :param values: Array (or scalar for width 1) with the new samples
+        :return: Array with the mean of every column
+        """
+        self.total += values - self.buffer[self.position]
+        self.buffer[self.position] = values
+        self.position = (self.position + 1) % len(self.buffer)
+        if self.position == 0:
+            # Recompute the sums once per lap so floating point drift cannot build up
+            self.total = self.buffer.sum(axis=0)
+        self.count = min(self.count + 1, len(self.buffer))
+        return self.total / self.count
+
+
+class AngleEngine:
+
+    def __init__(self, triples=ANGLE_TRIPLES, window_size=10):
+        """
+        Computes all configured joint angles of a frame in one vectorized step and smooths each of them
+        with its own moving average.
+
+        :param triples: Dictionary of angle name to (first, middle, last) landmark index
+        :param window_size: Number of frames in the moving average
+        """
+        self.names = list(triples)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.triples = np.array([triples[name] for name in self.names], dtype=np.intp)
+        self.window = RunningMean(window_size, len(self.names))
+        self.raw = np.zeros(len(self.names))
+
+    def compute(self, points):
+        """
+        Calculates the unsmoothed angles of all triples, of one frame or of a whole recording at once.
+
+        :param points: Landmark array of shape (33, 2 or more), x and y in the first two columns, or a batch
+                       of them with shape (frames, 33, 2 or more)
+        :return: Array with one angle in radians per triple, shape (triples,) or (frames, triples)
+        """
+        first = points[..., self.triples[:, 0], :2]
+        middle = points[..., self.triples[:, 1], :2]
+        last = points[..., self.triples[:, 2], :2]
+        vector1 = first - middle
+        vector2 = last - middle
+
+        dot_product = np.einsum('...ij,...ij->...i', vector1, vector2)
+        magnitudes = np.linalg.norm(vector1, axis=-1) * np.linalg.norm(vector2, axis=-1)
+        return np.arccos(np.clip(dot_product / np.maximum(magnitudes, 1e-12), -1.0, 1.0))
+
+    def update(self, points):
+        """
+        Calculates all angles of a new frame and adds them to their moving averages.
+
+        :param points: Landmark array of shape (33, 2 or more), x and y in the first two columns
+        :return: Array with the moving average of every angle in degrees, in the order of self.names
+        """
+        self.raw = self.compute(points)
+        return np.degrees(self.window.push(self.raw))
+
 
 # Sense Component: Detect joints using the camera
 # Things you need to improve: Make the skeleton tracking smoother and robust to errors.
 class Sense:
 
-    def __init__(self):
-        # Initialize the Mediapipe Pose object to track joints
+    def __init__(self, inference_size=640, use_roi=True, roi_padding=0.25, model_complexity=1,
+                 keyframe_interval=1, inference_budget=None, fast_motion=1.5):
+        """
+        :param inference_size: Longest side in pixels of the image passed to MediaPipe, bigger frames are
+                               downsampled. None runs inference at the camera resolution.
+        :param use_roi: Crop the frame to the region around the landmarks of the previous frame
+        :param roi_padding: Padding around the landmarks of the previous frame, as a fraction of their extent
+        :param model_complexity: MediaPipe pose model complexity (0, 1 or 2)
+        :param keyframe_interval: Run MediaPipe at most every this many frames and predict the frames in between.
+                                  The interval shrinks towards 1 when the limbs move fast. 1 disables prediction.
+        :param inference_budget: Optional fraction of the time (0-1) inference may take, an extra keyframe is run
+                                 whenever the last inference fits into the budget
+        :param fast_motion: Landmark speed (frame widths per second) from which every frame is a keyframe
+        """
+        # The Mediapipe Pose object to track joints is created on first use (or by load()), importing mediapipe
+        # and building the pose graph takes seconds
+        self.model_complexity = model_complexity
+        self._requested_complexity = model_complexity
+        self._mp_pose = None
+        self._load_lock = threading.Lock()
+        # Pose objects replaced by set_model_complexity, closed by the next detect_joints
+        self._retired_poses = []
+
+        self.inference_size = inference_size
+        self.use_roi = use_roi
+        self.roi_padding = roi_padding
+        # Region (x1, y1, x2, y2) in pixels the next inference is cropped to, None for the full frame
+        self.roi = None
 
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.mp_pose = mp.solutions.pose.Pose()
+        # Frame skipping: landmarks between keyframes come from the predictor
+        self.keyframe_interval = keyframe_interval
+        self.inference_budget = inference_budget
+        self.fast_motion = fast_motion
+        self.predictor = LandmarkPredictor(NUM_LANDMARKS)
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = False
+        self._last_pose_landmarks = None
+        self._last_keyframe_time = 0.0
+        self._last_inference_duration = 0.0
 
-        # used later for having a moving avergage
-        self.angle_window = [-1, -1, -1, -1, -1, -1, -1, -1, -1, -1]
+        # used later for having a moving avergage, every angle gets its own window
+        self.angle_windows = {}
+        self.angle_engine = AngleEngine()
         self.previous_angle = -1
 
+        # The most recent landmark array. Every result gets an array of its own: the pipeline may run any number
+        # of detections while the main thread still renders an older result.
+        self.landmarks = np.zeros((NUM_LANDMARKS, len(LANDMARK_COLUMNS)), dtype=np.float32)
+
+        # Landmarks extract_angles was last called with, so asking for several angles pushes each frame once
+        self._angles_points = np.full_like(self.landmarks, np.nan)
+        self._angles = None
+
+    @property
+    def mp_pose(self):
+        """
+        The MediaPipe Pose object, loaded on first access.
+        """
+        return self._mp_pose or self.load()
+
+    def load(self):
+        """
+        Imports mediapipe and builds the pose graph, if that did not happen yet. Safe to call from a background
+        thread while the main thread already shows something.
+
+        :return: The MediaPipe Pose object
+        """
+        with self._load_lock:
+            if self._mp_pose is None:
+                import mediapipe as mp
+                self._mp_pose = mp.solutions.pose.Pose(model_complexity=self.model_complexity)
+        return self._mp_pose
+
+    def set_model_complexity(self, model_complexity):
+        """
+        Switches to another model complexity. A loaded model keeps running until the new one is built and warmed
+        up on a background thread, so inference never stalls for the seconds that takes.
+
+        :param model_complexity: MediaPipe pose model complexity (0, 1 or 2)
+        :return: The thread building the new model, None if nothing had to be built
+        """
+        with self._load_lock:
+            if model_complexity == self._requested_complexity:
+                return None
+            self._requested_complexity = model_complexity
+            if self._mp_pose is None:
+                self.model_complexity = model_complexity
+                return None
+        thread = threading.Thread(target=self._swap_model, args=(model_complexity,), name='model-swap', daemon=True)
+        thread.start()
+        return thread
+
+    def _swap_model(self, model_complexity):
+        import mediapipe as mp
+        pose = mp.solutions.pose.Pose(model_complexity=model_complexity)
+        pose.process(np.zeros((256, 256, 3), dtype=np.uint8))
+        with self._load_lock:
+            if self._requested_complexity != model_complexity:
+                # Another switch was asked for while this model was built, it was never used
+                pose.close()
+                return
+            self._retired_poses.append(self._mp_pose)
+            self._mp_pose = pose
+            self.model_complexity = model_complexity
+
+    def warmup(self, frame_shape=(480, 640, 3)):
+        """
+        Loads the model and runs one inference on a blank frame, so the first real frame does not pay for
+        the model initialization. A blank frame has no pose, so the tracking state stays empty.
+
+        :param frame_shape: Shape of the camera frames
+        """
+        frame = np.zeros(frame_shape, dtype=np.uint8)
+        self._process_region(frame, (0, 0, frame_shape[1], frame_shape[0]))
+
     def detect_joints(self, frame):
-        results = self.mp_pose.process(frame)
-        return results if results else None
+        """
+        Detects the pose in the frame. On keyframes MediaPipe runs, in between the landmarks are predicted
+        from the previous keyframes.
+
+        :param frame: BGR camera frame
+        :return: PoseResults, pose_landmarks is None when nobody was detected
+        """
+        if self._retired_poses:
+            self._close_retired_poses()
+
+        now = time.perf_counter()
+        if not self._is_keyframe(now):
+            self.frames_since_keyframe += 1
+            return self._predicted_results(now)
+
+        results, landmarks = self._infer(frame)
+        self._last_inference_duration = time.perf_counter() - now
+        self._last_keyframe_time = now
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = False
+
+        if landmarks is None:
+            self.predictor.reset()
+            self._last_pose_landmarks = None
+            return PoseResults(None, None, False)
+
+        self.predictor.correct(landmarks, now)
+        self._last_pose_landmarks = results.pose_landmarks
+        return PoseResults(results.pose_landmarks, landmarks, False)
+
+    def _close_retired_poses(self):
+        # Runs on the thread that calls detect_joints, so the old models are certainly not in use anymore
+        with self._load_lock:
+            retired, self._retired_poses = self._retired_poses, []
+        for pose in retired:
+            pose.close()
+
+    def request_keyframe(self):
+        """
+        Makes the next call of detect_joints run MediaPipe, e.g. to confirm a hit seen on predicted landmarks.
+        """
+        self.keyframe_requested = True
+
+    def _is_keyframe(self, now):
+        if self.keyframe_requested or not self.predictor.ready:
+            return True
+
+        # Shorten the interval the faster the limbs move, down to every frame at fast_motion
+        slowness = max(0.0, 1.0 - self.predictor.speed() / self.fast_motion)
+        interval = max(1, round(1 + (self.keyframe_interval - 1) * slowness))
+        if self.frames_since_keyframe + 1 >= interval:
+            return True
+
+        # Run an extra keyframe whenever the time since the last one leaves room in the budget
+        return (self.inference_budget is not None and
+                (now - self._last_keyframe_time) * self.inference_budget >= self._last_inference_duration)
+
+    def _predicted_results(self, now):
+        landmarks = self.predictor.predict(now, np.empty_like(self.landmarks))
+        self.landmarks = landmarks
+        return PoseResults(self._last_pose_landmarks, landmarks, True)
+
+    def _infer(self, frame):
+        # MediaPipe on the frame, cropped to the region of interest and downsampled to the inference size.
+        # The landmark array is mapped back to normalized coordinates of the full frame.
+        frame_height, frame_width = frame.shape[:2]
+        region = self.roi if self.use_roi else None
+        results, landmarks = self._process_region(frame, region or (0, 0, frame_width, frame_height))
+
+        # Tracking lost inside the region, fall back to a full-frame pass
+        if landmarks is None and region is not None:
+            results, landmarks = self._process_region(frame, (0, 0, frame_width, frame_height))
 
-    def calculate_angle(self, joint1, joint2, joint3):
+        if landmarks is not None and self.use_roi:
+            self._update_roi(landmarks, frame_width, frame_height)
+        else:
+            self.roi = None
+        return results, landmarks
+
+    def _process_region(self, frame, region):
+        frame_height, frame_width = frame.shape[:2]
+        x1, y1, x2, y2 = region
+        crop = frame[y1:y2, x1:x2]
+        crop_width, crop_height = x2 - x1, y2 - y1
+
+        if self.inference_size is not None and max(crop_width, crop_height) > self.inference_size:
+            scale = self.inference_size / max(crop_width, crop_height)
+            crop = cv2.resize(crop, (max(1, round(crop_width * scale)), max(1, round(crop_height * scale))),
+                              interpolation=cv2.INTER_AREA)
+
+        # MediaPipe expects RGB
+        results = self.mp_pose.process(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
+
+        if not results.pose_landmarks:
+            return results, None
+        landmarks = self.landmark_array(results.pose_landmarks)
+        if (crop_width, crop_height) != (frame_width, frame_height):
+            # Landmarks are normalized to the crop, map them back to the full frame
+            extent = np.array((crop_width / frame_width, crop_height / frame_height))
+            offset = np.array((x1 / frame_width, y1 / frame_height))
+            landmarks[:, :2] = landmarks[:, :2] * extent + offset
+        return results, landmarks
+
+    def _update_roi(self, landmarks, frame_width, frame_height):
+        # Bounding box of the landmarks in pixels
+        (x1, y1), (x2, y2) = landmarks[:, :2].min(axis=0).tolist(), landmarks[:, :2].max(axis=0).tolist()
+        x1, x2 = x1 * frame_width, x2 * frame_width
+        y1, y2 = y1 * frame_height, y2 * frame_height
+
+        # Keep the current region while the landmarks stay well inside it, so MediaPipe sees a stable crop
+        pad_x, pad_y = (x2 - x1) * self.roi_padding, (y2 - y1) * self.roi_padding
+        if self.roi is not None:
+            rx1, ry1, rx2, ry2 = self.roi
+            inside = (rx1 + pad_x / 2 <= x1 and x2 <= rx2 - pad_x / 2 and
+                      ry1 + pad_y / 2 <= y1 and y2 <= ry2 - pad_y / 2)
+            if inside and (rx2 - rx1) * (ry2 - ry1) < 2 * (x2 - x1 + 2 * pad_x) * (y2 - y1 + 2 * pad_y):
+                return
+
+        roi = (max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y)),
+               min(frame_width, int(x2 + pad_x) + 1), min(frame_height, int(y2 + pad_y) + 1))
+        # Too small to be a real detection, search the full frame again
+        self.roi = roi if roi[2] - roi[0] > 32 and roi[3] - roi[1] > 32 else None
+
+    def calculate_angle(self, joint1, joint2, joint3, name='default'):
         """
         Calculates the angle between three joints.
 
@@ -30,6 +375,7 @@ class Sense:
         - joint1: Tuple of (x, y) for the first joint (e.g., shoulder)
         - joint2: Tuple of (x, y) for the middle joint (e.g., elbow)
         - joint3: Tuple of (x, y) for the last joint (e.g., wrist)
+        - name: Name of the moving average window the angle belongs to
 
         Returns:
         - Angle in degrees between the three joints
@@ -47,44 +393,57 @@ class Sense:
         angle = math.acos(dot_product / (magnitude1 * magnitude2))
 
         # get a moving average
-        self.angle_window.pop(0)
-        self.angle_window.append(angle)
-        # Use np.convolve to calculate the moving average
-        window_size = 10
-        angle_mvg = np.convolve(np.asarray(self.angle_window), np.ones(window_size) / window_size, mode='valid')
+        if name not in self.angle_windows:
+            self.angle_windows[name] = RunningMean(10)
+        angle_mvg = self.angle_windows[name].push(angle)[0]
 
         return math.degrees(angle_mvg)
 
+    def landmark_array(self, pose_landmarks):
+        """
+        Converts the pose landmarks from MediaPipe into the landmark array. This is the only place the protobuf
+        is read, everything else works on the array. detect_joints already does this for every frame.
+
+        Parameters:
+        - pose_landmarks: The pose_landmarks of the MediaPipe results
+
+        Returns:
+        - float32 array of shape (33, 4) with x, y, z and visibility of every landmark.
+          A new array for every call, it stays valid for as long as the caller keeps it.
+        """
+        landmarks = np.array([(landmark.x, landmark.y, landmark.z, landmark.visibility)
+                              for landmark in pose_landmarks.landmark], dtype=np.float32)
+        self.landmarks = landmarks
+        return landmarks
+
+    def extract_angles(self, landmarks):
+        """
+        Calculates the moving average of every angle in ANGLE_TRIPLES for a frame.
+
+        Parameters:
+        - landmarks: The landmark array from landmark_array
+
+        Returns:
+        - Array of angles in degrees, in the order of self.angle_engine.names
+        """
+        if self._angles is None or not np.array_equal(landmarks, self._angles_points):
+            self._angles = self.angle_engine.update(landmarks)
+            self._angles_points[:] = landmarks
+        return self._angles
+
     def extract_joint_coordinates(self, landmarks, joint):
         """
         Extracts the (x, y) coordinates of a specific joint.
 
         Parameters:
-        - landmarks: The list of pose landmarks from MediaPipe
+        - landmarks: The landmark array from landmark_array
         - joint: The name of the joint (e.g., 'left_elbow')
 
         Returns:
         - A tuple of (x, y) coordinates of the specified joint
         """
-        joint_index_map = {
-            'right_shoulder': mp.solutions.pose.PoseLandmark.LEFT_SHOULDER,
-            'left_shoulder': mp.solutions.pose.PoseLandmark.RIGHT_SHOULDER,
-            'right_elbow': mp.solutions.pose.PoseLandmark.LEFT_ELBOW,
-            'left_elbow': mp.solutions.pose.PoseLandmark.RIGHT_ELBOW,
-            'right_wrist': mp.solutions.pose.PoseLandmark.LEFT_WRIST,
-            'left_wrist': mp.solutions.pose.PoseLandmark.RIGHT_WRIST,
-            'right_hip': mp.solutions.pose.PoseLandmark.LEFT_HIP,
-            'left_hip': mp.solutions.pose.PoseLandmark.RIGHT_HIP,
-            'right_knee': mp.solutions.pose.PoseLandmark.LEFT_KNEE,
-            'left_knee': mp.solutions.pose.PoseLandmark.RIGHT_KNEE,
-            'right_ankle': mp.solutions.pose.PoseLandmark.LEFT_ANKLE,
-            'left_ankle': mp.solutions.pose.PoseLandmark.RIGHT_ANKLE
-        }
-
-        joint_index = joint_index_map[joint]
-        landmark = landmarks.landmark[joint_index]
-
-        return landmark.x, landmark.y
+        joint_index = JOINT_INDEX[joint]
+        return float(landmarks[joint_index, 0]), float(landmarks[joint_index, 1])
 
     ### Example for defining a function that extracts an angle
     def extract_hip_angle(self, landmarks):
@@ -92,46 +451,32 @@ class Sense:
                 Extracts the hip angle.
 
                 Parameters:
-                - landmarks: The list of pose landmarks from MediaPipe
+                - landmarks: The landmark array from landmark_array
 
                 Returns:
                 - An angle in degrees for the hip
                 """
-        # extract the x and y coordinates
-        left_hip = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_HIP.value].x,
-                    landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_HIP.value].y]
-        left_shoulder = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_SHOULDER.value].x,
-                         landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_SHOULDER.value].y]
-        left_knee = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_KNEE.value].x,
-                     landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_KNEE.value].y]
-        return self.calculate_angle(left_shoulder, left_hip, left_knee)
-
-    # Extracts the angle of the knee by measuring the angle between the left hip, left knee, and left ankle
+        # angle between the shoulder, hip and knee
+        return self.extract_angles(landmarks)[self.angle_engine.index['right_hip']]
+
+    # Extracts the angle of the knee by measuring the angle between the hip, knee, and ankle
     def extract_knee_angle(self, landmarks):
-        # extract the x and y coordinates
-        left_hip = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_HIP.value].x,
-                    landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_HIP.value].y]
-        left_knee = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_KNEE.value].x,
-                     landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_KNEE.value].y]
-        left_ankle = [landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_ANKLE.value].x,
-                      landmarks.landmark[mp.solutions.pose.PoseLandmark.LEFT_ANKLE.value].y]
-        return self.calculate_angle(left_hip, left_knee, left_ankle)
+        return self.extract_angles(landmarks)[self.angle_engine.index['right_knee']]
 
     def calculate_distance(self, landmarks):
         """
         Estimates the distance of the user from the camera based on shoulder width.
 
         Parameters:
-        - landmarks: The list of pose landmarks from MediaPipe
+        - landmarks: The landmark array from landmark_array
 
         Returns:
         - Distance estimate (in arbitrary units)
         """
-        left_shoulder = self.extract_joint_coordinates(landmarks, 'left_shoulder')
-        right_shoulder = self.extract_joint_coordinates(landmarks, 'right_shoulder')
+        left_shoulder = landmarks[JOINT_INDEX['left_shoulder']]
+        right_shoulder = landmarks[JOINT_INDEX['right_shoulder']]
 
         # Calculate the width between shoulders
-        shoulder_distance = math.sqrt((right_shoulder[0] - left_shoulder[0]) ** 2 +
-                                      (right_shoulder[1] - left_shoulder[1]) ** 2)
+        shoulder_distance = math.hypot(right_shoulder[0] - left_shoulder[0], right_shoulder[1] - left_shoulder[1])
 
         return shoulder_distance
@@ -0,0 +1,126 @@
+import collections
+import logging
+import os
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Speech: text-to-speech on a dedicated thread. Fixed utterances are synthesized to in-memory audio once at
+# startup and played straight from memory, everything else is synthesized by pyttsx3 when it comes up.
+class Speech:
+
+    def __init__(self, utterances=(), max_pending=2, max_age=3.0):
+        """
+        Starts the speech thread. It renders the fixed utterances first and then waits for messages.
+
+        :param utterances: Texts that are spoken often and get pre-rendered
+        :param max_pending: Maximum number of messages waiting to be spoken, older ones are dropped
+        :param max_age: Messages that waited longer than this many seconds are dropped as stale
+        """
+        self.utterances = list(utterances)
+        self.max_pending = max_pending
+        self.max_age = max_age
+
+        # Pre-rendered audio: text -> (int16 samples, sample rate)
+        self.cache = {}
+        self.dropped = 0
+
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='speech', daemon=True)
+        self._thread.start()
+
+    def say(self, text):
+        """
+        Queues a text to be spoken. Never blocks; when the queue is full the oldest message is dropped.
+
+        :param text: The text to be spoken
+        """
+        with self._condition:
+            # Saying the same thing twice in a row adds nothing
+            if any(pending == text for pending, _ in self._pending):
+                return
+            self._pending.append((text, time.monotonic()))
+            while len(self._pending) > self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._condition.notify()
+
+    def stop(self, timeout=2.0):
+        """
+        Stops the speech thread. Messages that were not spoken yet are discarded.
+        """
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join(timeout=timeout)
+
+    def _run(self):
+        try:
+            import pyttsx3
+            # pyttsx3 engines have to be used from the thread that created them
+            engine = pyttsx3.init()
+        except Exception:
+            logger.exception("Text-to-speech is not available, speech is disabled")
+            return
+        try:
+            import sounddevice
+        except Exception:
+            sounddevice = None
+            logger.warning("sounddevice is not available, utterances are synthesized every time")
+
+        if sounddevice is not None:
+            for text in self.utterances:
+                if self._stopped:
+                    break
+                self._prerender(engine, text)
+
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+                text, queued_at = self._pending.popleft()
+
+            if time.monotonic() - queued_at > self.max_age:
+                self.dropped += 1
+                continue
+
+            try:
+                if text in self.cache:
+                    samples, sample_rate = self.cache[text]
+                    sounddevice.play(samples, sample_rate)
+                    sounddevice.wait()
+                else:
+                    engine.say(text)
+                    engine.runAndWait()
+            except Exception:
+                logger.exception("Could not speak %r", text)
+
+    def _prerender(self, engine, text):
+        descriptor, path = tempfile.mkstemp(suffix='.wav')
+        os.close(descriptor)
+        try:
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            with wave.open(path, 'rb') as audio:
+                if audio.getsampwidth() != 2:
+                    raise ValueError("Only 16-bit audio is supported")
+                sample_rate = audio.getframerate()
+                samples = np.frombuffer(audio.readframes(audio.getnframes()), dtype=np.int16)
+                samples = samples.reshape(-1, audio.getnchannels())
+            self.cache[text] = (samples, sample_rate)
+        except Exception:
+            # Not every pyttsx3 driver writes wav files, those utterances are synthesized live instead
+            logger.warning("Could not pre-render %r", text)
+        finally:
+            os.remove(path)
@@ -0,0 +1,168 @@
+import collections
+import os
+
+import cv2
+
+from coach.Compositor import Compositor
+
+
+# Folder and colour of the balloon belonging to each limb (same order as Act.limb_list)
+BALLOON_PATHS = {
+    0: "Left_hand",
+    1: "Left_knee",
+    2: "Right_hand",
+    3: "Right_knee"
+}
+BALLOON_COLORS = {
+    0: "green",
+    1: "yellow",
+    2: "blue",
+    3: "red"
+}
+# The intact balloon (stage 0) followed by the five popping stages
+BALLOON_STAGES = 6
+
+# Full-screen images shown outside of the game itself
+SCREEN_IMAGES = ("balloon_tutorial", "balloons_end_screen")
+
+
+# Sprite atlas: decodes every image once and keeps it resized in memory, so the frame loop never touches the disk.
+class SpriteAtlas:
+
+    def __init__(self, image_dir="images", size=(100, 100), max_entries=96):
+        """
+        Initializes an empty atlas. Images are decoded lazily on first use or all at once with preload().
+
+        :param image_dir: Directory that contains the balloon folders and the screen images
+        :param size: (width, height) every balloon sprite is resized to
+        :param max_entries: Maximum number of decoded images kept in memory, least recently used ones are evicted
+        """
+        self.image_dir = image_dir
+        self.size = tuple(size)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def balloon_path(self, limb, stage):
+        """
+        Builds the file path of a balloon image.
+
+        :param limb: The limb the balloon belongs to (0-3)
+        :param stage: The popping stage (0 is the intact balloon)
+        :return: Path to the png file
+        """
+        base_path = os.path.join(self.image_dir, BALLOON_PATHS[limb], f"{BALLOON_COLORS[limb]}_balloon")
+        if stage == 0:
+            return f"{base_path}.png"
+        return f"{base_path}_popping{stage}.png"
+
+    def balloon(self, limb, stage):
+        """
+        Returns the resized BGRA sprite of a balloon.
+
+        :param limb: The limb the balloon belongs to (0-3)
+        :param stage: The popping stage (0-5)
+        :return: uint8 array of shape (height, width, 4)
+        """
+        if not 0 <= stage < BALLOON_STAGES:
+            raise ValueError(f"Balloon stage must be between 0 and {BALLOON_STAGES - 1}, got {stage}")
+        key = ("balloon", limb, stage)
+        entry = self._lookup(key)
+        if entry is None:
+            entry = self._load(self.balloon_path(limb, stage), cv2.IMREAD_UNCHANGED, self.size)
+            self._store(key, entry)
+        return entry
+
+    def premultiplied(self, limb, stage):
+        """
+        Returns the balloon sprite in premultiplied form, ready for Compositor.blend.
+
+        :param limb: The limb the balloon belongs to (0-3)
+        :param stage: The popping stage (0-5)
+        :return: PremultipliedSprite
+        """
+        key = ("balloon", limb, stage, "premultiplied")
+        entry = self._lookup(key)
+        if entry is None:
+            entry = Compositor.premultiply(self.balloon(limb, stage))
+            self._store(key, entry)
+        return entry
+
+    def image(self, name, size=None):
+        """
+        Returns one of the full-screen images (e.g. the tutorial or the end screen).
+        The returned array is shared, copy it before drawing on it.
+
+        :param name: File name without extension inside the image directory
+        :param size: Optional (width, height) to resize the image to
+        :return: uint8 BGR array
+        """
+        key = ("image", name, tuple(size) if size is not None else None)
+        entry = self._lookup(key)
+        if entry is None:
+            entry = self._load(os.path.join(self.image_dir, f"{name}.png"), cv2.IMREAD_COLOR, size)
+            self._store(key, entry)
+        return entry
+
+    def preload(self):
+        """
+        Decodes all balloon stages and the screen images up front.
+        """
+        for limb in BALLOON_PATHS:
+            for stage in range(BALLOON_STAGES):
+                self.premultiplied(limb, stage)
+        for name in SCREEN_IMAGES:
+            self.image(name)
+
+    def set_size(self, size):
+        """
+        Changes the balloon sprite size. Cached balloons of the old size are dropped.
+
+        :param size: New (width, height) of the balloon sprites
+        """
+        size = tuple(size)
+        if size != self.size:
+            self.size = size
+            self.invalidate("balloon")
+
+    def invalidate(self, kind=None):
+        """
+        Drops cached entries so they are decoded again on next use.
+
+        :param kind: "balloon" or "image" to only drop that kind of entry, None to drop everything
+        """
+        if kind is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == kind]:
+            del self._entries[key]
+
+    @property
+    def nbytes(self):
+        """
+        Memory currently used by the decoded images in bytes.
+        """
+        return sum(sum(part.nbytes for part in entry) if isinstance(entry, tuple) else entry.nbytes
+                   for entry in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _load(path, flags, size):
+        image = cv2.imread(path, flags)
+        if image is None:
+            raise FileNotFoundError(f"Could not read image {path}")
+        if size is not None:
+            image = cv2.resize(image, size)
+        return image
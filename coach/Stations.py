@@ -0,0 +1,199 @@
+import collections
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from coach.Sense import ANGLE_TRIPLES, NUM_LANDMARKS, LANDMARK_COLUMNS, AngleEngine, PoseResults, Sense
+
+
+# A frame taken out of a station's ring. joints is a PoseResults without the MediaPipe protobuf (pose_landmarks
+# is None), the protobuf never leaves the worker process. angles are the worker's smoothed angles.
+StationPacket = collections.namedtuple('StationPacket', ['sequence', 'frame', 'joints', 'angles', 'captured_at'])
+
+# Flags of a ring slot
+HAS_LANDMARKS = 1
+PREDICTED = 2
+
+
+class FrameRing:
+
+    def __init__(self, frame_shape, slots=4, num_angles=len(ANGLE_TRIPLES), name=None):
+        """
+        Ring of frames and their pose results in shared memory, written by one station worker and read by the
+        station manager. Only the newest frame is read, a slot is copied out once instead of being pickled.
+
+        :param frame_shape: (height, width, 3) of the frames
+        :param slots: Number of frames in the ring, the writer overwrites the oldest one
+        :param num_angles: Number of angles stored per frame
+        :param name: Name of an existing ring to attach to, None creates a new one. Only the creator unlinks it.
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        self.num_angles = num_angles
+
+        # Every field is an array over the slots, laid out one after the other
+        fields = [('latest', np.int64, (1,)),
+                  ('sequence', np.int64, (slots,)),
+                  ('captured_at', np.float64, (slots,)),
+                  ('angles', np.float64, (slots, num_angles)),
+                  ('landmarks', np.float32, (slots, NUM_LANDMARKS, len(LANDMARK_COLUMNS))),
+                  ('flags', np.uint8, (slots,)),
+                  ('frames', np.uint8, (slots,) + self.frame_shape)]
+        offsets, size = [], 0
+        for _, dtype, shape in fields:
+            size = -(-size // 8) * 8
+            offsets.append(size)
+            size += np.dtype(dtype).itemsize * int(np.prod(shape))
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        elif sys.version_info >= (3, 13):
+            # Only the creating worker unlinks the ring, attaching must not register it for cleanup at our exit
+            self.memory = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # Older versions always register on attach. The workers are spawned from the reader and share its
+            # resource tracker, which already holds the worker's registration: unregistering here would drop
+            # that one, and the tracker would fail on the worker's unlink.
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        for (field, dtype, shape), offset in zip(fields, offsets):
+            setattr(self, field, np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset))
+        if name is None:
+            self.latest[0] = -1
+            self.sequence[:] = -1
+
+    def write(self, frame, landmarks, angles, predicted, captured_at):
+        """
+        Publishes a frame and its pose results (landmarks and angles may be None).
+        """
+        count = int(self.latest[0]) + 1
+        slot = count % self.slots
+        # The slot is marked as being written, a reader that copied it meanwhile throws its copy away
+        self.sequence[slot] = -1
+        self.frames[slot] = frame
+        flags = PREDICTED if predicted else 0
+        if landmarks is not None:
+            self.landmarks[slot] = landmarks
+            self.angles[slot] = angles
+            flags |= HAS_LANDMARKS
+        self.flags[slot] = flags
+        self.captured_at[slot] = captured_at
+        self.sequence[slot] = count
+        self.latest[0] = count
+
+    def read_latest(self, after=-1, out=None):
+        """
+        Copies the newest frame out of the ring.
+
+        :param after: Sequence number of the last frame read, older or equal frames are not returned again
+        :param out: Optional array of the frame shape the frame is copied into
+        :return: StationPacket, None if there is no newer frame
+        """
+        count = int(self.latest[0])
+        if count <= after:
+            return None
+        slot = count % self.slots
+        if out is None:
+            frame = self.frames[slot].copy()
+        else:
+            np.copyto(out, self.frames[slot])
+            frame = out
+        flags = int(self.flags[slot])
+        landmarks = self.landmarks[slot].copy() if flags & HAS_LANDMARKS else None
+        angles = self.angles[slot].copy() if flags & HAS_LANDMARKS else None
+        captured_at = float(self.captured_at[slot])
+        # The writer went around the whole ring while we were copying
+        if self.sequence[slot] != count:
+            return None
+        return StationPacket(count, frame, PoseResults(None, landmarks, bool(flags & PREDICTED)), angles,
+                             captured_at)
+
+    def close(self):
+        for field in ('latest', 'sequence', 'captured_at', 'angles', 'landmarks', 'flags', 'frames'):
+            setattr(self, field, None)
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+# What play_frame and the telemetry need from Sense, for a station whose Sense runs in a worker process.
+# The worker sends its smoothed angles along with every frame.
+class StationSense:
+
+    def __init__(self, keyframe):
+        """
+        :param keyframe: multiprocessing.Event the worker checks before every frame
+        """
+        self.angle_engine = AngleEngine()
+        self.keyframe = keyframe
+        self.angles = None
+
+    def request_keyframe(self):
+        self.keyframe.set()
+
+    def extract_angles(self, landmarks):
+        return self.angles
+
+    # Only reads the landmark array, no state of the Sense instance
+    calculate_distance = Sense.calculate_distance
+
+
+def station_worker(source, connection, stop, keyframe, sense_options=None, flip=True, slots=4, core=None):
+    """
+    Entry point of a station's worker process: captures frames from one camera, runs Sense on them and publishes
+    the results in a FrameRing. The name and shape of the ring are sent through connection once the camera
+    delivered its first frame (None if it did not).
+
+    :param source: Camera index or video path for cv2.VideoCapture
+    :param connection: multiprocessing Connection the ring is announced on
+    :param stop: multiprocessing.Event that ends the worker
+    :param keyframe: multiprocessing.Event, when set the next frame runs MediaPipe
+    :param sense_options: Keyword arguments for Sense
+    :param flip: Mirror the frames horizontally
+    :param slots: Number of frames in the ring
+    :param core: CPU core the worker is pinned to, None leaves the scheduling to the OS
+    """
+    # One core per station: OpenCV's own thread pool would compete with the other stations
+    cv2.setNumThreads(1)
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+
+    capture = cv2.VideoCapture(source)
+    ret, frame = capture.read()
+    if not ret:
+        connection.send(None)
+        capture.release()
+        return
+
+    sense = Sense(**(sense_options or {}))
+    sense.warmup(frame.shape)
+    if flip:
+        frame = cv2.flip(frame, 1)
+    ring = FrameRing(frame.shape, slots, len(sense.angle_engine.names))
+    connection.send((ring.name, frame.shape, slots, len(sense.angle_engine.names)))
+    captured_at = time.monotonic()
+    try:
+        while not stop.is_set():
+            if keyframe.is_set():
+                keyframe.clear()
+                sense.request_keyframe()
+            joints = sense.detect_joints(frame)
+            angles = sense.extract_angles(joints.landmarks) if joints.landmarks is not None else None
+            ring.write(frame, joints.landmarks, angles, joints.predicted, captured_at)
+
+            ret, frame = capture.read()
+            if not ret:
+                break
+            # time.monotonic is the same clock in every process, so the manager can measure the latency
+            captured_at = time.monotonic()
+            if flip:
+                frame = cv2.flip(frame, 1)
+    finally:
+        capture.release()
+        ring.close()
+        ring.unlink()
@@ -0,0 +1,280 @@
+import bisect
+import collections
+import math
+
+
+# One completed repetition of a joint, a cycle from one rep event of rep_kind to the next:
+#   rom             Range of motion, max_angle - min_angle in degrees
+#   duration        Seconds of the cycle
+#   peak_velocity   Highest angular speed in the cycle, degrees per second
+#   summary         StatsSummary of the joint including this repetition
+RepStats = collections.namedtuple('RepStats', ['joint', 'rom', 'min_angle', 'max_angle', 'duration',
+                                               'peak_velocity', 'timestamp', 'summary'])
+
+# Running statistics of a joint over the session, nan until there is something to report
+StatsSummary = collections.namedtuple('StatsSummary', ['joint', 'reps', 'angle_mean', 'angle_std', 'rom_mean',
+                                                       'rom_std', 'rom_p50', 'rom_p90', 'duration_mean',
+                                                       'peak_velocity_mean', 'peak_velocity_p90'])
+
+
+class Welford:
+
+    def __init__(self):
+        """
+        Running mean and variance in O(1) per sample (Welford's algorithm), without keeping the samples.
+        """
+        self.count = 0
+        self.mean = math.nan
+        self._m2 = 0.0
+
+    def push(self, value):
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        """
+        Sample variance, nan with fewer than two samples.
+        """
+        return self._m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class P2Quantile:
+
+    def __init__(self, p, exact_samples=20):
+        """
+        Streaming estimate of a quantile with the P-square algorithm (Jain and Chlamtac): five markers are
+        moved along with the samples. The first samples are kept and give the exact quantile, P-square is far
+        off for a few samples (a p90 of 10 samples ends up near the median).
+
+        :param p: The quantile, e.g. 0.9
+        :param exact_samples: Samples kept before the markers take over, at least 5
+        """
+        self.p = p
+        self.exact_samples = max(exact_samples, 5)
+        self.count = 0
+        # Sorted samples while count <= exact_samples, then the marker heights
+        self._samples = []
+        self._heights = None
+        self._increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+
+    def push(self, value):
+        self.count += 1
+        if self.count <= self.exact_samples:
+            bisect.insort(self._samples, value)
+            return
+        if self._heights is None:
+            self._start_markers()
+        heights = self._heights
+
+        # Cell the value falls into, the extreme markers follow the minimum and maximum
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self._positions
+        for marker in range(cell + 1, 5):
+            positions[marker] += 1
+        for marker in range(5):
+            self._desired[marker] += self._increments[marker]
+
+        # Move the middle markers towards their desired positions, on a parabola through their neighbours
+        for marker in (1, 2, 3):
+            offset = self._desired[marker] - positions[marker]
+            if (offset >= 1 and positions[marker + 1] - positions[marker] > 1) or \
+                    (offset <= -1 and positions[marker - 1] - positions[marker] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(marker, step)
+                if not heights[marker - 1] < height < heights[marker + 1]:
+                    height = heights[marker] + step * (heights[marker + step] - heights[marker]) / \
+                        (positions[marker + step] - positions[marker])
+                heights[marker] = height
+                positions[marker] += step
+
+    @property
+    def value(self):
+        """
+        The estimated quantile, exact up to exact_samples samples. nan without samples.
+        """
+        if self.count == 0:
+            return math.nan
+        if self._heights is None:
+            # Linear between the two closest ranks, like numpy.percentile
+            position = self.p * (self.count - 1)
+            below = int(position)
+            above = min(below + 1, self.count - 1)
+            return self._samples[below] + (position - below) * (self._samples[above] - self._samples[below])
+        return self._heights[2]
+
+    def _start_markers(self):
+        # Markers at the quantiles 0, p/2, p, (1+p)/2 and 1 of the kept samples, then the samples are dropped
+        samples, last = self._samples, len(self._samples) - 1
+        self._desired = [last * increment for increment in self._increments]
+        positions = [round(desired) for desired in self._desired]
+        for marker in (1, 2, 3):
+            positions[marker] = min(max(positions[marker], positions[marker - 1] + 1), last - 3 + marker)
+        self._positions = positions
+        self._heights = [samples[position] for position in positions]
+        self._samples = []
+
+    def _parabolic(self, marker, step):
+        heights, positions = self._heights, self._positions
+        below = positions[marker] - positions[marker - 1]
+        above = positions[marker + 1] - positions[marker]
+        return heights[marker] + step / (positions[marker + 1] - positions[marker - 1]) * (
+            (below + step) * (heights[marker + 1] - heights[marker]) / above +
+            (above - step) * (heights[marker] - heights[marker - 1]) / below)
+
+
+class JointStats:
+
+    def __init__(self, joint, max_gap=0.5):
+        """
+        Statistics of one joint, updated in O(1) per angle sample. A repetition cycle runs from one rep event
+        to the next, see complete().
+
+        :param joint: Name of the joint
+        :param max_gap: Seconds between two samples above which no angular velocity is computed (tracking lost)
+        """
+        self.joint = joint
+        self.max_gap = max_gap
+        self.angles = Welford()
+        self.rom = Welford()
+        self.rom_p50 = P2Quantile(0.5)
+        self.rom_p90 = P2Quantile(0.9)
+        self.duration = Welford()
+        self.peak_velocity = Welford()
+        self.peak_velocity_p90 = P2Quantile(0.9)
+        self.last = None
+        self.break_cycle()
+
+    def break_cycle(self):
+        """
+        Drops the cycle in progress, e.g. when a new game starts. The next rep event starts a new one.
+        """
+        self._cycle_start = None
+        self._min = math.inf
+        self._max = -math.inf
+        self._peak = 0.0
+        self._previous = None
+
+    def push(self, angle, timestamp):
+        """
+        :param angle: Smoothed angle in degrees, nan if the joint was not measured
+        :param timestamp: Time of the sample in seconds
+        """
+        if angle != angle:
+            return
+        self.angles.push(angle)
+        if angle < self._min:
+            self._min = angle
+        if angle > self._max:
+            self._max = angle
+        if self._previous is not None:
+            previous_angle, previous_time = self._previous
+            elapsed = timestamp - previous_time
+            if 0 < elapsed <= self.max_gap:
+                speed = abs(angle - previous_angle) / elapsed
+                if speed > self._peak:
+                    self._peak = speed
+        self._previous = (angle, timestamp)
+
+    def complete(self, timestamp):
+        """
+        Ends the cycle in progress at a rep event and starts the next one.
+
+        :return: RepStats of the cycle, None for the first rep event, which only starts a cycle
+        """
+        rep = None
+        if self._cycle_start is not None and self._max >= self._min:
+            rom = self._max - self._min
+            duration = timestamp - self._cycle_start
+            self.rom.push(rom)
+            self.rom_p50.push(rom)
+            self.rom_p90.push(rom)
+            self.duration.push(duration)
+            self.peak_velocity.push(self._peak)
+            self.peak_velocity_p90.push(self._peak)
+            rep = self.last = RepStats(self.joint, rom, self._min, self._max, duration, self._peak, timestamp,
+                                       self.summary())
+        previous = self._previous
+        self.break_cycle()
+        self._cycle_start = timestamp
+        # The sample of the rep event belongs to both cycles
+        if previous is not None:
+            self._previous = previous
+            self._min = self._max = previous[0]
+        return rep
+
+    def summary(self):
+        """
+        :return: StatsSummary of the session so far
+        """
+        return StatsSummary(self.joint, self.rom.count, self.angles.mean, self.angles.std, self.rom.mean,
+                            self.rom.std, self.rom_p50.value, self.rom_p90.value, self.duration.mean,
+                            self.peak_velocity.mean, self.peak_velocity_p90.value)
+
+
+# Repetition statistics of all joints with a state machine: range of motion, duration and peak angular velocity
+# per repetition, running means, variances and percentiles per joint. Nothing of the session is buffered, every
+# sample and every repetition is an O(1) update.
+class RepStatistics:
+
+    def __init__(self, joints, rep_kind='flexion_to_extension', max_gap=0.5):
+        """
+        :param joints: Names of the joints, in the order of the angles passed to push
+        :param rep_kind: Kind of coach.Fsm.RepEvent that ends one repetition cycle and starts the next
+        :param max_gap: See JointStats
+        """
+        self.joints = list(joints)
+        self.rep_kind = rep_kind
+        self.stats = [JointStats(joint, max_gap) for joint in self.joints]
+        self._index = {joint: index for index, joint in enumerate(self.joints)}
+
+    def push(self, angles, timestamp):
+        """
+        :param angles: One smoothed angle per joint in degrees, nan for joints that were not measured
+        :param timestamp: Time of the sample in seconds
+        """
+        for stats, angle in zip(self.stats, angles):
+            stats.push(float(angle), timestamp)
+
+    def on_rep(self, event):
+        """
+        Called with every coach.Fsm.RepEvent, after the sample that caused it was pushed.
+
+        :return: RepStats if the event completed a repetition cycle, None otherwise
+        """
+        if event.kind != self.rep_kind:
+            return None
+        return self.stats[self._index[event.joint]].complete(event.timestamp)
+
+    def break_cycles(self):
+        """
+        Drops the cycles in progress of all joints, the statistics of the session are kept.
+        """
+        for stats in self.stats:
+            stats.break_cycle()
+
+    def summary(self, joint):
+        """
+        :param joint: Name of the joint
+        :return: StatsSummary of the joint
+        """
+        return self.stats[self._index[joint]].summary()
@@ -0,0 +1,411 @@
+import base64
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from coach.Events import COALESCE, DROP_OLDEST, HIT, POSE, REP, STATE
+from coach.Profiler import DISABLED
+
+logger = logging.getLogger(__name__)
+
+# Binary messages of the /events WebSocket, little endian. Every message starts with its kind (one byte).
+#   POSE   kind, elapsed_time f8, popped u2, flags u1, state i1 per joint,
+#          then if HAS_LANDMARKS: landmarks f4 (33, 4) and angles f4 per angle name
+#   STATE  kind, joint u1, source u1, dest u1, timestamp f8
+#   REP    kind, joint u1, source u1, dest u1, angle f4, timestamp f8
+#   HIT    kind, slot u1, landmark u1, stage u1, popped u1
+# The first message is a JSON text message with the names the indices refer to (angle_names, joints, states).
+MESSAGE_KINDS = {POSE: 1, STATE: 2, REP: 3, HIT: 4}
+POSE_HEADER = struct.Struct('<BdHB')
+STATE_MESSAGE = struct.Struct('<BBBBd')
+REP_MESSAGE = struct.Struct('<BBBBfd')
+HIT_MESSAGE = struct.Struct('<BBBBB')
+
+# Flags of a POSE message
+HAS_LANDMARKS = 1
+PREDICTED = 2
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC11B65'
+
+INDEX_PAGE = b"""<!DOCTYPE html>
+<html><head><title>Pop The Balloons</title></head>
+<body style="margin:0;background:#111">
+<img src="/stream.mjpg" style="width:100%;height:100vh;object-fit:contain">
+</body></html>
+"""
+
+
+class EventEncoder:
+
+    def __init__(self, angle_names, joints, states):
+        """
+        Packs bus events into the binary messages of the /events WebSocket.
+
+        :param angle_names: Names of the angles, Sense.angle_engine.names
+        :param joints: Names of the joints with a state machine, Think.fsm.joints
+        :param states: Names of the FSM states, Think.fsm.spec.states
+        """
+        self.angle_names = list(angle_names)
+        self.joints = list(joints)
+        self.states = list(states)
+        self._joint_index = {joint: index for index, joint in enumerate(self.joints)}
+        self._state_index = {state: index for index, state in enumerate(self.states)}
+
+    def schema(self):
+        """
+        :return: The JSON text of the first message
+        """
+        return json.dumps({'angle_names': self.angle_names, 'joints': self.joints, 'states': self.states,
+                           'kinds': MESSAGE_KINDS})
+
+    def encode(self, event):
+        """
+        :param event: Event of the bus
+        :return: The binary message
+        """
+        data = event.data
+        kind = MESSAGE_KINDS[event.topic]
+        if event.topic == POSE:
+            flags = (HAS_LANDMARKS if data.landmarks is not None else 0) | (PREDICTED if data.predicted else 0)
+            parts = [POSE_HEADER.pack(kind, data.elapsed_time, data.popped, flags),
+                     np.asarray(data.state, dtype=np.int8).tobytes()]
+            if data.landmarks is not None:
+                parts.append(np.asarray(data.landmarks, dtype='<f4').tobytes())
+                parts.append(np.asarray(data.angles, dtype='<f4').tobytes())
+            return b''.join(parts)
+        if event.topic == STATE:
+            return STATE_MESSAGE.pack(kind, self._joint_index[data.joint], self._state_index[data.source],
+                                      self._state_index[data.dest], data.timestamp)
+        if event.topic == REP:
+            return REP_MESSAGE.pack(kind, self._joint_index[data.joint], self._state_index[data.source],
+                                    self._state_index[data.dest], data.angle, data.timestamp)
+        return HIT_MESSAGE.pack(kind, data.slot, data.landmark, data.stage, bool(data.popped))
+
+
+class FrameEncoder:
+
+    def __init__(self, fps=10.0, quality=70, scale=1.0, workers=2, profiler=DISABLED):
+        """
+        Encodes the newest rendered frame to JPEG on a thread pool at a fixed rate, only while someone watches.
+        Frames the renderer offers in between are skipped, every viewer gets the newest JPEG.
+
+        :param fps: JPEGs encoded per second at most
+        :param quality: JPEG quality, 0 to 100
+        :param scale: Factor the frames are resized by before encoding
+        :param workers: Threads encoding at the same time
+        :param profiler: Profiler the encoding time is recorded to, as 'jpeg_encode'
+        """
+        self.interval = 1.0 / fps
+        self.quality = quality
+        self.scale = scale
+        self.workers = workers
+        self.profiler = profiler
+        self.viewers = 0
+
+        # The renderer's frame is only referenced, it must not be drawn on after offer()
+        self._frame = None
+        self._frame_sequence = 0
+        self._encoding_sequence = 0
+        self._in_flight = 0
+
+        self._jpeg = None
+        self._jpeg_sequence = 0
+        self._condition = threading.Condition()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jpeg')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='jpeg-scheduler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def offer(self, frame):
+        """
+        Hands the newest composed frame to the encoder without copying it. Called by the render loop.
+
+        :param frame: BGR frame that is not changed anymore by the caller
+        """
+        with self._condition:
+            self._frame = frame
+            self._frame_sequence += 1
+
+    def latest(self, after=0, timeout=1.0):
+        """
+        Waits for a JPEG newer than after.
+
+        :param after: Sequence number of the JPEG the caller already has
+        :return: (sequence, JPEG bytes), or (after, None) on timeout or when the encoder stopped
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._jpeg_sequence > after or self._stop.is_set(), timeout)
+            if self._jpeg_sequence <= after:
+                return after, None
+            return self._jpeg_sequence, self._jpeg
+
+    def watch(self):
+        with self._condition:
+            self.viewers += 1
+
+    def unwatch(self):
+        with self._condition:
+            self.viewers -= 1
+
+    def close(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=1)
+        self._pool.shutdown(wait=True)
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop.wait(max(0.0, next_time - time.monotonic())):
+            next_time += self.interval
+            with self._condition:
+                if (not self.viewers or self._frame is None or self._frame_sequence == self._encoding_sequence
+                        or self._in_flight >= self.workers):
+                    continue
+                frame, sequence = self._frame, self._frame_sequence
+                self._encoding_sequence = sequence
+                self._in_flight += 1
+            self._pool.submit(self._encode, frame, sequence)
+            # Falling behind only skips ticks, it does not encode a burst to catch up
+            next_time = max(next_time, time.monotonic())
+
+    def _encode(self, frame, sequence):
+        try:
+            start = time.perf_counter()
+            if self.scale != 1.0:
+                frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode('.jpg', frame, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+            self.profiler.record('jpeg_encode', time.perf_counter() - start)
+        except Exception:
+            logger.exception("Encoding a frame failed")
+            ok = False
+        with self._condition:
+            self._in_flight -= 1
+            # With several workers a newer frame may have finished first
+            if ok and sequence > self._jpeg_sequence:
+                self._jpeg = encoded.tobytes()
+                self._jpeg_sequence = sequence
+                self._condition.notify_all()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    # WebSocket upgrades need HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    # Set on the subclass StreamServer creates
+    server_state = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/':
+            self._send(200, 'text/html; charset=utf-8', INDEX_PAGE)
+        elif path == '/frame.jpg':
+            self._frame()
+        elif path == '/stream.mjpg':
+            self._mjpeg()
+        elif path == '/events' and self.server_state.events is not None:
+            self._events()
+        else:
+            self._send(404, 'text/plain', b'Not found\n')
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _frame(self):
+        encoder = self.server_state.frames
+        encoder.watch()
+        try:
+            _, jpeg = encoder.latest(timeout=2.0)
+        finally:
+            encoder.unwatch()
+        if jpeg is None:
+            self._send(503, 'text/plain', b'No frame yet\n')
+        else:
+            self._send(200, 'image/jpeg', jpeg)
+
+    def _mjpeg(self):
+        encoder = self.server_state.frames
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        encoder.watch()
+        sequence = 0
+        try:
+            # A client that reads slowly blocks only its own thread and then gets the newest JPEG, never a backlog
+            while not self.server_state.stopped.is_set():
+                sequence, jpeg = encoder.latest(sequence)
+                if jpeg is None:
+                    continue
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg))
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            pass
+        finally:
+            encoder.unwatch()
+
+    def _events(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if 'websocket' not in self.headers.get('Upgrade', '').lower() or not key:
+            self._send(400, 'text/plain', b'WebSocket upgrade expected\n')
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        encoder = self.server_state.events
+        lock = threading.Lock()
+        closed = threading.Event()
+
+        def send(opcode, payload):
+            with lock:
+                if closed.is_set():
+                    return
+                try:
+                    self.wfile.write(websocket_frame(opcode, payload))
+                    self.wfile.flush()
+                except OSError:
+                    closed.set()
+
+        send(0x1, encoder.schema().encode())
+        bus = self.server_state.bus
+        # Poses are coalesced, a slow client skips to the newest one. The other events are kept a little longer.
+        subscriptions = [
+            bus.subscribe(POSE, lambda event: send(0x2, encoder.encode(event)), policy=COALESCE,
+                          name='stream.pose'),
+            bus.subscribe((STATE, REP, HIT), lambda event: send(0x2, encoder.encode(event)), policy=DROP_OLDEST,
+                          max_pending=64, name='stream.events'),
+        ]
+        try:
+            # Only a close message or a dropped connection is expected from the client
+            while not closed.is_set() and not self.server_state.stopped.is_set():
+                opcode = read_websocket_frame(self.rfile)
+                if opcode is None or opcode == 0x8:
+                    break
+        except OSError:
+            pass
+        finally:
+            for subscription in subscriptions:
+                subscription.close(drain=False)
+            send(0x8, b'')
+            closed.set()
+            self.close_connection = True
+
+
+def websocket_frame(opcode, payload):
+    """
+    :return: An unmasked, unfragmented WebSocket frame as the server sends it
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def read_websocket_frame(file):
+    """
+    Reads one frame a client sent and throws its payload away.
+
+    :return: The opcode, None if the connection was closed
+    """
+    header = file.read(2)
+    if len(header) < 2:
+        return None
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', file.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', file.read(8))[0]
+    if header[1] & 0x80:
+        length += 4
+    file.read(length)
+    return header[0] & 0x0F
+
+
+# Local streaming server, so a therapist can watch a session from another room: the composed frames as MJPEG
+# (/stream.mjpg, /frame.jpg, a viewer page at /) and the pose and game events as binary WebSocket messages
+# (/events, see EventEncoder). Needs nothing but the standard library and OpenCV.
+class StreamServer:
+
+    def __init__(self, host='127.0.0.1', port=8080, bus=None, angle_names=(), joints=(), states=(), fps=10.0,
+                 quality=70, scale=1.0, workers=2, profiler=DISABLED):
+        """
+        :param host: Address to listen on, 0.0.0.0 for other machines on the network
+        :param port: Port to listen on, 0 picks a free one (see address)
+        :param bus: EventBus of Think whose events are streamed on /events, None serves only the frames
+        :param angle_names: Names of the angles, Sense.angle_engine.names
+        :param joints: Names of the joints with a state machine, Think.fsm.joints
+        :param states: Names of the FSM states, Think.fsm.spec.states
+        :param fps: JPEGs encoded per second at most
+        :param quality: JPEG quality, 0 to 100
+        :param scale: Factor the frames are resized by before encoding
+        :param workers: JPEG encoding threads
+        :param profiler: Profiler the encoding time and the event latency are recorded to
+        """
+        self.bus = bus
+        self.frames = FrameEncoder(fps, quality, scale, workers, profiler)
+        self.events = EventEncoder(angle_names, joints, states) if bus is not None else None
+        self.stopped = threading.Event()
+
+        handler = type('StreamHandler', (_Handler,), {'server_state': self})
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='stream-server', daemon=True)
+
+    @property
+    def address(self):
+        """
+        :return: (host, port) the server listens on
+        """
+        return self.httpd.server_address[:2]
+
+    def start(self):
+        self.frames.start()
+        self._thread.start()
+        host, port = self.address
+        logger.info("Streaming on http://%s:%d/", host, port)
+        return self
+
+    def offer(self, frame):
+        """
+        Shares the newest composed frame with the viewers, see FrameEncoder.offer.
+        """
+        self.frames.offer(frame)
+
+    def close(self):
+        self.stopped.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.frames.close()
@@ -0,0 +1,392 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from coach.Events import DROP_OLDEST, POSE
+from coach.Sense import NUM_LANDMARKS
+
+
+# File layout of a session directory:
+#   meta.json                 columns, row counts, start time, finish time, ...
+#   <table>.<column>.<n>.npy  chunk n of a column, chunk_rows rows each, the last one only partially filled
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+
+# Columns of the balloon event table, one row per touched balloon
+BALLOON_COLUMNS = {
+    'frame': ('int64', ()),
+    'timestamp': ('float64', ()),
+    'slot': ('int16', ()),
+    'limb': ('int8', ()),
+    'stage': ('int8', ()),
+    'popped': ('bool', ()),
+}
+
+
+def _chunk_path(directory, table, column, index):
+    return os.path.join(directory, f'{table}.{column}.{index:05d}.npy')
+
+
+class _ChunkedTable:
+
+    def __init__(self, directory, name, columns, chunk_rows):
+        # Append-only table of preallocated .npy memmaps. append() runs on the main loop and only copies into
+        # the current chunk, the writer thread flushes chunks and creates the next one ahead of time.
+        self.directory = directory
+        self.name = name
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+
+        self._lock = threading.Lock()
+        # Held while a chunk index is reserved and its files are created, so chunks are handed out in the
+        # order of their indices, which is the order TableReader reads the rows in
+        self._create_lock = threading.Lock()
+        self._current = None
+        self._offset = 0
+        self._spare = None
+        self._retired = []
+        self._next_index = 0
+
+    def append(self, values):
+        if self._current is None or self._offset == self.chunk_rows:
+            self._advance()
+        for column, array in self._current.items():
+            array[self._offset] = values[column]
+        self._offset += 1
+        self.rows += 1
+
+    def prepare(self):
+        """
+        Creates the next chunk if there is none waiting yet. Called from the writer thread.
+        """
+        with self._create_lock:
+            with self._lock:
+                if self._spare is not None:
+                    return
+                index = self._reserve()
+            chunk = self._create(index)
+            with self._lock:
+                self._spare = chunk
+
+    def flush(self):
+        """
+        Writes the dirty pages of the current chunk and of every full chunk to disk.
+        :return: Number of rows that are on disk
+        """
+        with self._lock:
+            rows = self.rows
+            retired, self._retired = self._retired, []
+            current = self._current
+        for chunk in retired:
+            for array in chunk.values():
+                array.flush()
+        if current is not None:
+            for array in current.values():
+                array.flush()
+        return rows
+
+    def close(self):
+        rows = self.flush()
+        with self._lock:
+            spare, self._spare = self._spare, None
+            self._current = None
+        # A chunk that was created ahead but never written to is not part of the session
+        if spare is not None:
+            paths = [array.filename for array in spare.values()]
+            del spare
+            for path in paths:
+                os.remove(path)
+        return rows
+
+    def _advance(self):
+        with self._lock:
+            if self._current is not None:
+                self._retired.append(self._current)
+            chunk, self._spare = self._spare, None
+        if chunk is None:
+            # The writer thread fell behind. It may be creating the next chunk right now, wait for that one
+            # rather than create a later one that would be filled first.
+            with self._create_lock:
+                with self._lock:
+                    chunk, self._spare = self._spare, None
+                    if chunk is None:
+                        index = self._reserve()
+                if chunk is None:
+                    chunk = self._create(index)
+        with self._lock:
+            self._current = chunk
+            self._offset = 0
+
+    def _reserve(self):
+        index = self._next_index
+        self._next_index += 1
+        return index
+
+    def _create(self, index):
+        return {column: np.lib.format.open_memmap(_chunk_path(self.directory, self.name, column, index), mode='w+',
+                                                  dtype=dtype, shape=(self.chunk_rows,) + shape)
+                for column, (dtype, shape) in self.columns.items()}
+
+
+# Telemetry recorder: streams every game frame (timestamp, landmark array, angles, FSM states) and the balloon
+# events of a session into memory-mapped .npy columns. Recording is a copy into preallocated memory, files are
+# grown in chunks and flushed by a background thread so the main loop never waits for the disk.
+class TelemetryRecorder:
+
+    def __init__(self, root='sessions', angle_names=(), joints=(), states=(), reps=(), chunk_rows=4096,
+                 flush_interval=1.0, session_id=None):
+        """
+        Creates a new session directory under root and starts the writer thread.
+
+        :param root: Directory all sessions are stored in
+        :param angle_names: Names of the angle columns, Sense.angle_engine.names
+        :param joints: Names of the joints with a state machine, Think.fsm.joints
+        :param states: Names of the FSM states, the state column holds indices into it
+        :param reps: (source, dest, rep) state changes that complete a repetition, see coach.Fsm.rep_transitions
+        :param chunk_rows: Rows per chunk file, the files are preallocated to this size
+        :param flush_interval: Seconds between two flushes of the writer thread
+        :param session_id: Name of the session directory, the start time (with a suffix if taken) if None
+        """
+        self.started_at = time.time()
+        if session_id is None:
+            self.session_id, self.path = self._create_session_directory(root)
+        else:
+            self.session_id = session_id
+            self.path = os.path.join(root, session_id)
+            os.makedirs(self.path)
+
+        self.angle_names = list(angle_names)
+        self.joints = list(joints)
+        self.states = list(states)
+        self.reps = [list(rep) for rep in reps]
+        self.flush_interval = flush_interval
+        self.finish_time = None
+
+        frame_columns = {
+            'timestamp': ('float64', ()),
+            'landmarks': ('float32', (NUM_LANDMARKS, 4)),
+            'angles': ('float32', (len(self.angle_names),)),
+            'state': ('int8', (len(self.joints),)),
+            'predicted': ('bool', ()),
+            'popped': ('int16', ()),
+        }
+        self.frames = _ChunkedTable(self.path, 'frames', frame_columns, chunk_rows)
+        self.balloons = _ChunkedTable(self.path, 'balloons', BALLOON_COLUMNS, max(chunk_rows // 16, 64))
+
+        # Reused for frames without landmarks or angles
+        self._no_landmarks = np.full((NUM_LANDMARKS, 4), np.nan, dtype=np.float32)
+        self._no_angles = np.full(len(self.angle_names), np.nan, dtype=np.float32)
+        self._no_state = np.full(len(self.joints), -1, dtype=np.int8)
+
+        self.subscription = None
+        self._write_meta(0, 0)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def record(self, timestamp, landmarks=None, angles=None, state=None, predicted=False, popped=0, hits=()):
+        """
+        Appends one frame. Only copies into memory, never waits for the disk.
+
+        :param timestamp: Seconds since the game started
+        :param landmarks: Landmark array of shape (33, 4), None if nothing was detected
+        :param angles: Angles in the order of angle_names, None if nothing was detected
+        :param state: FSM state index per joint (Think.fsm.state)
+        :param predicted: True if the landmarks were extrapolated instead of detected
+        :param popped: Number of balloons popped so far
+        :param hits: BalloonHit tuples of this frame
+        """
+        frame = self.frames.rows
+        self.frames.append({
+            'timestamp': timestamp,
+            'landmarks': self._no_landmarks if landmarks is None else landmarks,
+            'angles': self._no_angles if angles is None else angles,
+            'state': self._no_state if state is None else state,
+            'predicted': predicted,
+            'popped': popped,
+        })
+        for hit in hits:
+            self.balloons.append({'frame': frame, 'timestamp': timestamp, 'slot': hit.slot, 'limb': hit.limb,
+                                  'stage': hit.stage, 'popped': hit.popped})
+
+    def _create_session_directory(self, root):
+        # Named after the start time, sessions started in the same second get a suffix (-1, -2, ...)
+        base = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        os.makedirs(root, exist_ok=True)
+        suffix = 0
+        while True:
+            session_id = f'{base}-{suffix}' if suffix else base
+            path = os.path.join(root, session_id)
+            try:
+                os.mkdir(path)
+                return session_id, path
+            except FileExistsError:
+                suffix += 1
+
+    def subscribe(self, bus, policy=DROP_OLDEST, max_pending=256):
+        """
+        Records the POSE events of an EventBus on a thread of the subscription, see record().
+
+        :param policy: Backpressure policy, frames are dropped when the recorder falls behind unless it is BLOCK
+        :param max_pending: Frames waiting at most
+        """
+        self.subscription = bus.subscribe(POSE, self._record_event, policy=policy, max_pending=max_pending,
+                                          name='telemetry')
+        return self.subscription
+
+    def _record_event(self, event):
+        pose = event.data
+        self.record(pose.elapsed_time, pose.landmarks, pose.angles, pose.state, pose.predicted, pose.popped,
+                    pose.hits)
+
+    def finish(self, finish_time):
+        """
+        Stores the time the game was finished in, it is written with the next flush.
+        """
+        self.finish_time = finish_time
+
+    def close(self):
+        """
+        Stops the writer thread and writes everything that is left. The session is complete afterwards.
+        """
+        if self._closed.is_set():
+            return
+        # The frames still waiting on the bus belong to the session
+        if self.subscription is not None:
+            self.subscription.close()
+        self._closed.set()
+        self._thread.join()
+        self._write_meta(self.frames.close(), self.balloons.close(), complete=True)
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.frames.prepare()
+            self.balloons.prepare()
+            self._write_meta(self.frames.flush(), self.balloons.flush())
+
+    def _write_meta(self, frame_rows, balloon_rows, complete=False):
+        meta = {
+            'version': FORMAT_VERSION,
+            'session_id': self.session_id,
+            'started_at': self.started_at,
+            'finish_time': self.finish_time,
+            'complete': complete,
+            'angle_names': self.angle_names,
+            'joints': self.joints,
+            'states': self.states,
+            'reps': self.reps,
+            'tables': {
+                table.name: {'rows': rows, 'chunk_rows': table.chunk_rows,
+                             'columns': {column: [dtype, list(shape)] for column, (dtype, shape) in
+                                         table.columns.items()}}
+                for table, rows in ((self.frames, frame_rows), (self.balloons, balloon_rows))
+            }
+        }
+        # Readers never see a half written file
+        temporary = os.path.join(self.path, META_FILE + '.tmp')
+        with open(temporary, 'w') as file:
+            json.dump(meta, file, indent=1)
+        os.replace(temporary, os.path.join(self.path, META_FILE))
+
+
+class TableReader:
+
+    def __init__(self, directory, name, meta):
+        """
+        Read-only view of one table of a recorded session, the chunk files are memory-mapped on first use.
+        """
+        self.directory = directory
+        self.name = name
+        self.rows = meta['rows']
+        self.chunk_rows = meta['chunk_rows']
+        self.columns = list(meta['columns'])
+        # column -> (dtype, shape of one row)
+        self.dtypes = {column: (np.dtype(dtype), tuple(shape)) for column, (dtype, shape) in meta['columns'].items()}
+        self._chunks = {}
+
+    def __len__(self):
+        return self.rows
+
+    def chunks(self, column):
+        """
+        :param column: Name of the column
+        :return: List of memory-mapped arrays, one per chunk and together holding all rows. Nothing is copied.
+        """
+        chunks = self._chunks.get(column)
+        if chunks is None:
+            chunks = []
+            for index, start in enumerate(range(0, self.rows, self.chunk_rows)):
+                array = np.load(_chunk_path(self.directory, self.name, column, index), mmap_mode='r')
+                chunks.append(array[:min(self.chunk_rows, self.rows - start)])
+            chunks = self._chunks[column] = chunks
+        return chunks
+
+    def column(self, column):
+        """
+        :param column: Name of the column
+        :return: All rows of the column. A memory-mapped view if the table fits into one chunk, otherwise the
+                 chunks are concatenated into memory.
+        """
+        chunks = self.chunks(column)
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            # No chunk file is created before the first row
+            dtype, shape = self.dtypes[column]
+            return np.empty((0, *shape), dtype)
+        return np.concatenate(chunks)
+
+
+# A recorded session, opened for analysis
+class Session:
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the session
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as file:
+            self.meta = json.load(file)
+        self.session_id = self.meta['session_id']
+        self.started_at = self.meta['started_at']
+        self.finish_time = self.meta['finish_time']
+        self.complete = self.meta['complete']
+        self.angle_names = self.meta['angle_names']
+        self.joints = self.meta['joints']
+        self.states = self.meta['states']
+        self.reps = self.meta['reps']
+        self.frames = TableReader(path, 'frames', self.meta['tables']['frames'])
+        self.balloons = TableReader(path, 'balloons', self.meta['tables']['balloons'])
+
+    def __repr__(self):
+        return f"Session({self.session_id!r}, frames={len(self.frames)}, finish_time={self.finish_time})"
+
+
+def open_sessions(root='sessions', since=None, until=None):
+    """
+    Opens all recorded sessions under root. Only the metadata is read, the columns are mapped on access.
+
+    :param root: Directory the sessions were recorded to
+    :param since: Only sessions started at or after this time.time() value
+    :param until: Only sessions started before this time.time() value
+    :return: List of Session, oldest first
+    """
+    sessions = []
+    if not os.path.isdir(root):
+        return sessions
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isfile(os.path.join(path, META_FILE)):
+            continue
+        session = Session(path)
+        if since is not None and session.started_at < since:
+            continue
+        if until is not None and session.started_at >= until:
+            continue
+        sessions.append(session)
+    sessions.sort(key=lambda session: session.started_at)
+    return sessions
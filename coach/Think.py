@@ -1,8 +1,25 @@
 import math
+import random
+import time
 
 import cv2
-from transitions import Machine
 import collections
+import numpy as np
+
+from coach.Events import HIT, POSE, REP, STATE, STATS, EventBus, PoseFrame
+from coach.Fsm import ExerciseFsm, FLEXION_EXTENSION
+from coach.Sense import JOINT_INDEX
+from coach.Stats import RepStatistics
+
+
+# Landmark that has to touch each balloon type, in the order of Act.limb_list
+LIMB_LANDMARKS = (JOINT_INDEX['left_wrist'], JOINT_INDEX['left_knee'],
+                  JOINT_INDEX['right_wrist'], JOINT_INDEX['right_knee'])
+# Joint angle whose range of motion decides how far each balloon type is placed, see Act.random_location
+LIMB_JOINTS = ('left_elbow', 'left_knee', 'right_elbow', 'right_knee')
+
+# A balloon that was touched this frame. popped is True when it was the last stage and the balloon burst.
+BalloonHit = collections.namedtuple('BalloonHit', ['slot', 'limb', 'landmark', 'stage', 'popped'])
 
 
 # Think Component: Decision Making
@@ -10,17 +27,20 @@ import collections
 
 class Think(object):
 
-    def __init__(self, act_component, flexion_threshold=90, extension_threshold=120):
+    def __init__(self, act_component, flexion_threshold=90, extension_threshold=120, max_targets=1,
+                 joints=('right_elbow', 'left_elbow'), exercise=FLEXION_EXTENSION, bus=None):
         """
-        Initializes the state machine and sets up the transition logic.
-        :param act_component: Reference to the Act component to trigger visual feedback
+        Initializes the state machines, one per tracked joint, and the balloon game.
+        :param act_component: The Act component, only its random_location is used to place the balloons
         :param flexion_threshold: threshold for entering the flexion state
         :param extension_threshold: threshold for entering the extension state
+        :param max_targets: number of balloons on screen at the same time
+        :param joints: Names of the angles from Sense's AngleEngine that get a state machine, the first one
+                       is the one state and update_state refer to
+        :param exercise: The ExerciseSpec the state machines run
+        :param bus: EventBus the repetitions, state changes and balloon hits are published on, a new one if None
         """
 
-        # Define initial state and thresholds for transitions
-        self.state = 'flexion'  # Initial state
-        self.previous_state = self.state
         self.flexion_threshold = flexion_threshold  # Elbow angle threshold for flexion
         self.extension_threshold = extension_threshold  # Elbow angle threshold for extension
 
@@ -28,23 +48,40 @@ class Think(object):
         self.flexion_to_extension_count = 0  # Count transitions from flexion to extension
         self.extension_to_flexion_count = 0  # Count transitions from extension to flexion
 
-        # Act component for visualization
-        self.act_component = act_component
+        # Everything Think decides goes out as events, Act subscribes to what it shows and says
+        self.bus = bus or EventBus()
+        self._origin = None
 
-        # Define the state machine with states 'flexion' and 'extension'
-        states = ['flexion', 'extension']
+        # The balloon game, Act decides where new balloons are placed
+        self.game = BalloonGame(act_component.random_location, max_targets=max_targets)
 
-        # Initialize the state machine
-        self.machine = Machine(model=self, states=states, initial='flexion')
+        # One compiled state machine per joint, all stepped together
+        self.fsm = ExerciseFsm(exercise, joints, flexion_threshold, extension_threshold)
+        self.fsm.add_listener(self)
+        self.fsm.add_state_listener(self.on_state_change)
 
-        # Define transitions
-        self.machine.add_transition(trigger='angle_decreasing', source='extension', dest='flexion',
-                                    after='increment_ext_to_flexion')
-        # conditions='is_flexion_threshold_reached',
+        # Range of motion, duration and speed of every repetition, updated sample by sample
+        self.stats = RepStatistics(self.fsm.joints)
+        self._columns = None
+        self._index = None
 
-        self.machine.add_transition(trigger='angle_increasing', source='flexion', dest='extension',
-                                    after='increment_flexion_to_extension')
-        # conditions='is_extension_threshold_reached',
+    @property
+    def state(self):
+        """
+        State of the first tracked joint.
+        """
+        return self.fsm.state_name(0)
+
+    def reset(self):
+        """
+        Starts over: new balloon game, state machines back to the initial state and the counters at zero.
+        """
+        self.game.reset()
+        self.fsm.reset()
+        # The statistics describe the patient, they carry over to the next game
+        self.stats.break_cycles()
+        self.flexion_to_extension_count = 0
+        self.extension_to_flexion_count = 0
 
     # Condition for transition to 'flexion' state
     def is_flexion_threshold_reached(self, angle):
@@ -67,47 +104,238 @@ class Think(object):
         return angle > self.extension_threshold  # Extension is detected when the elbow is almost straight
 
     # Method to update the FSM state based on the current elbow angle
-    def update_state(self, current_angle, previous_angle):
+    def update_state(self, current_angle, previous_angle, timestamp=None):
         """
-        Updates the state machine based on the current angle (flexion or extension).
+        Updates the state machine of the first tracked joint based on the current angle (flexion or extension).
+        The other joints keep their state.
 
         :param current_angle: The current elbow joint angle (in degrees)
-        :param previous_angle: The previous elbow joint angle (in degrees)
+        :param previous_angle: The previous elbow joint angle (in degrees). Not needed anymore, the hysteresis
+                               of the thresholds already tells in which direction the angle moves.
+        :param timestamp: Time of the sample in seconds, time.monotonic() if None
+        :return: List of RepEvent
+        """
+        self._origin = None
+        angles = np.full(len(self.fsm.joints), np.nan)
+        angles[0] = current_angle
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        self.stats.push(angles, timestamp)
+        return self.fsm.step(angles, timestamp)
+
+    def update_angles(self, angles, index, timestamp, origin=None):
+        """
+        Steps the state machines of all tracked joints.
+
+        :param angles: Angles from Sense.extract_angles, shape (angles,) or a batch of shape (samples, angles)
+        :param index: Column of every angle name, Sense.angle_engine.index
+        :param timestamp: Time of the sample(s) in seconds
+        :param origin: time.perf_counter() of the capture of the frame, for the latency of the events
+        :return: List of RepEvent
         """
+        self._origin = origin
+        if self._index is not index:
+            self._columns = np.array([index[joint] for joint in self.fsm.joints], dtype=np.intp)
+            self._index = index
+        angles = np.asarray(angles)[..., self._columns]
+        if angles.ndim == 1:
+            self.stats.push(angles, timestamp)
+            return self.fsm.step(angles, timestamp)
 
-        # Check if the angle is decreasing and we're in the extension state
-        if current_angle < previous_angle and self.state == 'extension':
-            if self.is_flexion_threshold_reached(current_angle):
-                self.angle_decreasing()
+        # A batch is stepped sample by sample, the statistics need each sample before the reps it causes
+        timestamps = np.broadcast_to(np.asarray(timestamp, dtype=float), (len(angles),))
+        reps = []
+        for row, row_timestamp in zip(angles, timestamps):
+            self.stats.push(row, row_timestamp)
+            reps += self.fsm.step(row, row_timestamp)
+        return reps
 
-        # Check if the angle is increasing and we're in the flexion state
-        elif current_angle > previous_angle and self.state == 'flexion':
-            if self.is_extension_threshold_reached(current_angle):
-                self.angle_increasing()
+    def update_game(self, landmarks, frame_width, frame_height, confirmed=True, origin=None):
+        """
+        Runs the balloon game on a frame and publishes the confirmed hits.
 
-        # Debug: Print the current state and transition counts
-        # print(f"Elbow Angle: {current_angle}, State: {self.state}")
-        # print(f"Transitions - Flexion to Extension: {self.flexion_to_extension_count}, "
-        #       f"Extension to Flexion: {self.extension_to_flexion_count}")
+        :param landmarks: Landmark array of shape (33, 4) from Sense
+        :param confirmed: False for predicted landmarks, see BalloonGame.update
+        :param origin: time.perf_counter() of the capture of the frame, for the latency of the events
+        :return: List of BalloonHit
+        """
+        hits = self.game.update(landmarks, frame_width, frame_height, confirmed=confirmed)
+        if confirmed:
+            for hit in hits:
+                self.bus.publish(HIT, hit, origin)
+        return hits
 
-    # Methods to increment transition counters (no arguments needed)
-    def increment_flexion_to_extension(self):
+    def publish_pose(self, elapsed_time, landmarks=None, angles=None, predicted=False, hits=(), origin=None):
         """
-        Callback when transitioning from flexion to extension. Increments the repetition count.
+        Publishes a processed frame as a POSE event, with copies of everything that changes with the next frame.
+
+        :param elapsed_time: Seconds since the game started
+        :param landmarks: Landmark array of shape (33, 4), None if nothing was detected
+        :param angles: Angles from Sense.extract_angles, None if nothing was detected
+        :param predicted: True if the landmarks were extrapolated
+        :param hits: BalloonHit tuples of the frame, only the confirmed ones are published
+        :param origin: time.perf_counter() of the capture of the frame
         """
-        self.flexion_to_extension_count += 1
-        self.act_component.handle_balloon_inflation()  # Inflate the balloon
+        self.bus.publish(POSE, PoseFrame(elapsed_time, None if landmarks is None else np.array(landmarks),
+                                         None if angles is None else np.array(angles), predicted,
+                                         self.fsm.state.copy(), self.game.popped_count,
+                                         tuple(hits) if not predicted else ()), origin)
 
-    def increment_ext_to_flexion(self):
+    def on_rep(self, event):
         """
-        Callback when transitioning from extension to flexion.
+        Counts the repetitions of all tracked joints and publishes them, with their statistics once a cycle
+        is complete.
         """
-        self.extension_to_flexion_count += 1
-        self.act_component.handle_balloon_inflation()  # Reset timeout trigger
+        if event.kind == 'flexion_to_extension':
+            self.flexion_to_extension_count += 1
+        elif event.kind == 'extension_to_flexion':
+            self.extension_to_flexion_count += 1
+        self.bus.publish(REP, event, self._origin)
+        rep = self.stats.on_rep(event)
+        if rep is not None:
+            self.bus.publish(STATS, rep, self._origin)
+
+    def on_state_change(self, change):
+        """
+        Publishes the state changes of the state machines.
+        """
+        self.bus.publish(STATE, change, self._origin)
 
     def is_landmark_over_image(self, joint_coords, image_rect, frame_width, frame_height):
+        """
+        Checks if a landmark lies inside an image rectangle.
+
+        :param joint_coords: Normalized (x, y) of the landmark, or its row in Sense's landmark array
+        :param image_rect: (x1, y1, x2, y2) of the image in pixels
+        :param frame_width: Width of the frame in pixels
+        :param frame_height: Height of the frame in pixels
+        :return: True if the landmark is over the image
+        """
         img_x1, img_y1, img_x2, img_y2 = image_rect
         x, y = joint_coords[0] * frame_width, joint_coords[1] * frame_height
         if img_x1 <= x <= img_x2 and img_y1 <= y <= img_y2:
             return True
         return False
+
+
+# Balloon game: all active balloons live in parallel arrays, so one vectorized pass per frame hit-tests every
+# landmark against every balloon no matter how many balloons are on screen.
+class BalloonGame(object):
+
+    def __init__(self, place, max_targets=1, balloon_size=100, last_stage=5, initial_location=(500, 100)):
+        """
+        :param place: Function (limb, frame_width, frame_height) -> (x, y) that picks where a new balloon goes
+        :param max_targets: Number of balloons on screen at the same time
+        :param balloon_size: Width and height of a balloon in pixels
+        :param last_stage: The stage after which a touched balloon pops
+        :param initial_location: Location of the first balloon of a game
+        """
+        self.place = place
+        self.max_targets = max_targets
+        self.balloon_size = balloon_size
+        self.last_stage = last_stage
+        self.initial_location = initial_location
+
+        self.x = np.zeros(max_targets, dtype=np.int32)
+        self.y = np.zeros(max_targets, dtype=np.int32)
+        self.limb = np.zeros(max_targets, dtype=np.int8)
+        self.landmark = np.zeros(max_targets, dtype=np.intp)
+        self.stage = np.zeros(max_targets, dtype=np.int8)
+        self.active = np.zeros(max_targets, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new game: removes all balloons and sets the popped count to zero.
+        The balloons are spawned on the next update, once the frame size is known.
+        """
+        self.active[:] = False
+        self.stage[:] = 0
+        self.popped_count = 0
+        self._started = False
+
+    @property
+    def slots(self):
+        """
+        Indices of the active balloons.
+        """
+        return np.flatnonzero(self.active)
+
+    def rect(self, slot):
+        """
+        :return: The hit box (x1, y1, x2, y2) of a balloon in pixels
+        """
+        x, y = int(self.x[slot]), int(self.y[slot])
+        return x, y, x + self.balloon_size, y + self.balloon_size
+
+    def spawn(self, limb, frame_width, frame_height, location=None, landmark=None):
+        """
+        Puts a new balloon into a free slot.
+
+        :param limb: The balloon type (0-3), decides the picture and by default the landmark that pops it
+        :param location: (x, y) of the balloon, picked by place() if None
+        :param landmark: Index of the pose landmark (0-32) that pops the balloon, by default the one of the limb
+        :return: The slot of the balloon, None if all slots are taken
+        """
+        free = np.flatnonzero(~self.active)
+        if len(free) == 0:
+            return None
+        slot = free[0]
+        if location is None:
+            location = self.place(limb, frame_width, frame_height)
+        self.x[slot], self.y[slot] = location
+        self.limb[slot] = limb
+        self.landmark[slot] = LIMB_LANDMARKS[limb] if landmark is None else landmark
+        self.stage[slot] = 0
+        self.active[slot] = True
+        return slot
+
+    def hit_test(self, landmarks, frame_width, frame_height):
+        """
+        Checks which balloons are touched by their landmark.
+
+        :param landmarks: Landmark array of shape (33, 4) from Sense
+        :return: Boolean array over all slots, True where an active balloon is touched
+        """
+        # Only the landmark of each balloon against that balloon, one point per slot
+        target = landmarks[self.landmark, :2]
+        x = target[:, 0] * frame_width
+        y = target[:, 1] * frame_height
+        size = self.balloon_size
+        return (self.x <= x) & (x <= self.x + size) & (self.y <= y) & (y <= self.y + size) & self.active
+
+    def update(self, landmarks, frame_width, frame_height, confirmed=True):
+        """
+        Advances every touched balloon by one stage, pops the ones past the last stage and replaces them.
+
+        :param landmarks: Landmark array of shape (33, 4) from Sense
+        :param confirmed: False for predicted landmarks, hits are then only reported and the game is not changed
+        :return: List of BalloonHit for the touched balloons
+        """
+        if not self._started:
+            self._fill(frame_width, frame_height)
+            self._started = True
+
+        touched = np.flatnonzero(self.hit_test(landmarks, frame_width, frame_height))
+        hits = []
+        for slot in touched:
+            popped = confirmed and self.stage[slot] >= self.last_stage
+            hits.append(BalloonHit(int(slot), int(self.limb[slot]), int(self.landmark[slot]),
+                                   int(self.stage[slot]), bool(popped)))
+        if not confirmed:
+            return hits
+
+        self.stage[touched] += 1
+        for hit in hits:
+            if hit.popped:
+                self.active[hit.slot] = False
+                self.popped_count += 1
+                # The next balloon is for a different limb
+                limbs = [limb for limb in range(len(LIMB_LANDMARKS)) if limb != hit.limb]
+                self.spawn(random.choice(limbs), frame_width, frame_height)
+        return hits
+
+    def _fill(self, frame_width, frame_height):
+        limbs = list(range(len(LIMB_LANDMARKS)))
+        self.spawn(0, frame_width, frame_height, location=self.initial_location)
+        while self.active.sum() < self.max_targets:
+            self.spawn(random.choice(limbs), frame_width, frame_height)
@@ -1,120 +1,303 @@
-import random
+import argparse
+import concurrent.futures
+import functools
+import logging
+import os
 import time
 
+# Startup metrics are measured from here, before the heavy imports
+PROGRAM_START = time.perf_counter()
+
 import cv2
-import mediapipe as mp
-from numpy.ma.core import nonzero
 
 from coach import Sense
 from coach import Think
 from coach import Act
+from coach.Events import DROP_OLDEST, POSE, EventBus
+from coach.Fsm import rep_transitions
+from coach.Governor import QualityGovernor, apply_level
+from coach.Pipeline import Pipeline
+from coach.Profiler import DISABLED, Profiler
+from coach.Sprites import SpriteAtlas
+from coach.Streaming import StreamServer
+from coach.Telemetry import TelemetryRecorder
+
+
+def play_frame(sense, think, act, frame, joints, elapsed_time, frame_width, frame_height, profiler=DISABLED,
+               origin=None):
+    """
+    Runs the game logic for one frame: draws the balloons and feedback and checks which balloons are hit.
+    Think publishes what happened on its bus, and the whole frame as a POSE event if anyone subscribed to it.
+
+    :param frame: The mirrored camera frame, drawn on in place
+    :param joints: The PoseResults of this frame from Sense.detect_joints
+    :param elapsed_time: Seconds since the game started
+    :param profiler: Profiler the stages are timed with
+    :param origin: time.perf_counter() of the capture of the frame, the events' latency is measured from it
+    :return: List of BalloonHit of this frame, None if no landmarks were detected
+    """
+    # If landmarks are detected, calculate the elbow angle
+    if joints.landmarks is not None:
+        # Sense already converted the landmarks, everything below reads from the array
+        landmarks = joints.landmarks
+        with profiler.stage('show_balloons'):
+            act.show_balloons(think.game, frame)
+
+        # Calculate the distance from the camera
+        distance = sense.calculate_distance(landmarks)
+
+        angles = None
+        # Repetitions are only counted on landmarks MediaPipe actually saw
+        if not joints.predicted:
+            angles = sense.extract_angles(landmarks)
+            with profiler.stage('update_state'):
+                think.update_angles(angles, sense.angle_engine.index, elapsed_time, origin)
+
+        # Act takes the state changes from the bus
+        with profiler.stage('provide_feedback'):
+            act.provide_feedback(frame=frame, joints=joints, distance=distance, elapsed_time=elapsed_time)
+
+        # Never pop on extrapolated landmarks, let the next frame run MediaPipe to confirm the hit
+        with profiler.stage('hit_test'):
+            hits = think.update_game(landmarks, frame_width, frame_height, confirmed=not joints.predicted,
+                                     origin=origin)
+        if hits and joints.predicted:
+            sense.request_keyframe()
+
+        if think.bus.has_subscribers(POSE):
+            if angles is None:
+                angles = sense.extract_angles(landmarks)
+            think.publish_pose(elapsed_time, landmarks, angles, joints.predicted, hits, origin)
+        return hits
+
+    if think.bus.has_subscribers(POSE):
+        think.publish_pose(elapsed_time, origin=origin)
+    return None
+
+
+def new_recorder(sense, think, root="sessions", policy=DROP_OLDEST):
+    """
+    Starts the telemetry of a new game session, recorded from the POSE events of Think's bus.
+
+    :param policy: Backpressure policy of the recorder's subscription, BLOCK records every frame even when the
+                   disk cannot keep up
+    """
+    recorder = TelemetryRecorder(root, angle_names=sense.angle_engine.names, joints=think.fsm.joints,
+                                 states=think.fsm.spec.states, reps=rep_transitions(think.fsm.spec))
+    recorder.subscribe(think.bus, policy=policy)
+    return recorder
+
 
-import numpy as np
+def warm_up(sense, camera, profiler):
+    """
+    Loads the pose model and runs a dummy inference at the camera resolution. Runs on a startup thread.
+
+    :param sense: The Sense whose model is loaded
+    :param camera: Future of the cv2.VideoCapture, the warmup frame gets its size
+    :param profiler: Profiler the load and warmup durations are recorded to
+    """
+    start = time.perf_counter()
+    sense.load()
+    loaded = time.perf_counter()
+    profiler.record('model_load', loaded - start)
+
+    cap = camera.result()
+    frame_shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 480, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 640, 3)
+    warmup_start = time.perf_counter()
+    sense.warmup(frame_shape)
+    profiler.record('model_warmup', time.perf_counter() - warmup_start)
+
+
+def report_startup(profiler, time_to_first_landmark):
+    """
+    Records and prints the startup metrics once the first landmarks of the game were shown.
+
+    :param time_to_first_landmark: Seconds from the end of the tutorial to the first frame with landmarks
+    """
+    profiler.record('time_to_first_landmark', time_to_first_landmark)
+    time_to_first_frame = profiler.percentiles('time_to_first_frame')[0]
+    model_load = profiler.percentiles('model_load')[0]
+    model_warmup = profiler.percentiles('model_warmup')[0]
+    print(f"Startup: first frame after {time_to_first_frame:.0f} ms, model loaded in {model_load:.0f} ms "
+          f"and warmed up in {model_warmup:.0f} ms, first landmarks {1000 * time_to_first_landmark:.0f} ms "
+          f"after the tutorial")
 
 
 # Main Program Loop
-def main():
+def main(stream_port=None, stream_host='127.0.0.1', target_fps=25.0):
     """
     Main function to initialize the exercise tracking application.
 
     This function sets up the webcam feed, initializes the Sense, Think, and Act components,
     and starts the main loop to continuously process frames from the webcam.
+    Capture and pose detection run on their own threads (see coach.Pipeline), this loop only renders.
+    Press 'h' to toggle the profiling HUD, the stage timings are written to profiles/ when the program ends.
+    Every game is recorded to sessions/ (see coach.Telemetry).
+
+    :param stream_port: Port of the local streaming server (see coach.Streaming), None streams nothing
+    :param stream_host: Address the streaming server listens on
+    :param target_fps: Frame rate the quality governor holds (see coach.Governor), None keeps the quality fixed
     """
 
-    # Initialize the components: Sense for input, Think for decision-making, Act for output
-    sense = Sense.Sense()
-    act = Act.Act()
-    think = Think.Think(act)
+    # Stage timings, cheap enough to always be on
+    profiler = Profiler()
 
-    # Initialize the webcam capture
-    cap = cv2.VideoCapture(0)  # Use the default camera (0)
+    # Show the tutorial right away, the camera and the pose model load in the background while it is read
+    sprites = SpriteAtlas()
+    cv2.imshow("Pop The Balloons", sprites.image("balloon_tutorial"))
+    cv2.waitKey(1)
+    tutorial_start = time.time()
+    profiler.record('time_to_first_frame', time.perf_counter() - PROGRAM_START)
 
-    # Start the timer
+    # Initialize the components: Sense for input, Think for decision-making, Act for output
+    # Pose inference runs on every third frame at most, the landmarks in between are predicted
+    sense = Sense.Sense(keyframe_interval=3)
+    loader = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+    camera = loader.submit(cv2.VideoCapture, 0)  # Use the default camera (0)
+    warmup = loader.submit(warm_up, sense, camera, profiler)
+    # Think publishes repetitions, state changes, hits and frames, Act and the telemetry subscribe
+    bus = EventBus(profiler)
+    act = Act.Act(sprites=sprites, bus=bus)
+    think = Think.Think(act, bus=bus)
+
+    # Remote viewers get the composed frames and the events, encoded on the server's own threads
+    server = None
+    if stream_port is not None:
+        server = StreamServer(stream_host, stream_port, bus, angle_names=sense.angle_engine.names,
+                              joints=think.fsm.joints, states=think.fsm.spec.states, profiler=profiler).start()
+        print("Streaming on http://%s:%d/" % server.address)
+
+    # The tutorial stays for 15 seconds or until space is pressed, and at least until the model is warm
     tutorial_duration = 15
-    start_time = time.time() + tutorial_duration
-
-    tutorial = cv2.imread("images/balloon_tutorial.png")
+    skipped = False
+    while not ((skipped or time.time() - tutorial_start >= tutorial_duration) and warmup.done()):
+        if cv2.waitKey(30) & 0xFF == ord(' '):
+            skipped = True
+    warmup.result()
+    loader.shutdown()
+
+    cap = camera.result()
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    # Capture and inference threads, the newest frame always wins
+    pipeline = Pipeline(cap, sense.detect_joints, profiler=profiler).start()
+
+    # The governor lowers the quality on machines that cannot hold the frame rate, and raises it again when
+    # they can. The target stays below what the camera delivers, no quality level makes the camera faster.
+    governor = None
+    if target_fps:
+        camera_fps = cap.get(cv2.CAP_PROP_FPS)
+        if camera_fps > 0:
+            target_fps = min(target_fps, 0.9 * camera_fps)
+        governor = QualityGovernor(target_fps, apply=functools.partial(apply_level, sense=sense, act=act,
+                                                                        profiler=profiler))
 
-    # Main loop to process video frames
-    while cap.isOpened():
+    # Start the timer
+    start_time = time.time()
+    game_start = time.perf_counter()
+    first_landmark = False
 
-        # Capture frame-by-frame from the webcam
-        ret, frame = cap.read()
+    # Telemetry of the current game, started with its first frame
+    recorder = None
 
-        frame = cv2.flip(frame, 1)
+    # Main loop to process video frames
+    while True:
 
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        if not ret:
+        # Take the newest processed frame from the pipeline
+        packet = pipeline.get()
+        if packet is None:
             print("Failed to grab frame")
             break
-
+        render_start = time.perf_counter()
+        frame = packet.frame
 
         # Calculate elapsed time
         elapsed_time = time.time() - start_time  # Calculate elapsed time
 
-
-        if elapsed_time < 0:
-            cv2.imshow("Pop The Balloons", tutorial)
-            if cv2.waitKey(10) & 0xFF == ord(' '):
-                start_time = time.time()
-            continue
-
-        if act.popped_count >= 10:
+        if think.game.popped_count >= 10:
+            pipeline.inference_enabled.clear()
+            if governor is not None:
+                governor.pause()
             if act.finish_time is None:
                 act.finish_time = elapsed_time
-            end_screen = cv2.imread("images/balloons_end_screen.png")
+                if recorder is not None:
+                    recorder.finish(act.finish_time)
+            end_screen = act.sprites.image("balloons_end_screen").copy()
             cv2.putText(end_screen, f'{act.finish_time:.2f}s', (255, 280), cv2.FONT_HERSHEY_COMPLEX, 1.6, (255, 160, 230), 4, cv2.LINE_AA)
             cv2.imshow("Pop The Balloons", end_screen)
+            if server is not None:
+                server.offer(end_screen)
 
-            if cv2.waitKey(10) & 0xFF == ord(' '):
+            if cv2.waitKey(1) & 0xFF == ord(' '):
                 # Restart
                 act.finish_time = None
-                act.popped_count = 0
-                act.stage = 0
-                act.location = (500, 100)
-                act.current_balloon = 0
+                if recorder is not None:
+                    recorder.close()
+                    recorder = None
+                think.reset()
                 start_time = time.time()
 
             continue
 
-        # Sense: Detect joints
-        joints = sense.detect_joints(frame)
-        landmarks = joints.pose_landmarks
-
-        # If landmarks are detected, calculate the elbow angle
-        if landmarks:
-            shoulder = sense.extract_joint_coordinates(landmarks, 'left_shoulder')
-            left_knee = sense.extract_joint_coordinates(landmarks, "left_knee")
-            right_knee = sense.extract_joint_coordinates(landmarks, "right_knee")
-            left_wrist = sense.extract_joint_coordinates(landmarks, "left_wrist")
-            right_wrist = sense.extract_joint_coordinates(landmarks, "right_wrist")
-            limbs = [left_wrist, left_knee, right_wrist, right_knee]
-            overlay_rect = act.show_balloon(act.current_balloon, frame)
-            # print(act.current_balloon, limbs[act.current_balloon])
-
-            # Calculate the distance from the camera
-            distance = sense.calculate_distance(landmarks)
-
-            decision = think.state
-
-            act.provide_feedback(decision, frame=frame, joints=joints, distance=distance, elapsed_time=elapsed_time)
-
-            if think.is_landmark_over_image(limbs[act.current_balloon], overlay_rect, frame_width, frame_height):
-                act.enlarge(frame_width,frame_height)
-                print("Hand is over the image!")
-            mp.solutions.drawing_utils.draw_landmarks(frame, joints.pose_landmarks, mp.solutions.pose.POSE_CONNECTIONS)
-
-
-            cv2.imshow("Pop The Balloons", frame)
-
-        if cv2.waitKey(10) & 0xFF == ord('q'):
+        pipeline.inference_enabled.set()
+
+        # Frames that passed the inference stage while it was switched off carry no results
+        if packet.results is not None:
+            # Sense already ran on the inference thread, play the game on its results
+            if recorder is None:
+                recorder = new_recorder(sense, think)
+            hits = play_frame(sense, think, act, frame, packet.results, elapsed_time, frame_width, frame_height,
+                              profiler, origin=packet.captured_at)
+            if hits is not None:
+                if not first_landmark:
+                    first_landmark = True
+                    report_startup(profiler, time.perf_counter() - game_start)
+                profiler.draw_hud(frame)
+                with profiler.stage('imshow'):
+                    cv2.imshow("Pop The Balloons", frame)
+                # The frame is not drawn on anymore, the server encodes it without a copy
+                if server is not None:
+                    server.offer(frame)
+                profiler.frame()
+                if governor is not None:
+                    governor.frame()
+                profiler.record('render', time.perf_counter() - render_start)
+                profiler.record('motion_to_photon', time.perf_counter() - packet.captured_at)
+            else:
+                profiler.drop()
+                if governor is not None:
+                    governor.pause()
+
+        with profiler.stage('waitKey'):
+            key = cv2.waitKey(1) & 0xFF
+        if key == ord('h'):
+            profiler.show_hud = not profiler.show_hud
+        if key == ord('q'):
             break
 
-    # Release the webcam and close all OpenCV windows
+    # Stop the pipeline, release the webcam and close all OpenCV windows
+    pipeline.stop()
+    if recorder is not None:
+        recorder.close()
+    os.makedirs("profiles", exist_ok=True)
+    profiler.export(time.strftime("profiles/profile-%Y%m%d-%H%M%S.csv"))
+    if server is not None:
+        server.close()
+    act.close()
+    bus.close()
     cap.release()
     cv2.destroyAllWindows()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Pop The Balloons, the rehabilitation game")
+    parser.add_argument('--stream', type=int, metavar='PORT', help='Serve the game on a local streaming server')
+    parser.add_argument('--stream-host', default='127.0.0.1',
+                        help='Address the streaming server listens on, 0.0.0.0 for other machines')
+    parser.add_argument('--target-fps', type=float, default=25.0,
+                        help='Frame rate the quality governor holds, 0 keeps the quality fixed')
+    args = parser.parse_args()
+    # Quality level changes are logged
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+    main(args.stream, args.stream_host, args.target_fps)
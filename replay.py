@@ -0,0 +1,187 @@
+"""
+Headless replay: runs a recorded video or image sequence through Sense, Think and Act without a window,
+webcam or tutorial, and writes per-frame landmarks, balloon hits, popped counts and timings as JSON lines.
+
+Examples:
+    python replay.py session.mp4 --output session.jsonl
+    python replay.py "frames/*.png" --fps 30 --realtime
+"""
+import argparse
+import glob
+import json
+import random
+import sys
+import time
+
+import cv2
+
+from coach import Sense
+from coach import Think
+from coach import Act
+from coach.Events import BLOCK, EventBus
+from coach.Profiler import Profiler
+from main import new_recorder, play_frame
+
+
+def read_frames(source, fps=30.0):
+    """
+    Yields the frames of a video file or an image sequence.
+
+    :param source: Path of a video file, or a glob pattern matching image files (sorted by name)
+    :param fps: Frame rate of image sequences, videos use their own frame rate
+    :return: Generator of (frame, timestamp in seconds)
+    """
+    images = sorted(glob.glob(source)) if any(char in source for char in '*?[') else []
+    if images:
+        for index, path in enumerate(images):
+            frame = cv2.imread(path)
+            if frame is None:
+                raise FileNotFoundError(f"Could not read image {path}")
+            yield frame, index / fps
+        return
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Could not open video {source}")
+    video_fps = cap.get(cv2.CAP_PROP_FPS) or fps
+    index = 0
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame, index / video_fps
+            index += 1
+    finally:
+        cap.release()
+
+
+def replay(source, output, fps=30.0, realtime=False, flip=True, keyframe_interval=1, seed=0, output_video=None,
+           profile=None, balloons=1, telemetry=None):
+    """
+    Replays a recording through the game and writes one JSON object per frame to output.
+
+    :param source: Video file or image glob, see read_frames
+    :param output: Writable text file for the JSON lines
+    :param fps: Frame rate of image sequences
+    :param realtime: Pace the frames at their recorded timestamps instead of running as fast as possible
+    :param flip: Mirror the frames like the live camera feed
+    :param keyframe_interval: Passed to Sense, 1 runs MediaPipe on every frame
+    :param seed: Seed for the balloon placement, so runs are comparable
+    :param output_video: Optional path of a video file the rendered frames are written to
+    :param profile: Optional .csv or .jsonl path the per-stage timings are exported to
+    :param balloons: Number of balloons on screen at the same time
+    :param telemetry: Optional directory the run is recorded to as a telemetry session
+    :return: Dictionary with the summary of the run
+    """
+    random.seed(seed)
+    sense = Sense.Sense(keyframe_interval=keyframe_interval)
+    profiler = Profiler(enabled=profile is not None)
+    bus = EventBus(profiler)
+    act = Act.Act(speech=False, bus=bus)
+    think = Think.Think(act, max_targets=balloons, bus=bus)
+    # A replay runs as fast as it can, the recorder holds it up instead of dropping frames
+    recorder = new_recorder(sense, think, telemetry, policy=BLOCK) if telemetry is not None else None
+
+    writer = None
+    frames = 0
+    hit_count = 0
+    detect_total = 0.0
+    play_total = 0.0
+    run_start = time.perf_counter()
+
+    for frame, timestamp in read_frames(source, fps):
+        if realtime:
+            delay = run_start + timestamp - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if flip:
+            frame = cv2.flip(frame, 1)
+        frame_height, frame_width = frame.shape[:2]
+
+        start = time.perf_counter()
+        joints = sense.detect_joints(frame)
+        detected = time.perf_counter()
+
+        hits = play_frame(sense, think, act, frame, joints, timestamp, frame_width, frame_height, profiler)
+        played = time.perf_counter()
+        profiler.record('detect_joints', detected - start)
+        profiler.frame()
+        hit = bool(hits) and not joints.predicted
+        if think.game.popped_count >= 10 and act.finish_time is None:
+            act.finish_time = timestamp
+            if recorder is not None:
+                recorder.finish(timestamp)
+
+        frames += 1
+        hit_count += hit
+        detect_total += detected - start
+        play_total += played - detected
+
+        output.write(json.dumps({
+            'frame': frames - 1,
+            'time': round(timestamp, 4),
+            'landmarks': joints.landmarks.astype(float).round(5).tolist() if hits is not None else None,
+            'predicted': bool(joints.predicted),
+            'hit': hit,
+            'balloons': [[int(think.game.limb[slot]), int(think.game.stage[slot])] for slot in think.game.slots],
+            'popped': think.game.popped_count,
+            'detect_ms': round(1000 * (detected - start), 3),
+            'play_ms': round(1000 * (played - detected), 3)
+        }) + '\n')
+
+        if output_video is not None:
+            if writer is None:
+                writer = cv2.VideoWriter(output_video, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                         (frame_width, frame_height))
+            writer.write(frame)
+
+    if writer is not None:
+        writer.release()
+    if profile is not None:
+        profiler.export(profile)
+    if recorder is not None:
+        recorder.close()
+    bus.close()
+
+    wall_time = time.perf_counter() - run_start
+    return {
+        'frames': frames,
+        'hits': hit_count,
+        'popped': think.game.popped_count,
+        'finish_time': act.finish_time,
+        'fps': frames / wall_time if wall_time > 0 else 0.0,
+        'mean_detect_ms': 1000 * detect_total / max(frames, 1),
+        'mean_play_ms': 1000 * play_total / max(frames, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='Video file or quoted glob pattern of images')
+    parser.add_argument('--output', '-o', help='JSON lines file for the per-frame results (default: stdout)')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of image sequences')
+    parser.add_argument('--realtime', action='store_true', help='Pace frames at their recorded timestamps')
+    parser.add_argument('--no-flip', action='store_true', help='Do not mirror the frames')
+    parser.add_argument('--keyframe-interval', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-video', help='Write the rendered frames to this video file')
+    parser.add_argument('--profile', help='Export the per-stage timings to this .csv or .jsonl file')
+    parser.add_argument('--balloons', type=int, default=1, help='Number of balloons on screen at the same time')
+    parser.add_argument('--telemetry', help='Record the run as a telemetry session into this directory')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        summary = replay(args.source, output, fps=args.fps, realtime=args.realtime, flip=not args.no_flip,
+                         keyframe_interval=args.keyframe_interval, seed=args.seed, output_video=args.output_video,
+                         profile=args.profile, balloons=args.balloons,
+                         telemetry=args.telemetry)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(summary), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Station manager: one workstation serving several rehab stations, one camera each. Every camera gets its own
+worker process for capture and pose detection (see coach.Stations), the frames come back through shared memory.
+Each station plays its own balloon game, the outputs are tiled into one window or shown in separate windows.
+
+Keys: space restarts the finished stations, 'h' toggles the profiling HUDs, 'q' quits.
+
+Examples:
+    python stations.py 0 1 2
+    python stations.py 0 1 --windows --speech
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+
+from coach import Act
+from coach import Think
+from coach.Events import EventBus
+from coach.Profiler import Profiler
+from coach.Stations import FrameRing, StationSense, station_worker
+from main import new_recorder, play_frame
+
+
+class Station:
+
+    def __init__(self, index, source, context, sense_options=None, flip=True, speech=False, telemetry=None,
+                 core=None):
+        """
+        One camera with its worker process and its own game (Think, Act, profiler and telemetry).
+
+        :param index: Number of the station, used in window titles and file names
+        :param source: Camera index or video path
+        :param context: multiprocessing context the worker is started with
+        :param sense_options: Keyword arguments for the worker's Sense
+        :param flip: Mirror the frames horizontally
+        :param speech: Speak the motivating utterances of this station
+        :param telemetry: Directory the sessions of this station are recorded to, None records nothing
+        :param core: CPU core the worker is pinned to
+        """
+        self.index = index
+        self.name = f"Station {index + 1}"
+        self.stop_event = context.Event()
+        self.keyframe = context.Event()
+        self.connection, worker_connection = context.Pipe(duplex=False)
+        self.process = context.Process(target=station_worker, name=f'station-{index}', daemon=True,
+                                       args=(source, worker_connection, self.stop_event, self.keyframe,
+                                             sense_options, flip, 4, core))
+
+        self.sense = StationSense(self.keyframe)
+        self.profiler = Profiler()
+        self.bus = EventBus(self.profiler)
+        self.act = Act.Act(speech=speech, bus=self.bus)
+        self.think = Think.Think(self.act, bus=self.bus)
+        self.telemetry = telemetry
+        self.recorder = None
+
+        self.ring = None
+        self.frame = None
+        self.sequence = -1
+        self.start_time = None
+
+    def start(self, timeout=30.0):
+        """
+        Starts the worker and attaches to its frame ring once the camera delivered the first frame.
+        """
+        self.process.start()
+        if not self.connection.poll(timeout):
+            raise RuntimeError(f"{self.name}: the worker did not start")
+        info = self.connection.recv()
+        if info is None:
+            raise RuntimeError(f"{self.name}: could not read from the camera")
+        name, shape, slots, num_angles = info
+        self.ring = FrameRing(shape, slots, num_angles, name=name)
+        self.frame = np.zeros(shape, dtype=np.uint8)
+        return self
+
+    @property
+    def finished(self):
+        return self.think.game.popped_count >= 10
+
+    def update(self):
+        """
+        Plays the game on the newest frame of the worker.
+
+        :return: True if the station has a new frame to show
+        """
+        packet = self.ring.read_latest(self.sequence, out=self.frame)
+        if packet is None:
+            return False
+        self.sequence = packet.sequence
+        frame_height, frame_width = self.frame.shape[:2]
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        elapsed_time = time.monotonic() - self.start_time
+
+        if self.finished:
+            if self.act.finish_time is None:
+                self.act.finish_time = elapsed_time
+                if self.recorder is not None:
+                    self.recorder.finish(elapsed_time)
+            end_screen = cv2.resize(self.act.sprites.image("balloons_end_screen"), (frame_width, frame_height))
+            cv2.putText(end_screen, f'{self.act.finish_time:.2f}s', (255, 280), cv2.FONT_HERSHEY_COMPLEX, 1.6,
+                        (255, 160, 230), 4, cv2.LINE_AA)
+            self.frame[:] = end_screen
+            return True
+
+        self.sense.angles = packet.angles
+        if self.telemetry is not None and self.recorder is None:
+            self.recorder = new_recorder(self.sense, self.think, self.telemetry)
+        # The worker's capture time is time.monotonic(), not the bus clock, so it is not the events' origin
+        play_frame(self.sense, self.think, self.act, self.frame, packet.joints, elapsed_time, frame_width,
+                   frame_height, self.profiler)
+
+        self.profiler.draw_hud(self.frame)
+        self.profiler.frame()
+        self.profiler.record('motion_to_photon', time.monotonic() - packet.captured_at)
+        return True
+
+    def restart(self):
+        """
+        Starts a new game on this station.
+        """
+        self.act.finish_time = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self.think.reset()
+        self.start_time = None
+
+    def close(self):
+        self.stop_event.set()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        if self.ring is not None:
+            self.ring.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.act.close()
+        self.bus.close()
+
+
+class TiledDisplay:
+
+    def __init__(self, count, tile_size, columns=None):
+        """
+        One canvas with a tile per station.
+
+        :param count: Number of stations
+        :param tile_size: (width, height) of a tile, frames of another size are scaled
+        :param columns: Number of tiles per row, as square as possible if None
+        """
+        self.columns = columns or math.ceil(math.sqrt(count))
+        rows = math.ceil(count / self.columns)
+        self.tile_width, self.tile_height = tile_size
+        self.canvas = np.zeros((rows * self.tile_height, self.columns * self.tile_width, 3), dtype=np.uint8)
+
+    def tile(self, index):
+        """
+        :return: The part of the canvas of the tile
+        """
+        row, column = divmod(index, self.columns)
+        return self.canvas[row * self.tile_height:(row + 1) * self.tile_height,
+                           column * self.tile_width:(column + 1) * self.tile_width]
+
+    def draw(self, index, frame):
+        tile = self.tile(index)
+        if frame.shape[:2] == tile.shape[:2]:
+            tile[:] = frame
+        else:
+            tile[:] = cv2.resize(frame, (self.tile_width, self.tile_height), interpolation=cv2.INTER_AREA)
+
+
+def parse_source(text):
+    return int(text) if text.isdigit() else text
+
+
+def run(sources, windows=False, speech=False, flip=True, keyframe_interval=3, inference_budget=0.5,
+        telemetry='sessions', pin=True):
+    """
+    Runs one station per source until 'q' is pressed or every camera stopped.
+
+    :param sources: Camera indices or video paths
+    :param windows: One window per station instead of one tiled window
+    :param speech: Speak the motivating utterances (all stations share the speakers)
+    :param keyframe_interval: Passed to each worker's Sense
+    :param inference_budget: Passed to each worker's Sense, under load the workers predict more frames
+                             instead of falling behind the camera
+    :param telemetry: Directory the sessions are recorded to, one subdirectory per station. None records nothing.
+    :param pin: Pin every worker to its own CPU core when there are enough cores
+    """
+    # spawn: the workers must not inherit MediaPipe or OpenCV threads of this process
+    context = multiprocessing.get_context('spawn')
+    sense_options = {'keyframe_interval': keyframe_interval, 'inference_budget': inference_budget}
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    # The first core is left to this process, it renders all stations
+    pin = pin and len(cores) > len(sources)
+
+    stations = []
+    try:
+        for index, source in enumerate(sources):
+            station = Station(index, source, context, sense_options, flip, speech,
+                              os.path.join(telemetry, f'station-{index + 1}') if telemetry else None,
+                              cores[index + 1] if pin else None)
+            stations.append(station)
+            station.start()
+
+        display = None
+        if not windows:
+            frame_height, frame_width = stations[0].frame.shape[:2]
+            display = TiledDisplay(len(stations), (frame_width, frame_height))
+
+        while any(station.process.is_alive() for station in stations):
+            updated = False
+            for station in stations:
+                if station.update():
+                    updated = True
+                    if windows:
+                        cv2.imshow(station.name, station.frame)
+                    else:
+                        display.draw(station.index, station.frame)
+            if updated and display is not None:
+                cv2.imshow("Pop The Balloons", display.canvas)
+
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):
+                break
+            if key == ord('h'):
+                for station in stations:
+                    station.profiler.show_hud = not station.profiler.show_hud
+            if key == ord(' '):
+                for station in stations:
+                    if station.finished:
+                        station.restart()
+    finally:
+        os.makedirs("profiles", exist_ok=True)
+        for station in stations:
+            station.close()
+            station.profiler.export(time.strftime(f"profiles/station-{station.index + 1}-%Y%m%d-%H%M%S.csv"))
+        cv2.destroyAllWindows()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', type=parse_source, help='Camera indices or video files')
+    parser.add_argument('--windows', action='store_true', help='One window per station instead of tiles')
+    parser.add_argument('--speech', action='store_true', help='Speak the motivating utterances')
+    parser.add_argument('--no-flip', action='store_true', help='Do not mirror the frames')
+    parser.add_argument('--keyframe-interval', type=int, default=3)
+    parser.add_argument('--inference-budget', type=float, default=0.5,
+                        help='Fraction of the time a worker may spend in MediaPipe')
+    parser.add_argument('--telemetry', default='sessions', help='Session directory, one subdirectory per station')
+    parser.add_argument('--no-telemetry', action='store_true', help='Do not record the sessions')
+    parser.add_argument('--no-pin', action='store_true', help='Do not pin the workers to CPU cores')
+    args = parser.parse_args()
+    run(args.sources, windows=args.windows, speech=args.speech, flip=not args.no_flip,
+        keyframe_interval=args.keyframe_interval, inference_budget=args.inference_budget,
+        telemetry=None if args.no_telemetry else args.telemetry, pin=not args.no_pin)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import json
+import os
+
+from coach.Analytics import summarize_session, summarize_sessions
+from coach.Telemetry import META_FILE, TelemetryRecorder
+
+
+def _record_empty(root, session_id):
+    recorder = TelemetryRecorder(root, angle_names=['left_elbow', 'right_elbow'], joints=['right_elbow'],
+                                 states=['flexion', 'extension'], session_id=session_id)
+    recorder.close()
+    return recorder.path
+
+
+def test_session_without_frames_has_an_empty_summary(tmp_path):
+    summary = summarize_session(_record_empty(str(tmp_path), 'empty'))
+    assert summary['frames'] == 0
+    assert summary['reps'] == 0
+    assert summary['reps_right_elbow'] == 0
+    assert summary['reps_per_minute'] is None
+    assert summary['rom_left_elbow'] is None
+    assert summary['symmetry_elbow'] is None
+
+
+def test_sessions_that_cannot_be_read_are_skipped(tmp_path):
+    _record_empty(str(tmp_path), 'a-empty')
+    damaged = _record_empty(str(tmp_path), 'b-damaged')
+    # Claims rows whose chunk files do not exist
+    with open(os.path.join(damaged, META_FILE)) as file:
+        meta = json.load(file)
+    meta['tables']['frames']['rows'] = 10
+    with open(os.path.join(damaged, META_FILE), 'w') as file:
+        json.dump(meta, file)
+
+    summaries = summarize_sessions(str(tmp_path), workers=1)
+    assert [summary['session_id'] for summary in summaries] == ['a-empty']
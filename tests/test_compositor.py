@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from coach.Compositor import Compositor
+
+
+def _random_overlay(rng, height=24, width=32):
+    overlay = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    # Fully transparent and fully opaque pixels, the two ends of the fixed-point math
+    overlay[:4, :, 3] = 0
+    overlay[-4:, :, 3] = 255
+    return overlay
+
+
+def _float_blend(frame, overlay, x, y):
+    # The reference: alpha blending in floating point, on a frame big enough for the whole sprite
+    out = frame.astype(np.float64)
+    alpha = overlay[:, :, 3:4] / 255.0
+    height, width = overlay.shape[:2]
+    out[y:y + height, x:x + width] = overlay[:, :, :3] * alpha + out[y:y + height, x:x + width] * (1 - alpha)
+    return out
+
+
+def test_blend_matches_the_float_reference():
+    rng = np.random.default_rng(0)
+    overlay = _random_overlay(rng)
+    frame = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    expected = _float_blend(frame, overlay, 10, 20)
+
+    assert Compositor().blend(frame, Compositor.premultiply(overlay), (10, 20)) == (10, 20, 42, 44)
+    assert np.abs(frame - expected).max() <= 1
+    # Transparent pixels leave the frame alone, opaque ones replace it
+    assert np.array_equal(frame[20:24, 10:42], np.rint(expected[20:24, 10:42]))
+    assert np.array_equal(frame[40:44, 10:42], overlay[-4:, :, :3])
+
+
+@pytest.mark.parametrize('pos', [(-10, 5), (5, -10), (60, 5), (5, 45), (-10, -10), (60, 45), (-31, -23)])
+def test_blend_clips_at_every_edge(pos):
+    rng = np.random.default_rng(1)
+    overlay = _random_overlay(rng)
+    sprite = Compositor.premultiply(overlay)
+    frame = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+
+    # The same blend on a frame with a margin all around, where nothing needs clipping
+    margin = 40
+    padded = np.pad(frame, ((margin, margin), (margin, margin), (0, 0)))
+    Compositor().blend(padded, sprite, (pos[0] + margin, pos[1] + margin))
+
+    x, y = pos
+    rect = Compositor().blend(frame, sprite, pos)
+    assert rect == (max(x, 0), max(y, 0), min(x + 32, 80), min(y + 24, 60))
+    assert np.array_equal(frame, padded[margin:-margin, margin:-margin])
+
+
+@pytest.mark.parametrize('pos', [(-32, 0), (0, -24), (80, 0), (0, 60), (-100, -100)])
+def test_blend_outside_the_frame_draws_nothing(pos):
+    rng = np.random.default_rng(2)
+    frame = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    original = frame.copy()
+    assert Compositor().blend(frame, Compositor.premultiply(_random_overlay(rng)), pos) is None
+    assert np.array_equal(frame, original)
+
+
+def test_blend_many_reuses_the_scratch_buffers_for_smaller_sprites():
+    rng = np.random.default_rng(3)
+    big, small = _random_overlay(rng, 40, 50), _random_overlay(rng, 10, 12)
+    placements = [(Compositor.premultiply(big), (0, 0)), (Compositor.premultiply(small), (30, 30))]
+    frame = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    one_by_one = frame.copy()
+    for sprite, pos in placements:
+        Compositor().blend(one_by_one, sprite, pos)
+
+    compositor = Compositor()
+    assert compositor.blend_many(frame, placements) == [(0, 0, 50, 40), (30, 30, 42, 40)]
+    assert compositor._scratch.shape[:2] == (40, 50)
+    assert np.array_equal(frame, one_by_one)
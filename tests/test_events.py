@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from coach.Events import BLOCK, COALESCE, DROP_OLDEST, POSE, STATE, EventBus
+
+
+def _data(events):
+    return [event.data for event in events]
+
+
+def test_drop_oldest_keeps_the_newest_events():
+    bus = EventBus()
+    subscription = bus.subscribe(POSE, policy=DROP_OLDEST, max_pending=3)
+    for frame in range(10):
+        bus.publish(POSE, frame)
+    assert _data(subscription.poll()) == [7, 8, 9]
+    assert subscription.dropped == 7
+    assert subscription.delivered == 3
+
+
+def test_coalesce_keeps_the_newest_event_per_topic():
+    bus = EventBus()
+    subscription = bus.subscribe((POSE, STATE), policy=COALESCE)
+    for frame in range(5):
+        bus.publish(POSE, frame)
+    bus.publish(STATE, 'flexion')
+    assert _data(subscription.poll()) == [4, 'flexion']
+    assert subscription.dropped == 4
+
+
+def test_block_drops_the_new_event_after_the_timeout():
+    bus = EventBus()
+    subscription = bus.subscribe(POSE, policy=BLOCK, max_pending=2)
+    bus.publish(POSE, 0)
+    bus.publish(POSE, 1)
+    start = time.monotonic()
+    bus.publish(POSE, 2, timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+    assert _data(subscription.poll()) == [0, 1]
+    assert subscription.dropped == 1
+
+
+def test_block_holds_the_publisher_until_there_is_room():
+    bus = EventBus()
+    subscription = bus.subscribe(POSE, policy=BLOCK, max_pending=1)
+    bus.publish(POSE, 0)
+    published = threading.Event()
+
+    def publish():
+        bus.publish(POSE, 1)
+        published.set()
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+    assert not published.wait(0.05)
+    assert _data(subscription.poll()) == [0]
+    assert published.wait(1)
+    thread.join()
+    assert _data(subscription.poll()) == [1]
+    assert subscription.dropped == 0
+
+
+def test_threaded_subscriber_handles_every_event_in_order_and_survives_errors():
+    bus = EventBus()
+    handled = []
+
+    def handler(event):
+        if event.data == 3:
+            raise RuntimeError("broken consumer")
+        handled.append(event.data)
+
+    subscription = bus.subscribe(POSE, handler, policy=BLOCK, max_pending=2)
+    for frame in range(20):
+        bus.publish(POSE, frame)
+    subscription.close()
+    assert handled == [frame for frame in range(20) if frame != 3]
+    assert not bus.has_subscribers(POSE)
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        EventBus().subscribe(POSE, policy='drop_newest')
@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+
+from coach.Fsm import FLEXION_EXTENSION, ExerciseFsm
+from coach.Think import Think
+
+
+class _Placement:
+    # Think only needs Act to place the balloons
+    def random_location(self, limb, frame_width, frame_height):
+        return 0, 0
+
+
+def _kinds(reps):
+    return [rep.kind for rep in reps]
+
+
+def test_first_sample_on_monotonic_clock_does_not_time_out():
+    fsm = ExerciseFsm(FLEXION_EXTENSION, ['right_elbow'], 90, 120)
+    start = time.monotonic()
+    changes = []
+    fsm.add_state_listener(changes.append)
+
+    reps = []
+    for offset, angle in enumerate([100, 100, 130, 80, 130]):
+        reps += fsm.step(np.array([angle]), start + 0.1 * offset)
+
+    assert _kinds(reps) == ['flexion_to_extension', 'extension_to_flexion', 'flexion_to_extension']
+    assert all(change.dest != 'idle' for change in changes)
+
+
+def test_reset_without_timestamp_starts_at_next_sample():
+    fsm = ExerciseFsm(FLEXION_EXTENSION, ['right_elbow'], 90, 120)
+    fsm.step(np.array([130]), 5.0)
+    fsm.reset()
+    start = time.monotonic()
+    assert _kinds(fsm.step(np.array([100]), start)) == []
+    assert _kinds(fsm.step(np.array([130]), start + 0.1)) == ['flexion_to_extension']
+
+
+def test_timeout_still_fires_after_the_first_sample():
+    fsm = ExerciseFsm(FLEXION_EXTENSION, ['right_elbow'], 90, 120)
+    start = time.monotonic()
+    fsm.step(np.array([100]), start)
+    fsm.step(np.array([100]), start + FLEXION_EXTENSION.timeout + 1)
+    assert fsm.state_name() == 'idle'
+
+
+def test_think_update_state_counts_the_first_rep_of_every_game():
+    think = Think(_Placement())
+    # The second game starts after reset(), with the timestamps still on time.monotonic()
+    for _ in range(2):
+        for angle in [100, 100, 130, 80, 130]:
+            think.update_state(angle, None)
+        assert think.flexion_to_extension_count == 2
+        assert think.extension_to_flexion_count == 1
+        think.reset()
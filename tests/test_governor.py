@@ -0,0 +1,81 @@
+from coach.Governor import LEVELS, QualityGovernor
+
+
+class _Clock:
+    # Feeds the governor frames at a given frame rate
+    def __init__(self, governor):
+        self.governor = governor
+        self.now = 0.0
+
+    def run(self, fps, seconds):
+        changes = []
+        for _ in range(round(fps * seconds)):
+            self.now += 1 / fps
+            change = self.governor.frame(self.now)
+            if change is not None:
+                changes.append(change.name)
+        return changes
+
+
+def test_applies_the_initial_level():
+    applied = []
+    QualityGovernor(apply=applied.append, level=1)
+    assert applied == [LEVELS[1]]
+
+
+def test_drops_a_level_only_after_staying_slow():
+    governor = QualityGovernor(target_fps=25, downgrade_after=2.0)
+    clock = _Clock(governor)
+    # A short dip does not count
+    assert clock.run(20, 1.5) == []
+    assert clock.run(25, 1.0) == []
+    assert clock.run(20, 4.0) == ['medium']
+    assert governor.changes[0].source == 'high'
+
+
+def test_stays_put_inside_the_tolerance_band():
+    governor = QualityGovernor(target_fps=25, level=1, tolerance=0.1)
+    clock = _Clock(governor)
+    # Above the downgrade threshold (22.5) but below the upgrade one (23.75)
+    assert clock.run(23, 60) == []
+    assert governor.current.name == 'medium'
+
+
+def test_raises_a_level_after_holding_the_target_longer():
+    governor = QualityGovernor(target_fps=25, level=2, upgrade_after=8.0)
+    clock = _Clock(governor)
+    assert clock.run(30, 7.0) == []
+    assert clock.run(30, 3.0) == ['medium']
+
+
+def test_a_failed_upgrade_doubles_the_wait_for_the_next_one():
+    governor = QualityGovernor(target_fps=25, level=1, downgrade_after=2.0, upgrade_after=8.0)
+    clock = _Clock(governor)
+    assert clock.run(30, 10) == ['high']
+    # The better level cannot hold the frame rate: back down, and the next upgrade waits 16 s instead of 8
+    assert clock.run(20, 4) == ['medium']
+    assert clock.run(30, 14) == []
+    assert clock.run(30, 4) == ['high']
+
+
+def test_a_lasting_upgrade_resets_the_wait():
+    governor = QualityGovernor(target_fps=25, level=2, downgrade_after=2.0, upgrade_after=8.0)
+    clock = _Clock(governor)
+    assert clock.run(30, 10) == ['medium']
+    assert clock.run(20, 4) == ['low']
+    assert clock.run(30, 18) == ['medium']
+    assert governor._upgrade_wait == 16.0
+    # Holding the upgraded level for the whole wait brings it back to 8 s
+    clock.run(30, 15.5)
+    assert governor._upgrade_wait == 8.0
+
+
+def test_pause_restarts_the_measurement():
+    governor = QualityGovernor(target_fps=25, downgrade_after=2.0)
+    clock = _Clock(governor)
+    clock.run(20, 1.5)
+    governor.pause()
+    # The gap of the pause is not a slow frame, and the slow time counts anew
+    clock.now += 5.0
+    assert clock.run(20, 1.5) == []
+    assert governor.fps == 0.0 or governor.fps > 19
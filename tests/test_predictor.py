@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from coach.Predictor import LandmarkPredictor
+
+
+def _pose(position, visibility=1.0):
+    landmarks = np.zeros((33, 4), dtype=np.float32)
+    landmarks[:, :3] = position
+    landmarks[:, 3] = visibility
+    return landmarks
+
+
+def _moving(predictor, velocity, frames=30, dt=1 / 30):
+    for frame in range(frames):
+        predictor.correct(_pose(np.multiply(velocity, frame * dt)), frame * dt)
+    return (frames - 1) * dt
+
+
+def test_the_first_measurement_is_held_still():
+    predictor = LandmarkPredictor()
+    assert not predictor.ready
+    predictor.correct(_pose((0.5, 0.4, 0.1), 0.8), 1.0)
+    assert predictor.ready
+    predicted = predictor.predict(1.5, np.empty((33, 4), dtype=np.float32))
+    np.testing.assert_allclose(predicted, _pose((0.5, 0.4, 0.1), 0.8))
+
+
+def test_constant_velocity_is_extrapolated():
+    predictor = LandmarkPredictor()
+    velocity = (0.3, -0.2, 0.05)
+    last = _moving(predictor, velocity)
+    out = np.empty((33, 4), dtype=np.float32)
+    assert predictor.predict(last + 0.1, out) is out
+    np.testing.assert_allclose(out[:, :3], np.broadcast_to(np.multiply(velocity, last + 0.1), (33, 3)), atol=1e-3)
+    assert predictor.speed() == pytest.approx(np.hypot(0.3, 0.2), abs=1e-3)
+
+
+def test_predict_does_not_change_the_filter():
+    predictor = LandmarkPredictor()
+    last = _moving(predictor, (0.3, 0.0, 0.0))
+    position, velocity = predictor.position.copy(), predictor.velocity.copy()
+    predictor.predict(last + 0.2, np.empty((33, 4), dtype=np.float32))
+    np.testing.assert_array_equal(predictor.position, position)
+    np.testing.assert_array_equal(predictor.velocity, velocity)
+
+
+def test_speed_ignores_invisible_landmarks():
+    predictor = LandmarkPredictor()
+    predictor.correct(_pose(0.0, 0.2), 0.0)
+    predictor.correct(_pose(0.1, 0.2), 0.1)
+    assert predictor.speed() == 0.0
+    assert predictor.speed(min_visibility=0.1) > 0
+
+
+def test_reset_forgets_the_motion():
+    predictor = LandmarkPredictor()
+    _moving(predictor, (0.3, 0.0, 0.0))
+    predictor.reset()
+    assert not predictor.ready
+    predictor.correct(_pose(0.2), 5.0)
+    np.testing.assert_allclose(predictor.predict(6.0, np.empty((33, 4)))[:, 0], 0.2)
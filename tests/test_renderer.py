@@ -0,0 +1,26 @@
+import numpy as np
+
+from coach.Renderer import Renderer
+
+
+def _draw(renderer, *args, **kwargs):
+    frame = np.zeros((120, 320, 3), dtype=np.uint8)
+    renderer.text('slot', *args, **kwargs)
+    renderer.flush(frame)
+    return frame
+
+
+def test_cached_text_is_rasterized_again_when_its_style_changes():
+    renderer = Renderer()
+    white = _draw(renderer, 'Pop!', (20, 60))
+    red = _draw(renderer, 'Pop!', (20, 60), color=(0, 0, 255))
+    assert white[:, :, 0].any()
+    assert not red[:, :, 0].any() and red[:, :, 2].any()
+    assert not np.array_equal(_draw(renderer, 'Pop!', (20, 60), scale=0.5), white)
+
+
+def test_cached_and_plain_text_are_drawn_at_the_same_place():
+    renderer = Renderer()
+    cached = _draw(renderer, 'Duration: 1.23 seconds', (20, 60), scale=0.6)
+    plain = _draw(renderer, 'Duration: 1.23 seconds', (20, 60), scale=0.6, cached=False)
+    assert np.array_equal(cached, plain)
@@ -0,0 +1,48 @@
+import types
+
+import numpy as np
+
+from coach.Sense import NUM_LANDMARKS, Sense
+
+
+class _Pose:
+    # Stands in for mediapipe's Pose: the same landmarks, normalized to whatever image it is given
+    def __init__(self, points):
+        self.points = points
+        self.shapes = []
+
+    def process(self, image):
+        self.shapes.append(image.shape[:2])
+        landmark = [types.SimpleNamespace(x=x, y=y, z=0.0, visibility=1.0) for x, y in self.points]
+        return types.SimpleNamespace(pose_landmarks=types.SimpleNamespace(landmark=landmark))
+
+
+def test_landmarks_of_a_cropped_region_are_mapped_to_the_frame():
+    points = np.linspace(0.4, 0.6, NUM_LANDMARKS)[:, None].repeat(2, axis=1)
+    sense = Sense(inference_size=None)
+    sense._mp_pose = _Pose(points)
+    sense.roi = (100, 40, 300, 240)
+
+    joints = sense.detect_joints(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert sense._mp_pose.shapes == [(200, 200)]
+    np.testing.assert_allclose(joints.landmarks[:, 0], (100 + points[:, 0] * 200) / 640, rtol=1e-6)
+    np.testing.assert_allclose(joints.landmarks[:, 1], (40 + points[:, 1] * 200) / 480, rtol=1e-6)
+    # The landmarks span 180-220 px on both axes, much less than the region: it shrinks to them plus the padding
+    # (to a pixel, the array holds float32)
+    np.testing.assert_allclose(sense.roi, (170, 110, 231, 171), atol=1)
+
+
+def test_a_result_is_not_overwritten_by_later_detections():
+    points = np.full((NUM_LANDMARKS, 2), 0.11)
+    sense = Sense(inference_size=None, use_roi=False, keyframe_interval=3)
+    sense._mp_pose = _Pose(points)
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    kept = sense.detect_joints(frame)
+    copy = kept.landmarks.copy()
+
+    # Detected and predicted results alike, more of them than the pipeline could have in flight
+    for step in range(8):
+        points[:] = 0.15 + 0.01 * step
+        sense.detect_joints(frame)
+    np.testing.assert_array_equal(kept.landmarks, copy)
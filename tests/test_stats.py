@@ -0,0 +1,54 @@
+import math
+
+import numpy as np
+import pytest
+
+from coach.Stats import P2Quantile, Welford
+
+
+def _pushed(statistic, values):
+    for value in values:
+        statistic.push(float(value))
+    return statistic
+
+
+def test_welford_matches_numpy():
+    values = np.random.default_rng(0).normal(90, 15, 1000)
+    welford = _pushed(Welford(), values)
+    assert welford.count == 1000
+    assert welford.mean == pytest.approx(values.mean())
+    assert welford.variance == pytest.approx(values.var(ddof=1))
+    assert welford.std == pytest.approx(values.std(ddof=1))
+
+
+def test_welford_needs_two_samples_for_a_variance():
+    assert math.isnan(Welford().mean)
+    welford = _pushed(Welford(), [42])
+    assert welford.mean == 42
+    assert math.isnan(welford.variance)
+
+
+def test_quantile_is_exact_for_few_samples():
+    assert math.isnan(P2Quantile(0.9).value)
+    assert _pushed(P2Quantile(0.9), [10, 20, 30, 40, 50]).value == pytest.approx(46)
+    values = np.random.default_rng(1).uniform(60, 140, 20)
+    for count in range(1, 21):
+        assert _pushed(P2Quantile(0.9), values[:count]).value == pytest.approx(np.percentile(values[:count], 90))
+
+
+@pytest.mark.parametrize('p', [0.5, 0.9])
+def test_quantile_follows_the_samples_after_the_exact_ones(p):
+    rng = np.random.default_rng(2)
+    for count in (25, 50, 200):
+        errors = []
+        for _ in range(100):
+            values = rng.uniform(60, 140, count)
+            errors.append(_pushed(P2Quantile(p), values).value - np.percentile(values, 100 * p))
+        # No bias, and an error that shrinks with the number of samples
+        assert abs(np.mean(errors)) < 2
+        assert np.mean(np.abs(errors)) < 40 / math.sqrt(count)
+
+
+def test_quantile_of_a_long_stream():
+    values = np.random.default_rng(3).normal(100, 20, 20000)
+    assert _pushed(P2Quantile(0.9), values).value == pytest.approx(np.percentile(values, 90), abs=1)
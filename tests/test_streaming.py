@@ -0,0 +1,102 @@
+import io
+import json
+import struct
+
+import cv2
+import numpy as np
+
+from coach.Events import HIT, POSE, REP, STATE, Event, PoseFrame
+from coach.Fsm import RepEvent, StateChange
+from coach.Streaming import (HAS_LANDMARKS, MESSAGE_KINDS, POSE_HEADER, PREDICTED, EventEncoder, FrameEncoder,
+                             read_websocket_frame, websocket_frame)
+from coach.Think import BalloonHit
+
+ANGLE_NAMES = ['left_elbow', 'right_elbow']
+JOINTS = ['right_elbow']
+STATES = ['idle', 'flexion', 'extension']
+
+
+def _event(topic, data):
+    return Event(topic, data, 0.0, 0.0)
+
+
+def test_schema_names_what_the_indices_refer_to():
+    schema = json.loads(EventEncoder(ANGLE_NAMES, JOINTS, STATES).schema())
+    assert schema == {'angle_names': ANGLE_NAMES, 'joints': JOINTS, 'states': STATES, 'kinds': MESSAGE_KINDS}
+
+
+def test_pose_message_round_trips():
+    landmarks = np.random.default_rng(0).random((33, 4)).astype(np.float32)
+    angles = np.array([91.5, 130.25], dtype=np.float32)
+    pose = PoseFrame(12.5, landmarks, angles, True, np.array([2], dtype=np.int8), 7, ())
+    message = EventEncoder(ANGLE_NAMES, JOINTS, STATES).encode(_event(POSE, pose))
+
+    kind, elapsed_time, popped, flags = POSE_HEADER.unpack_from(message)
+    assert (kind, elapsed_time, popped, flags) == (MESSAGE_KINDS[POSE], 12.5, 7, HAS_LANDMARKS | PREDICTED)
+    offset = POSE_HEADER.size
+    assert message[offset] == 2
+    offset += len(JOINTS)
+    np.testing.assert_array_equal(np.frombuffer(message, '<f4', 33 * 4, offset).reshape(33, 4), landmarks)
+    np.testing.assert_array_equal(np.frombuffer(message, '<f4', len(ANGLE_NAMES), offset + 33 * 4 * 4), angles)
+    assert len(message) == offset + (33 * 4 + len(ANGLE_NAMES)) * 4
+
+
+def test_pose_message_without_landmarks_is_only_the_header_and_states():
+    pose = PoseFrame(1.0, None, None, False, np.array([-1], dtype=np.int8), 0, ())
+    message = EventEncoder(ANGLE_NAMES, JOINTS, STATES).encode(_event(POSE, pose))
+    assert len(message) == POSE_HEADER.size + len(JOINTS)
+    assert POSE_HEADER.unpack_from(message)[3] == 0
+    assert struct.unpack_from('<b', message, POSE_HEADER.size)[0] == -1
+
+
+def test_state_rep_and_hit_messages():
+    encoder = EventEncoder(ANGLE_NAMES, JOINTS, STATES)
+    state = encoder.encode(_event(STATE, StateChange('right_elbow', 'flexion', 'extension', 3.5)))
+    assert struct.unpack('<BBBBd', state) == (MESSAGE_KINDS[STATE], 0, 1, 2, 3.5)
+    rep = encoder.encode(_event(REP, RepEvent('right_elbow', 'flexion_to_extension', 'flexion', 'extension',
+                                              125.5, 4.0)))
+    assert struct.unpack('<BBBBfd', rep) == (MESSAGE_KINDS[REP], 0, 1, 2, 125.5, 4.0)
+    hit = encoder.encode(_event(HIT, BalloonHit(2, 1, 15, 4, True)))
+    assert struct.unpack('<BBBBB', hit) == (MESSAGE_KINDS[HIT], 2, 15, 4, 1)
+
+
+def test_websocket_frames_of_every_length_can_be_read_back():
+    for length in (0, 125, 126, 65535, 65536):
+        frame = websocket_frame(0x2, b'x' * length)
+        assert frame[0] == 0x82
+        stream = io.BytesIO(frame + websocket_frame(0x8, b''))
+        assert read_websocket_frame(stream) == 0x2
+        assert read_websocket_frame(stream) == 0x8
+        assert read_websocket_frame(stream) is None
+
+
+def test_masked_client_frames_are_skipped_with_their_mask():
+    # A client frame: masked, payload length 5, then the 4 mask bytes and the payload
+    client = bytes([0x81, 0x80 | 5]) + b'mask' + b'hello'
+    stream = io.BytesIO(client + bytes([0x88, 0x80]) + b'mask')
+    assert read_websocket_frame(stream) == 0x1
+    assert read_websocket_frame(stream) == 0x8
+
+
+def test_frame_encoder_only_encodes_while_watched():
+    encoder = FrameEncoder(fps=200, quality=90, scale=0.5).start()
+    try:
+        frame = np.full((48, 64, 3), (0, 0, 255), dtype=np.uint8)
+        encoder.offer(frame)
+        assert encoder.latest(timeout=0.1) == (0, None)
+
+        encoder.watch()
+        sequence, jpeg = encoder.latest(timeout=2.0)
+        encoder.unwatch()
+        assert sequence == 1
+        image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        assert image.shape == (24, 32, 3)
+        assert abs(int(image[12, 16, 2]) - 255) < 8
+
+        # Nothing newer until the renderer offers a new frame
+        encoder.watch()
+        assert encoder.latest(sequence, timeout=0.1) == (sequence, None)
+        encoder.offer(frame.copy())
+        assert encoder.latest(sequence, timeout=2.0)[0] == 2
+    finally:
+        encoder.close()
@@ -0,0 +1,46 @@
+import threading
+
+import numpy as np
+
+from coach.Telemetry import Session, TelemetryRecorder
+
+
+def test_empty_tables_read_as_empty_columns(tmp_path):
+    recorder = TelemetryRecorder(str(tmp_path), angle_names=['right_elbow'], joints=['right_elbow'],
+                                 states=['flexion'])
+    recorder.close()
+    session = Session(recorder.path)
+    assert session.frames.column('landmarks').shape == (0, 33, 4)
+    assert session.balloons.column('slot').shape == (0,)
+
+
+def test_sessions_started_in_the_same_second_get_their_own_directory(tmp_path):
+    recorders = [TelemetryRecorder(str(tmp_path / 'sessions')) for _ in range(3)]
+    for recorder in recorders:
+        recorder.close()
+    assert len({recorder.path for recorder in recorders}) == 3
+    assert all(Session(recorder.path).complete for recorder in recorders)
+
+
+def test_rows_stay_in_order_while_chunks_are_prepared_concurrently(tmp_path):
+    for run in range(5):
+        recorder = TelemetryRecorder(str(tmp_path), chunk_rows=16, flush_interval=0.0005, session_id=f'run-{run}')
+        # Besides the writer thread, more threads keep creating spare chunks while the frames are appended
+        stop = threading.Event()
+
+        def prepare():
+            while not stop.is_set():
+                recorder.frames.prepare()
+
+        threads = [threading.Thread(target=prepare) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for frame in range(3000):
+            recorder.record(float(frame))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        recorder.close()
+
+        timestamps = Session(recorder.path).frames.column('timestamp')
+        assert np.array_equal(timestamps, np.arange(3000.0))
@@ -0,0 +1,26 @@
+import numpy as np
+
+from coach.Think import BalloonGame
+
+
+def _old_hit_test(game, landmarks, frame_width, frame_height):
+    # Every landmark against every balloon, the reference the indexed test has to match
+    x = landmarks[:, 0, None] * frame_width
+    y = landmarks[:, 1, None] * frame_height
+    size = game.balloon_size
+    inside = (game.x <= x) & (x <= game.x + size) & (game.y <= y) & (y <= game.y + size)
+    return inside[game.landmark, np.arange(game.max_targets)] & game.active
+
+
+def test_hit_test_only_checks_the_landmark_of_each_balloon():
+    rng = np.random.default_rng(0)
+    game = BalloonGame(lambda limb, width, height: (0, 0), max_targets=6, balloon_size=200)
+    for _ in range(200):
+        game.x[:] = rng.integers(0, 440, game.max_targets)
+        game.y[:] = rng.integers(0, 280, game.max_targets)
+        game.landmark[:] = rng.integers(0, 33, game.max_targets)
+        game.active[:] = rng.random(game.max_targets) < 0.8
+        landmarks = rng.random((33, 4))
+        landmarks[rng.random(33) < 0.1] = np.nan
+        expected = _old_hit_test(game, landmarks, 640, 480)
+        assert np.array_equal(game.hit_test(landmarks, 640, 480), expected)